@@ -4,40 +4,3275 @@
 # Features glassmorphism effects, 5 contrasting themes, and chat management
 
 import os
+import re
+import sys
+import ast
+import gzip
 import json
-from flask import Flask, request, jsonify
+import time
+import uuid
+import base64
+import shutil
+import sqlite3
+import mimetypes
+import asyncio
+import multiprocessing
+import hashlib
+import socket
+import selectors
+import queue
+import logging
+import argparse
+import bisect
+import functools
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+from collections import deque, namedtuple, OrderedDict
+from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, g
 from flask_cors import CORS
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:  # Optional: only needed for the async serving mode (python3 app.py --async)
+    import httpx
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    httpx = None
+    WsgiToAsgi = None
+
+try:  # Optional: brotli-compressed index page for browsers that accept it
+    import brotli
+except ImportError:
+    brotli = None
+
+try:  # Optional: the vector index of chat messages used for retrieval (EMBEDDING_MODEL)
+    import numpy as np
+except ImportError:
+    np = None
+
+try:  # Optional: keeps worker processes from indexing at the same time (not available on Windows)
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # --- Configuration ---
 LM_STUDIO_BASE_URL = "http://localhost:1234/v1"
+LM_STUDIO_BASE_URLS = []        # Several OpenAI-compatible backends to spread chats over; empty uses LM_STUDIO_BASE_URL
+BACKEND_HEALTH_INTERVAL = 10    # Seconds between health checks of each backend (only with several backends)
+BACKEND_EJECT_FAILURES = 3      # Consecutive failures before a backend stops getting requests
+BACKEND_EJECT_SECONDS = 30      # How long it is left out before it is tried again
 APP_PORT = 5010
-CONFIG_FILE_PATH = 'config.py'
+CONFIG_FILE_PATH = 'config.json'  # Firebase config saved from the settings panel
+LEGACY_CONFIG_FILE_PATH = 'config.py'  # Read once if config.json doesn't exist yet
+CONTEXT_WINDOW_DEFAULT = 8192   # Context length (tokens) assumed for models not listed below
+MODEL_CONTEXT_WINDOWS = {}      # Per-model context lengths, e.g. {"google/gemma-2-9b": 8192}
+CONTEXT_RESERVED_TOKENS = 1024  # Tokens kept free for the reply when a request doesn't set max_tokens
+PROMPT_SUMMARIZE = False        # Summarize trimmed turns with the model (requests can override with "summarize")
+SUMMARY_MAX_TOKENS = 256        # Length limit of that summary
+CHAT_STORE = 'firebase'         # Where chats are saved: 'firebase' (Firestore) or 'local' (SQLite on this server)
+CHAT_DB_PATH = 'chats.db'       # SQLite database used when CHAT_STORE is 'local'
+CHAT_PAGE_SIZE = 50             # Chats per page of history in the sidebar (max 200)
+SEARCH_PAGE_SIZE = 20           # Messages per page of chat search results (max 100)
+REPLY_SAVE_INTERVAL_MS = 1000   # While a reply streams, save what arrived at most this often...
+REPLY_SAVE_CHARS = 2048         # ...or as soon as this many new characters are waiting
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')  # Output of build.py
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+UPSTREAM_POOL_SIZE = 32         # Keep-alive connections kept per LM Studio host
+UPSTREAM_CONNECT_TIMEOUT = 3.05 # Seconds to establish a TCP connection
+UPSTREAM_READ_TIMEOUT = 600     # Seconds to wait between bytes from LM Studio
+UPSTREAM_RETRIES = 3            # Retries for idempotent requests such as GET /models
+UPSTREAM_RETRY_BACKOFF = 0.3    # Backoff factor between retries (0.3s, 0.6s, 1.2s, ...)
+ASYNC_UPSTREAM_MAX_CONNECTIONS = 10000  # Concurrent LM Studio requests in async mode
+MODELS_CACHE_TTL = 30           # Seconds the model list is served without asking LM Studio
+MODELS_CACHE_STALE_TTL = 600    # Seconds an expired list may still be served while refreshing or if LM Studio is down
+RESPONSE_CACHE = False          # Answer repeated identical chat requests from a cache (requests can override with "cache")
+RESPONSE_CACHE_TTL = 3600       # Seconds a cached reply is reused
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory used by cached replies
+RESPONSE_CACHE_DIR = None       # Directory for a second, on-disk tier that survives restarts, e.g. 'response_cache'
+RESPONSE_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024  # Disk used by that tier
+RESPONSE_CACHE_ANY_TEMPERATURE = False  # Also cache replies sampled with temperature > 0 (they'd never vary again)
+CHAT_SESSIONS = True            # Keep each chat on the server, so the browser sends only the new message of a turn
+SESSION_TTL = 24 * 3600         # Seconds an idle session is kept; after that the browser sends the whole chat once
+SESSION_MAX_BYTES = 64 * 1024 * 1024  # Memory used by sessions
+SESSION_DIR = None              # Directory to also keep sessions on disk, shared by workers and restarts; 'sessions' with several workers
+MODEL_CONCURRENCY = 4           # Chat requests sent to LM Studio at once per model (None for no limit)
+MODEL_CONCURRENCY_LIMITS = {}   # Per-model overrides, e.g. {"google/gemma-2-9b": 1}
+ADMISSION_QUEUE_SIZE = 256      # Requests that may wait per model; more are rejected with 429
+ADMISSION_QUEUE_TIMEOUT = 600   # Seconds a request may wait in the queue before giving up with 503
+BATCH_DIR = 'batches'           # Where batch jobs keep their uploaded requests, results and progress
+BATCH_CONCURRENCY = 2           # Requests of one batch job sent at once (a job can ask for fewer)
+BATCH_RESERVED_SLOTS = 1        # Slots per model batch requests never take, kept free for chats
+BATCH_MAX_BYTES = 256 * 1024 * 1024  # Largest JSONL upload accepted by /api/batch
+EMBEDDING_MODEL = None          # Model that embeds saved chat messages for retrieval, e.g. 'text-embedding-nomic-embed-text-v1.5'
+EMBEDDING_DIR = 'embeddings'    # Where the vector index of chat messages is kept (local chat store only)
+EMBEDDING_BATCH_SIZE = 64       # Messages embedded per /embeddings request while indexing
+RETRIEVAL = False               # Add excerpts of the user's past chats that match the prompt (requests can override with "retrieval")
+RETRIEVAL_TOP_K = 4             # Past messages added to a prompt at most
+RETRIEVAL_MIN_SCORE = 0.5       # Cosine similarity a past message needs to be added
+RETRIEVAL_MAX_CHARS = 1000      # Characters of each past message added
+COALESCE_REQUESTS = True        # Identical chat requests in flight at the same time share one generation
+CANCEL_DIR = 'cancels'          # Where, with several workers, cancel calls are left for the worker running the chat
+METRICS_MAX_MODELS = 50         # Distinct model labels on /metrics; further models are counted as "other"
+TRACE_LOG = True                # Log the timing spans of each chat request as one JSON line on stderr
+TRACE_OTLP_FILE = None          # Also append them as OTLP/JSON lines to this file, e.g. 'traces.jsonl'
+TRACE_OTLP_ENDPOINT = None      # Or send them to an OpenTelemetry collector, e.g. 'http://localhost:4318/v1/traces'
+WORKERS = None                  # Worker processes with --production; None for one per CPU core
+WORKER_THREADS = 32             # Threads per sync worker with --production; each streaming chat holds one
+GRACEFUL_TIMEOUT = 120          # Seconds in-flight generations get to finish when the server is stopped
+
+def setting_from_env(name, raw, default):
+    """Parses an environment variable into the type of the setting it overrides."""
+    if raw.strip().lower() in ('none', 'null'):
+        return None
+    try:
+        if isinstance(default, bool):
+            return raw.strip().lower() in ('1', 'true', 'yes', 'on')
+        if isinstance(default, (int, float)):
+            return type(default)(raw)
+        if isinstance(default, list):
+            return [item.strip() for item in raw.split(',') if item.strip()]
+        if isinstance(default, dict):
+            return json.loads(raw)
+        if default is None:
+            try:
+                return json.loads(raw)
+            except ValueError:
+                return raw
+    except ValueError as e:
+        raise SystemExit(f"Invalid value for {name} in the environment: {e}")
+    return raw
+
+# Every setting above can be overridden by an environment variable of the same name,
+# e.g. LM_STUDIO_BASE_URLS=http://gpu1:1234/v1,http://gpu2:1234/v1 or RESPONSE_CACHE=1.
+for _name, _default in list(globals().items()):
+    if _name.isupper() and _name in os.environ:
+        globals()[_name] = setting_from_env(_name, os.environ[_name], _default)
+
+# --- Config Management ---
+
+def read_legacy_config(path):
+    """Reads FIREBASE_CONFIG from a config.py written by earlier versions, without importing it."""
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == 'FIREBASE_CONFIG' for t in node.targets):
+                config = ast.literal_eval(node.value)
+                return config if isinstance(config, dict) else {}
+    except (OSError, SyntaxError, ValueError):
+        pass
+    return {}
+
+class ConfigStore:
+    """The Firebase config, held in memory and backed by a JSON file.
+
+    save() replaces the file atomically and bumps its version. Every worker
+    process notices a newer file by its mtime, checked at most once per
+    CHECK_INTERVAL, reloads it and calls the on_change() listeners, so no
+    restart is needed and a request rarely touches the filesystem.
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.version = 0
+        self.data = {}
+        self.listeners = []
+        self._signature = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        if not os.path.exists(path) and legacy_path and os.path.exists(legacy_path):
+            self.data = read_legacy_config(legacy_path)
+        self.reload()
+
+    def on_change(self, listener):
+        self.listeners.append(listener)
+
+    def get(self):
+        """The current config; a dict that callers must not modify."""
+        self.check()
+        return self.data
+
+    def check(self):
+        """Reloads the file if it may have changed since the last check."""
+        if time.monotonic() - self._checked >= self.CHECK_INTERVAL:
+            self.reload()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def reload(self):
+        """Reads the file if its mtime, size or inode changed; returns True if the config did."""
+        with self._lock:
+            self._checked = time.monotonic()
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                return False
+            try:
+                with open(self.path) as f:
+                    stored = json.load(f)
+                version, data = int(stored["version"]), dict(stored["firebase"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Keep serving the last good config; the file is read again at the next check.
+                print(f"Could not read {self.path}: {e}")
+                return False
+            self._signature = signature
+            changed = version != self.version or data != self.data
+            self.version, self.data = version, data
+        if changed:
+            self._notify()
+        return changed
+
+    def save(self, data):
+        """Writes a new version of the config and applies it in this process straight away."""
+        self.reload()
+        with self._lock:
+            version = self.version + 1
+            temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump({"version": version, "firebase": data}, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)  # Other workers never read a half-written file
+            except OSError:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self._signature = self._stat()
+            self._checked = time.monotonic()
+            self.version, self.data = version, dict(data)
+        self._notify()
+        return version
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+config_store = ConfigStore(CONFIG_FILE_PATH, LEGACY_CONFIG_FILE_PATH)
+
+def load_firebase_config():
+    """Returns the current Firebase config."""
+    return config_store.get()
+
+def save_firebase_config(config_data):
+    """Saves the Firebase config; every worker picks it up without a restart."""
+    version = config_store.save(config_data)
+    print(f"Firebase configuration saved to {CONFIG_FILE_PATH} (version {version}).")
+    return version
+
+# --- Metrics ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Bucketed observations per label set; observing costs a bisect and a few additions."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., count above the last, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(label_values, list(values)) for label_values, values in self.series.items()]
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {values[-1]}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}"
+
+class Gauge:
+    """A value read at scrape time: `collect` returns {label values: value}."""
+
+    def __init__(self, name, help, labels, collect, kind='gauge'):
+        self.name, self.help, self.labels = name, help, labels
+        self.collect = collect
+        self.kind = kind
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for label_values, value in self.collect().items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class MetricsRegistry:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = []
+        self.models = set()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def gauge(self, name, help, labels, collect, kind='gauge'):
+        return self._add(Gauge(self.prefix + name, help, labels, collect, kind))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def model_label(self, model):
+        """Bounds the model label's cardinality, since the model name comes from the client."""
+        model = model if isinstance(model, str) else str(model)
+        if model in self.models:
+            return model
+        with self._lock:
+            if len(self.models) < METRICS_MAX_MODELS:
+                self.models.add(model)
+                return model
+        return "other"
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry('lmstudio_proxy_')
+http_requests = metrics.counter('http_requests_total', "HTTP requests by route, method and status.", ('route', 'method', 'status'))
+http_duration = metrics.histogram('http_request_duration_seconds', "Time from request to the end of the response.", ('route',))
+http_request_size = metrics.histogram('http_request_size_bytes', "Request body sizes.", ('route',), SIZE_BUCKETS)
+http_response_size = metrics.histogram('http_response_size_bytes', "Response body sizes.", ('route',), SIZE_BUCKETS)
+errors = metrics.counter('errors_total', "Failed requests and interrupted streams by route and type.", ('route', 'type'))
+upstream_latency = metrics.histogram('upstream_latency_seconds', "Time until LM Studio sent response headers for a chat.", ('model',))
+chat_ttft = metrics.histogram('chat_time_to_first_token_seconds', "Time from request to the first reply token sent.", ('model', 'source'))
+chat_duration = metrics.histogram('chat_duration_seconds', "Time from request to the end of the reply.", ('model', 'source'))
+chat_token_rate = metrics.histogram('chat_tokens_per_second', "Generation speed of replies from LM Studio.", ('model',), RATE_BUCKETS)
+chat_tokens = metrics.counter('chat_tokens_total', "Prompt and completion tokens reported by LM Studio.", ('model', 'kind'))
+chat_cancelled = metrics.counter('chat_cancelled_total', "Chat requests stopped before LM Studio finished, by reason.", ('model', 'reason'))
+gpu_seconds_saved = metrics.counter('chat_cancelled_gpu_seconds_saved_total', "Estimated LM Studio generation time saved by cancelled requests.", ('model',))
+client_phase = metrics.histogram('client_phase_seconds', "Chat phases as timed by the browser.", ('phase',), LATENCY_BUCKETS)
+
+ERROR_TYPES = {
+    400: "bad_request", 404: "not_found", 429: "queue_full", 499: "cancelled", 500: "upstream_error",
+    502: "bad_upstream_response", 503: "queue_timeout", 504: "upstream_timeout",
+}
+USAGE_PATTERN = re.compile(rb'"(prompt|completion)_tokens"\s*:\s*(\d+)')
+
+class RequestMeter:
+    """Times one request and records its metrics once the response has been sent.
+
+    Chat replies are inspected chunk by chunk without parsing them: data lines
+    with a delta approximate the token count, and the usage block LM Studio
+    sends is picked out with a regex.
+    """
+
+    def __init__(self, route, method, request_bytes):
+        self.started = time.perf_counter()
+        self.route = route
+        self.method = method
+        self.request_bytes = request_bytes or 0
+        self.model = None     # Set by the chat handlers
+        self.status = None
+        self.source = "upstream"
+        self.response_bytes = 0
+        self.first_token_at = None
+        self.deltas = 0
+        self.usage = {}
+        self.interrupted = False
+
+    def start(self, status, cache_state=None, coalesced=False):
+        self.status = status
+        if coalesced:
+            self.source = "coalesced"
+        elif cache_state == "HIT":
+            self.source = "cache"
+
+    def chunk(self, chunk):
+        self.response_bytes += len(chunk)
+        if self.model is None:
+            return
+        deltas = chunk.count(b'"delta"')
+        if deltas:
+            self.deltas += deltas
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+        if b'"usage"' in chunk:
+            self.usage.update((kind.decode(), int(count)) for kind, count in USAGE_PATTERN.findall(chunk))
+        if b'event: error' in chunk:
+            self.interrupted = True
+
+    def count(self, chunks):
+        """Passes a streamed body through, observing each chunk."""
+        try:
+            for chunk in chunks:
+                self.chunk(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def finish(self):
+        now = time.perf_counter()
+        duration = now - self.started
+        if self.status is None:
+            self.status = 500  # The handler failed before it could respond
+        http_requests.inc(self.route, self.method, self.status)
+        http_duration.observe(duration, self.route)
+        http_request_size.observe(self.request_bytes, self.route)
+        http_response_size.observe(self.response_bytes, self.route)
+        if self.status >= 400:
+            errors.inc(self.route, ERROR_TYPES.get(self.status, f"http_{self.status}"))
+        if self.model is None or self.status != 200:
+            return
+        if self.interrupted:
+            errors.inc(self.route, "stream_error")
+        model = metrics.model_label(self.model)
+        first_token_at = self.first_token_at or now
+        chat_ttft.observe(first_token_at - self.started, model, self.source)
+        chat_duration.observe(duration, model, self.source)
+        if self.source != "upstream":
+            return
+        for kind in ("prompt", "completion"):
+            if kind in self.usage:
+                chat_tokens.inc(model, kind, amount=self.usage[kind])
+        tokens = self.usage.get("completion", self.deltas)
+        generating = now - first_token_at if self.first_token_at else duration
+        if tokens and generating > 0:
+            chat_token_rate.observe(tokens / generating, model)
+
+# --- Tracing ---
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,128}$')
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+CLIENT_PHASES = ('save_prompt', 'response_headers', 'first_token', 'stream', 'save_reply')
+
+trace_log = logging.getLogger('lmstudio_proxy.trace')
+if not trace_log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_log.addHandler(_handler)
+    trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class Trace:
+    """The request id and timing spans of one request.
+
+    Spans are kept as perf_counter offsets from the start of the request. A
+    W3C traceparent header from the client makes this request part of its trace.
+    """
+
+    def __init__(self, name, request_id=None, traceparent=None):
+        self.name = name
+        self.request_id = request_id if request_id and REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        match = TRACEPARENT_PATTERN.match(traceparent or '')
+        self.trace_id, self.parent_id = match.groups() if match else (uuid.uuid4().hex, None)
+        self.span_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []  # (name, start, end, attributes)
+
+    def add(self, name, start, end, **attributes):
+        self.spans.append((name, start - self.started, end - self.started, attributes))
+
+    def server_timing(self):
+        """A Server-Timing header value with the spans finished so far."""
+        entries = [f"{name.replace('.', '-')};dur={(end - start) * 1000:.1f}" for name, start, end, _ in self.spans]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def finish(self, status, model=None):
+        """Logs and exports the trace; requests that recorded no spans are skipped."""
+        if not self.spans:
+            return
+        duration = time.perf_counter() - self.started
+        if TRACE_LOG:
+            trace_log.info(json.dumps({
+                "request_id": self.request_id, "trace_id": self.trace_id, "name": self.name, "model": model,
+                "status": status, "duration_ms": round(duration * 1000, 1),
+                "spans": [
+                    {"name": name, "start_ms": round(start * 1000, 1), "duration_ms": round((end - start) * 1000, 1), **attributes}
+                    for name, start, end, attributes in self.spans
+                ],
+            }))
+        if span_exporter is not None:
+            span_exporter.export(self, status, model, duration)
+
+def record_span(name, start, end=None, **attributes):
+    """Adds a span to the current request's trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, start, time.perf_counter() if end is None else end, **attributes)
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, **attributes)
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_attributes(attributes):
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+class OtlpExporter:
+    """Exports traces as OTLP/JSON, batched on a background thread.
+
+    Each batch is appended as one line to `path` (the format of the collector's
+    file exporter) and/or POSTed to an OTLP/HTTP `endpoint`. Requests never wait
+    on the export; when the queue is full, traces are dropped and counted.
+    """
+
+    BATCH_SIZE = 256
+    FLUSH_INTERVAL = 2.0
+
+    def __init__(self, path=None, endpoint=None):
+        self.path = path
+        self.endpoint = endpoint
+        self.queue = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        threading.Thread(target=self._run, name='otlp-exporter', daemon=True).start()
+
+    def export(self, trace, status, model, duration):
+        try:
+            self.queue.put_nowait((trace, status, model, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    def _spans(self, trace, status, model, duration):
+        def nanos(offset):
+            return str(int((trace.started_at + offset) * 1e9))
+        yield {
+            "traceId": trace.trace_id, "spanId": trace.span_id, "parentSpanId": trace.parent_id or "",
+            "name": trace.name, "kind": 2, "startTimeUnixNano": nanos(0), "endTimeUnixNano": nanos(duration),
+            "attributes": otlp_attributes({"http.response.status_code": status, "request.id": trace.request_id, "llm.model": model}),
+            "status": {"code": 2 if status is not None and status >= 500 else 0},
+        }
+        for name, start, end, attributes in trace.spans:
+            yield {
+                "traceId": trace.trace_id, "spanId": uuid.uuid4().hex[:16], "parentSpanId": trace.span_id,
+                "name": name, "kind": 3 if name.startswith('upstream') else 1,
+                "startTimeUnixNano": nanos(start), "endTimeUnixNano": nanos(end), "attributes": otlp_attributes(attributes),
+            }
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while len(batch) < self.BATCH_SIZE and time.monotonic() < deadline:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            body = json.dumps({"resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": "lmstudio-proxy"})},
+                "scopeSpans": [{"scope": {"name": "app.py"}, "spans": [s for item in batch for s in self._spans(*item)]}],
+            }]})
+            try:
+                if self.path:
+                    with open(self.path, 'a') as f:
+                        f.write(body + "\n")
+                if self.endpoint:
+                    requests.post(self.endpoint, data=body, headers={"Content-Type": "application/json"}, timeout=5)
+            except (OSError, requests.exceptions.RequestException) as e:
+                trace_log.warning(json.dumps({"error": "Could not export traces.", "details": str(e)}))
+
+span_exporter = OtlpExporter(TRACE_OTLP_FILE, TRACE_OTLP_ENDPOINT) if TRACE_OTLP_FILE or TRACE_OTLP_ENDPOINT else None
+
+# --- Cancellation ---
+
+class RequestCancelled(Exception):
+    """Raised in a chat request that was stopped by the browser, the cancel API or a disconnect."""
+
+current_cancellation = contextvars.ContextVar('current_cancellation', default=None)
+
+class Cancellation:
+    """Lets a running chat request be stopped from another thread.
+
+    The upstream socket the request is reading from is attached while LM Studio
+    works on it; cancelling shuts that socket down, so the blocked read returns
+    at once and LM Studio sees the connection close and stops generating.
+    """
+
+    def __init__(self, request_id, user, model=None):
+        self.request_id = request_id
+        self.user = user
+        self.model = model
+        self.ticket = None      # The admission ticket, once the request has one
+        self.reason = None
+        self.finished = False
+        self.client_socket = None
+        self._socket = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def on_cancel(self, callback):
+        self._callbacks.append(callback)
+
+    def attach(self, sock):
+        """Remembers the upstream socket; shuts it down at once if the request is already cancelled."""
+        with self._lock:
+            self._socket = sock
+            cancelled = self.cancelled
+        if cancelled:
+            shutdown_socket(sock)
+
+    def detach(self):
+        with self._lock:
+            self._socket = None
+
+    def done(self):
+        """Marks the reply as complete; there is nothing left to cancel."""
+        with self._lock:
+            self.finished = True
+
+    def cancel(self, reason):
+        """Stops the request; returns the estimated GPU seconds saved, or None if it had already ended."""
+        with self._lock:
+            if self.cancelled or self.finished:
+                return None
+            self.reason = reason
+            sock = self._socket
+        if self.ticket is not None:
+            self.ticket.cancelled = True
+        saved = admission.remaining_service_time(self.model, self.ticket) if self.model is not None else 0.0
+        if sock is not None:
+            shutdown_socket(sock)
+        for callback in self._callbacks:
+            callback()
+        model = metrics.model_label(self.model)
+        chat_cancelled.inc(model, reason)
+        gpu_seconds_saved.inc(model, amount=saved)
+        return saved
+
+def shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Already closed
+
+def request_cancelled():
+    cancellation = current_cancellation.get()
+    return cancellation is not None and cancellation.cancelled
+
+def raise_if_cancelled():
+    cancellation = current_cancellation.get()
+    if cancellation is not None and cancellation.cancelled:
+        raise RequestCancelled(f"The request was cancelled ({cancellation.reason}).")
+
+def raise_if_task_cancelled():
+    """The async version of raise_if_cancelled(): httpx can swallow the task.cancel() meant to stop the request."""
+    if request_cancelled():
+        raise asyncio.CancelledError(f"The request was cancelled ({current_cancellation.get().reason}).")
+
+def request_done():
+    cancellation = current_cancellation.get()
+    if cancellation is not None:
+        cancellation.done()
+
+def detach_upstream():
+    """Stops tying the upstream connection to the current request, before it goes back to the pool."""
+    cancellation = current_cancellation.get()
+    if cancellation is not None:
+        cancellation.detach()
+
+def cancelled_event():
+    cancellation = current_cancellation.get()
+    return sse_event({"reason": cancellation.reason if cancellation else None}, event="cancelled")
+
+class CancellableConnectionMixin:
+    """Attaches an upstream connection's socket to the request being served once the request is sent."""
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        cancellation = current_cancellation.get()
+        if cancellation is not None and self.sock is not None:
+            cancellation.attach(self.sock)
+
+class CancellableHTTPConnection(CancellableConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class CancellableHTTPSConnection(CancellableConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class CancellableHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+class CancellableHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+class ActiveRequests:
+    """The chat requests in progress in this process, by request id, for the cancel API."""
+
+    def __init__(self):
+        self.requests = {}
+        self.counters = {"cancelled": 0, "gpu_seconds_saved": 0.0}
+        self.lock = threading.Lock()
+
+    def start(self, request_id, user, model=None):
+        cancellation = Cancellation(request_id, user, model)
+        with self.lock:
+            self.requests[request_id] = cancellation
+        return cancellation
+
+    def end(self, cancellation):
+        cancellation.done()
+        with self.lock:
+            if self.requests.get(cancellation.request_id) is cancellation:
+                del self.requests[cancellation.request_id]
+        if cancellation.client_socket is not None:
+            disconnects.unwatch(cancellation.client_socket)
+
+    def running(self, request_id):
+        with self.lock:
+            return request_id in self.requests
+
+    def cancel(self, request_id, user, reason='client'):
+        """Cancels a request of `user`; returns the GPU seconds saved, or None if there is no such request."""
+        with self.lock:
+            cancellation = self.requests.get(request_id)
+        if cancellation is None or cancellation.user != user:
+            return None
+        return self.stop(cancellation, reason)
+
+    def stop(self, cancellation, reason):
+        saved = cancellation.cancel(reason)
+        if saved is not None:
+            with self.lock:
+                self.counters["cancelled"] += 1
+                self.counters["gpu_seconds_saved"] += saved
+        return saved
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.requests), "cancelled": self.counters["cancelled"],
+                    "gpu_seconds_saved": round(self.counters["gpu_seconds_saved"], 3)}
+
+active_requests = ActiveRequests()
+
+class DisconnectWatcher:
+    """Cancels chat requests whose browser hung up, for the WSGI servers.
+
+    One thread polls the client sockets of running chat requests. A socket that
+    turns readable and peeks as closed means the browser is gone; a socket with
+    data on it (a pipelined request) is just no longer watched. Only servers that
+    expose the client socket (werkzeug and gunicorn) can be watched this way.
+    """
+
+    INTERVAL = 0.25  # Seconds between applying watch/unwatch calls
+
+    def __init__(self):
+        self._changes = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def watch(self, sock, cancellation):
+        with self._lock:
+            self._changes.append((sock, cancellation))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, sock):
+        with self._lock:
+            self._changes.append((sock, None))
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        while True:
+            with self._lock:
+                changes, self._changes = self._changes, []
+            for sock, cancellation in changes:
+                try:
+                    if cancellation is not None:
+                        selector.register(sock, selectors.EVENT_READ, cancellation)
+                    else:
+                        selector.unregister(sock)
+                except (KeyError, ValueError, OSError):
+                    pass  # Closed already, or never registered
+            if not selector.get_map():
+                time.sleep(self.INTERVAL)
+                continue
+            for key, _ in selector.select(self.INTERVAL):
+                try:
+                    closed = key.fileobj.recv(1, socket.MSG_PEEK) == b''
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    closed = True
+                with contextlib.suppress(KeyError, ValueError, OSError):
+                    selector.unregister(key.fileobj)
+                if closed:
+                    active_requests.stop(key.data, 'disconnect')
+
+disconnects = DisconnectWatcher()
+
+class CancelRelay:
+    """Passes cancel calls on to the worker process running the chat.
+
+    A worker that gets a cancel call for a request it isn't running leaves a
+    marker file named after the request, holding the user. Every worker looks
+    for markers of its own requests each INTERVAL seconds and stops them;
+    markers that no worker claims are removed after MAX_AGE seconds.
+    """
+
+    INTERVAL = 0.25  # Seconds between looking for markers
+    MAX_AGE = 30     # Seconds a marker waits for its request to show up
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cancel-relay', daemon=True)
+                self._thread.start()
+
+    def post(self, request_id, user):
+        """Leaves a cancel call for the worker running `request_id`; raises OSError."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{request_id}.cancel")
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({"user": user}, f)
+        os.replace(temp_path, path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                continue  # No cancel call left yet
+            for name in names:
+                self._claim(name)
+
+    def _claim(self, name):
+        path = os.path.join(self.directory, name)
+        request_id, ext = os.path.splitext(name)
+        try:
+            if ext != '.cancel' or not active_requests.running(request_id):
+                if time.time() - os.stat(path).st_mtime >= self.MAX_AGE:
+                    os.remove(path)
+                return
+            with open(path) as f:
+                user = json.load(f)['user']
+            os.remove(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return  # Removed meanwhile, or still being written
+        active_requests.cancel(request_id, user)
+
+cancel_relay = CancelRelay(CANCEL_DIR)
+
+# --- Upstream HTTP Client ---
+
+class UpstreamClient:
+    """A shared keep-alive HTTP client for LM Studio with a bounded connection pool.
+
+    requests.Session and urllib3's pools are safe to share across threads. Only
+    idempotent methods are retried on errors; POSTs are retried only when the
+    connection could not be established, so a generation never runs twice.
+    """
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, retries, backoff):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(502, 503, 504), allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS'}),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=retry)  # One pool per backend host
+        self.adapter.poolmanager.pool_classes_by_scheme = {  # Lets cancelled requests close their connection
+            'http': CancellableHTTPConnectionPool, 'https': CancellableHTTPSConnectionPool,
+        }
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def stats(self):
+        """Returns connection counts per upstream host for sizing the pool."""
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "in_use": max(0, pool.pool.maxsize - pool.pool.qsize()),
+                "idle": idle,
+                "created": pool.num_connections,
+                "reused": max(0, pool.num_requests - pool.num_connections),
+            }
+        return {"pool_size": self.pool_size, "hosts": hosts}
+
+upstream = UpstreamClient(UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT, UPSTREAM_RETRIES, UPSTREAM_RETRY_BACKOFF)
+
+# --- Backend Pool ---
+
+class Backend:
+    """One OpenAI-compatible server and what the proxy knows about it."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.failures = 0          # Consecutive failed requests or health checks
+        self.ejected_until = 0.0
+        self.models = None         # Model ids from its last /models response; None until known
+        self.model_list = []
+        self.requests = 0
+        self.errors = 0
+
+    def ejected(self, now):
+        return now < self.ejected_until
+
+class BackendPool:
+    """Routes chat requests across several backends.
+
+    A request goes to a backend that serves its model, the one with the fewest
+    outstanding requests. Turns of the same chat go back to the backend that
+    answered the last one, so its prompt cache stays warm, unless that backend
+    is much busier than the others. Backends that keep failing are left out for
+    a while; with more than one backend, a health check thread probes each
+    /models endpoint and brings them back.
+    """
+
+    STICKY_SLACK = 2             # Extra outstanding requests tolerated to keep a chat on its backend
+    STICKY_CHATS = 10000         # Chat -> backend assignments remembered
+
+    def __init__(self, urls, health_interval, eject_failures, eject_seconds):
+        self.backends = [Backend(url) for url in urls]
+        self.health_interval = health_interval
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.sticky = OrderedDict()  # chat id -> Backend, least recently used first
+        self.counters = {"sticky": 0, "rebalanced": 0, "ejected": 0, "failover": 0}
+        self._lock = threading.Lock()
+        self._checker = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix='backend')
+
+    def acquire(self, model, chat_id=None, exclude=()):
+        """Picks a backend for `model` and counts the request against it until release()."""
+        self.start_health_checks()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude] or self.backends
+            # Prefer healthy backends that list the model, then ones whose models aren't known yet.
+            healthy = [b for b in candidates if not b.ejected(now)] or candidates
+            serving = [b for b in healthy if b.models is not None and model in b.models]
+            serving = serving or [b for b in healthy if b.models is None] or healthy
+            backend = min(serving, key=lambda b: (b.outstanding, b.requests))
+            pinned = self.sticky.get(chat_id) if chat_id else None
+            if pinned in serving:
+                if pinned.outstanding <= backend.outstanding + self.STICKY_SLACK:
+                    backend = pinned
+                    self.counters["sticky"] += 1
+                else:
+                    self.counters["rebalanced"] += 1
+            if chat_id:
+                self.sticky[chat_id] = backend
+                self.sticky.move_to_end(chat_id)
+                while len(self.sticky) > self.STICKY_CHATS:
+                    self.sticky.popitem(last=False)
+            backend.outstanding += 1
+            backend.requests += 1
+        return backend
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def release(self, backend, failed=False):
+        with self._lock:
+            backend.outstanding -= 1
+        if failed:
+            self.failed(backend)
+        else:
+            self.succeeded(backend)
+
+    def succeeded(self, backend):
+        with self._lock:
+            backend.failures = 0
+            backend.ejected_until = 0.0
+
+    def failed(self, backend):
+        with self._lock:
+            backend.errors += 1
+            backend.failures += 1
+            if backend.failures >= self.eject_failures and len(self.backends) > 1:
+                if not backend.ejected(time.monotonic()):
+                    self.counters["ejected"] += 1
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def merge_model_lists(self, results):
+        """Records each backend's /models response and returns the merged list as JSON bytes.
+
+        `results` pairs each backend with its response or the exception raised
+        fetching it. Raises the first error if no backend answered.
+        """
+        merged = OrderedDict()
+        first_error = None
+        for backend, result in results:
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                result.raise_for_status()
+                model_list = result.json()['data']
+            except Exception as e:
+                first_error = first_error or (ValueError(f"{backend.url}: {e}") if isinstance(e, (KeyError, TypeError)) else e)
+                self.failed(backend)
+                continue
+            with self._lock:
+                backend.model_list = model_list
+                backend.models = {m.get('id') for m in model_list}
+            self.succeeded(backend)
+            for model in model_list:
+                merged.setdefault(model.get('id'), model)
+        if not merged and first_error is not None:
+            raise first_error
+        return json.dumps({"object": "list", "data": list(merged.values())}).encode()
+
+    def fetch_models(self):
+        """Asks every backend for its models at once and returns the merged list."""
+        def fetch(backend):
+            try:
+                return upstream.get(f"{backend.url}/models")
+            except requests.exceptions.RequestException as e:
+                return e
+        return self.merge_model_lists(zip(self.backends, self._executor.map(fetch, self.backends)))
+
+    def start_health_checks(self):
+        if self._checker is not None or len(self.backends) < 2:
+            return
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._check_forever, name='backend-health', daemon=True)
+                self._checker.start()
+
+    def _check_forever(self):
+        while True:
+            time.sleep(self.health_interval)
+            try:
+                self.fetch_models()
+            except Exception as e:
+                print(f"No LM Studio backend answered its health check: {e}")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            pool = {
+                b.url: {
+                    "outstanding": b.outstanding, "requests": b.requests, "errors": b.errors,
+                    "ejected": b.ejected(now), "models": None if b.models is None else len(b.models),
+                }
+                for b in self.backends
+            }
+        return {"backends": pool, **self.counters}
+
+backends = BackendPool(LM_STUDIO_BASE_URLS or [LM_STUDIO_BASE_URL], BACKEND_HEALTH_INTERVAL, BACKEND_EJECT_FAILURES, BACKEND_EJECT_SECONDS)
+
+# --- Model List Cache ---
+
+CachedBody = namedtuple('CachedBody', ['body', 'etag', 'fresh_for', 'state'])
+
+class ModelListCache:
+    """Caches LM Studio's model list with a TTL and single-flight refresh.
+
+    A list younger than `ttl` is served as-is. An expired list younger than
+    `stale_ttl` is served at once while a single background refresh runs, and is
+    also served when LM Studio can't be reached. Concurrent misses wait on one
+    shared upstream call instead of each making their own.
+    """
+
+    def __init__(self, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.body = None
+        self.etag = None
+        self.fetched_at = 0.0
+        self.counters = {"hit": 0, "stale": 0, "miss": 0, "coalesced": 0, "error": 0}
+        self._error = None
+        self._lock = threading.Lock()
+        self._refreshing = None   # threading.Event while a sync refresh runs
+        self._arefreshing = None  # asyncio.Task while an async refresh runs
+
+    def _age(self):
+        return time.monotonic() - self.fetched_at if self.body is not None else None
+
+    def _entry(self, state):
+        self.counters[state] += 1
+        return CachedBody(self.body, self.etag, max(0, self.ttl - self._age()), state)
+
+    def _lookup(self):
+        """Returns 'hit', 'stale' or 'miss' for the current entry. Caller holds the lock."""
+        age = self._age()
+        if age is not None and age < self.ttl:
+            return "hit"
+        if age is not None and age < self.stale_ttl:
+            return "stale"
+        return "miss"
+
+    def _store(self, body):
+        with self._lock:
+            self.body = body
+            self.etag = hashlib.sha1(body).hexdigest()
+            self.fetched_at = time.monotonic()
+            self._error = None
+
+    def _result(self, state):
+        """Returns the entry after a refresh, falling back to the last known list on error."""
+        with self._lock:
+            if self._error is None and self.body is not None:
+                return self._entry(state)
+            if self._lookup() != "miss":
+                return self._entry("stale")
+            raise self._error
+
+    def get(self, fetch):
+        """Returns a CachedBody, calling fetch() -> bytes at most once across threads."""
+        with self._lock:
+            state = self._lookup()
+            if state == "hit":
+                return self._entry("hit")
+            leader = self._refreshing is None
+            if leader:
+                self._refreshing = threading.Event()
+            done = self._refreshing
+            if state == "stale":
+                if leader:
+                    threading.Thread(target=self._refresh, args=(fetch, done), daemon=True).start()
+                return self._entry("stale")
+        if leader:
+            self._refresh(fetch, done)
+        else:
+            done.wait()
+        return self._result("miss" if leader else "coalesced")
+
+    def _refresh(self, fetch, done):
+        try:
+            self._store(fetch())
+        except Exception as e:
+            with self._lock:
+                self._error = e
+                self.counters["error"] += 1
+        finally:
+            with self._lock:
+                self._refreshing = None
+            done.set()
+
+    async def aget(self, fetch):
+        """The asyncio version of get(); fetch is a coroutine function returning bytes."""
+        with self._lock:
+            state = self._lookup()
+            if state == "hit":
+                return self._entry("hit")
+            leader = self._arefreshing is None
+            if leader:
+                self._arefreshing = asyncio.ensure_future(self._arefresh(fetch))
+            task = self._arefreshing
+            if state == "stale":
+                return self._entry("stale")
+        await asyncio.shield(task)
+        return self._result("miss" if leader else "coalesced")
+
+    async def _arefresh(self, fetch):
+        try:
+            self._store(await fetch())
+        except Exception as e:
+            with self._lock:
+                self._error = e
+                self.counters["error"] += 1
+        finally:
+            with self._lock:
+                self._arefreshing = None
+
+    def stats(self):
+        return {"ttl": self.ttl, "stale_ttl": self.stale_ttl, **self.counters}
+
+models_cache = ModelListCache(MODELS_CACHE_TTL, MODELS_CACHE_STALE_TTL)
+
+def cached_body_headers(entry):
+    """Caching headers that let browsers revalidate the model list with If-None-Match."""
+    return {
+        "ETag": f'"{entry.etag}"',
+        "Cache-Control": f"public, max-age={int(entry.fresh_for)}, stale-while-revalidate={MODELS_CACHE_STALE_TTL - MODELS_CACHE_TTL}",
+        "X-Cache": entry.state.upper(),
+    }
+
+def etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header value against an unquoted ETag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')]
+    return etag in tags or '*' in tags
+
+# --- Prompt Budgeting ---
+
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+MESSAGE_OVERHEAD_TOKENS = 4  # Role markers and separators added by chat templates
+SUMMARY_PROMPT = (
+    "Summarize the following conversation in a few sentences. Keep names, facts, "
+    "decisions and open questions that later messages may refer to."
+)
+
+PromptTrim = namedtuple('PromptTrim', ['dropped', 'dropped_tokens', 'summarized'])
+
+@functools.lru_cache(maxsize=16384)
+def count_tokens(text):
+    """Estimates BPE tokens: words in chunks of up to four characters plus each symbol."""
+    return len(TOKEN_PATTERN.findall(text))
+
+def message_tokens(message):
+    content = message.get('content') if isinstance(message, dict) else None
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    return MESSAGE_OVERHEAD_TOKENS + count_tokens(content)
+
+def prompt_budget(payload):
+    """Tokens the prompt may use: the model's context window minus room for the reply."""
+    window = MODEL_CONTEXT_WINDOWS.get(payload['model'], CONTEXT_WINDOW_DEFAULT)
+    max_tokens = payload.get('max_tokens', -1)
+    reserved = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else CONTEXT_RESERVED_TOKENS
+    return max(window - reserved, 0)
+
+def trim_messages(messages, budget):
+    """Keeps the system prompt and the most recent messages that fit in `budget` tokens.
+
+    Returns (kept, dropped). The newest message is always kept, even if it alone
+    is over budget, and the kept turns are always a contiguous tail.
+    """
+    system = [m for m in messages if isinstance(m, dict) and m.get('role') == 'system']
+    turns = [m for m in messages if not (isinstance(m, dict) and m.get('role') == 'system')]
+    used = sum(message_tokens(m) for m in system)
+    start = len(turns)
+    while start > 0:
+        cost = message_tokens(turns[start - 1])
+        if used + cost > budget and start < len(turns):
+            break
+        used += cost
+        start -= 1
+    return system + turns[start:], turns[:start]
+
+def trim_prompt(payload, summarize=False):
+    """Trims payload['messages'] in place to the model's token budget.
+
+    When `summarize` is set, room is left for a summary of the dropped turns;
+    the caller fetches it and passes it to insert_summary().
+    """
+    budget = prompt_budget(payload)
+    messages = payload['messages']
+    if sum(message_tokens(m) for m in messages) <= budget:
+        return PromptTrim([], 0, False)
+    if summarize:
+        budget -= SUMMARY_MAX_TOKENS + MESSAGE_OVERHEAD_TOKENS
+    kept, dropped = trim_messages(messages, budget)
+    payload['messages'] = kept
+    return PromptTrim(dropped, sum(message_tokens(m) for m in dropped), False)
+
+def summary_payload(model, dropped):
+    transcript = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in dropped)
+    budget = MODEL_CONTEXT_WINDOWS.get(model, CONTEXT_WINDOW_DEFAULT) - SUMMARY_MAX_TOKENS - count_tokens(SUMMARY_PROMPT) - 16
+    if count_tokens(transcript) > budget:
+        # Summarize the most recent part of the dropped history that fits.
+        transcript = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in trim_messages(dropped, budget)[0])
+    return {
+        "model": model, "temperature": 0, "max_tokens": SUMMARY_MAX_TOKENS, "stream": False,
+        "messages": [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+    }
+
+def summary_key(model, dropped):
+    return hashlib.sha256(json.dumps([model, dropped], sort_keys=True).encode()).hexdigest()
+
+def insert_summary(payload, trim, summary):
+    """Puts the summary of dropped turns right after the system prompt."""
+    messages = payload['messages']
+    position = sum(1 for m in messages if isinstance(m, dict) and m.get('role') == 'system')
+    messages.insert(position, {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    return trim._replace(summarized=True)
+
+def trim_headers(trim):
+    headers = {
+        "X-Prompt-Messages-Dropped": str(len(trim.dropped)),
+        "X-Prompt-Tokens-Dropped": str(trim.dropped_tokens),
+    }
+    if trim.summarized:
+        headers["X-Prompt-Summarized"] = "1"
+    return headers
+
+summary_cache = OrderedDict()  # summary_key -> summary text, most recently used last
+summary_cache_lock = threading.Lock()
+SUMMARY_CACHE_SIZE = 256
+
+def cached_summary(key):
+    with summary_cache_lock:
+        summary = summary_cache.get(key)
+        if summary is not None:
+            summary_cache.move_to_end(key)
+        return summary
+
+def store_summary(key, summary):
+    with summary_cache_lock:
+        summary_cache[key] = summary
+        summary_cache.move_to_end(key)
+        while len(summary_cache) > SUMMARY_CACHE_SIZE:
+            summary_cache.popitem(last=False)
+
+def summarize_dropped(model, dropped):
+    """Asks LM Studio to summarize dropped turns; returns None if that fails."""
+    key = summary_key(model, dropped)
+    summary = cached_summary(key)
+    if summary is None:
+        try:
+            response, backend = send_chat(summary_payload(model, dropped))
+            backends.release(backend)
+            summary = response.json()['choices'][0]['message']['content']
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            print(f"Could not summarize trimmed messages: {e}")
+            return None
+        store_summary(key, summary)
+    return summary
+
+# --- Response Cache ---
+
+CacheLookup = namedtuple('CacheLookup', ['key', 'body', 'state'])
+
+class ResponseCache:
+    """Exact-match cache of chat completions, keyed by a hash of the request.
+
+    Completions are kept in an in-memory LRU bounded by `max_bytes` and, when
+    `directory` is set, also as files bounded by `disk_max_bytes`, so they
+    survive restarts. Both tiers expire entries `ttl` seconds after they were
+    stored.
+    """
+
+    def __init__(self, max_bytes, ttl, directory=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()  # key -> (stored_at, body), most recently used last
+        self.bytes = 0
+        self.disk_bytes = None        # Measured the first time the disk tier is written
+        self.counters = {"hit": 0, "disk_hit": 0, "miss": 0, "bypass": 0, "store": 0, "evict": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached completion body, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.counters["hit"] += 1
+                return entry[1]
+            if entry is not None:
+                self._forget(key)
+                self.counters["expired"] += 1
+        entry = self._read_file(key, now)
+        with self._lock:
+            if entry is None:
+                self.counters["miss"] += 1
+                return None
+            self.counters["disk_hit"] += 1
+            self._remember(key, *entry)
+        return entry[1]
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def put(self, key, body):
+        with self._lock:
+            self.counters["store"] += 1
+            self._remember(key, time.time(), body)
+        if self.directory:
+            self._write_file(key, body)
+
+    def _remember(self, key, stored_at, body):
+        """Adds an entry to the memory tier, evicting the least recently used. Caller holds the lock."""
+        if key in self.entries:
+            self._forget(key)
+        if len(body) > self.max_bytes:
+            return
+        self.entries[key] = (stored_at, body)
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.counters["evict"] += 1
+
+    def _forget(self, key):
+        self.bytes -= len(self.entries.pop(key)[1])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_file(self, key, now):
+        """Returns (stored_at, body) from the disk tier, using the file's mtime as its age."""
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            stored_at = os.stat(path).st_mtime
+            if now - stored_at >= self.ttl:
+                os.remove(path)
+                self.count("expired")
+                return None
+            with open(path, 'rb') as f:
+                return stored_at, f.read()
+        except OSError:
+            return None
+
+    def _write_file(self, key, body):
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, path)  # Readers never see a half-written file
+        except OSError as e:
+            print(f"Could not write to the response cache directory: {e}")
+            return
+        with self._lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _, size, _ in self._files())
+            else:
+                self.disk_bytes += len(body)
+            if self.disk_bytes > self.disk_max_bytes:
+                self._prune_files()
+
+    def _files(self):
+        """Yields (mtime, size, path) for every file in the disk tier."""
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _prune_files(self):
+        """Deletes the oldest files until the disk tier is back under 90% of its limit. Caller holds the lock."""
+        files = sorted(self._files())
+        self.disk_bytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.counters["evict"] += 1
+
+    def stats(self):
+        return {
+            "enabled": RESPONSE_CACHE, "ttl": self.ttl, "entries": len(self.entries),
+            "bytes": self.bytes, "max_bytes": self.max_bytes,
+            "disk_bytes": self.disk_bytes, "disk_max_bytes": self.disk_max_bytes if self.directory else None,
+            **self.counters,
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES)
+
+def response_cache_key(payload):
+    """Hashes everything that shapes a completion; `stream` only changes how it is delivered."""
+    canonical = {k: v for k, v in payload.items() if k != 'stream'}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def lookup_response(data, payload):
+    """Returns a CacheLookup; its key is None when the request doesn't use the cache."""
+    if not data.get("cache", RESPONSE_CACHE):
+        return CacheLookup(None, None, None)
+    if payload['temperature'] != 0 and not RESPONSE_CACHE_ANY_TEMPERATURE:
+        response_cache.count("bypass")
+        return CacheLookup(None, None, "BYPASS")
+    key = response_cache_key(payload)
+    body = response_cache.get(key)
+    return CacheLookup(key, body, "MISS" if body is None else "HIT")
+
+def cache_headers(lookup):
+    return {"X-Cache": lookup.state} if lookup.state else {}
+
+class CompletionCollector:
+    """Rebuilds a non-streamed completion from the SSE chunks of a streamed one.
+
+    It is cached under `key` and its reply is added to the session `turn`, if given.
+    """
+
+    def __init__(self, key, model, turn=None):
+        self.key = key
+        self.model = model
+        self.turn = turn
+        self.pending = b''
+        self.parts = []
+        self.finish_reason = None
+        self.done = False
+        self.failed = False
+
+    def feed(self, chunk):
+        self.pending += chunk
+        *lines, self.pending = self.pending.split(b'\n')
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b'data:'):
+                continue
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                self.done = True
+                continue
+            try:
+                event = json.loads(data)
+            except ValueError:
+                self.failed = True  # Something we can't replay faithfully
+                continue
+            if not isinstance(event, dict) or 'error' in event:
+                self.failed = True
+                continue
+            choices = event.get('choices')
+            if not choices:  # The usage chunk some servers send last has an empty (or no) "choices"
+                continue
+            try:
+                choice = choices[0]
+                self.parts.append((choice.get('delta') or {}).get('content') or '')
+            except (TypeError, AttributeError, KeyError):
+                self.failed = True
+                continue
+            self.finish_reason = choice.get('finish_reason') or self.finish_reason
+
+    def store(self):
+        """Caches the completion if the stream finished cleanly."""
+        if not self.done or self.failed:
+            return
+        content = ''.join(self.parts)
+        if self.turn is not None:
+            self.turn.commit(content)
+        if self.key is None:
+            return
+        response_cache.put(self.key, json.dumps({
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": self.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": self.finish_reason}],
+        }).encode())
+
+# --- Chat Sessions ---
+
+class SessionConflict(Exception):
+    """Raised when a turn builds on a different version of the chat than the server has."""
+
+    def __init__(self, version):
+        super().__init__("The chat changed since this version; send the whole chat again.")
+        self.version = version  # The server's version, or None if it doesn't know the chat
+
+Session = namedtuple('Session', ['stored_at', 'version', 'messages', 'size'])
+
+class SessionTurn:
+    """One request's turn in a session: the full prompt, and the reply to add once it is complete."""
+
+    def __init__(self, store, key, version, messages):
+        self.store = store
+        self.key = key
+        self.version = version
+        self.messages = messages
+        self.closed = False
+
+    def commit(self, reply):
+        if not self.closed:
+            self.closed = True
+            self.store.commit(self, reply)
+
+    def close(self):
+        """Forgets the session unless the reply was committed; the browser then sends the whole chat again."""
+        if not self.closed:
+            self.closed = True
+            self.store.abort(self)
+
+class SessionStore:
+    """Chats kept on the server, so the browser only sends the new messages of each turn.
+
+    Every turn names the version it builds on and the number of messages before
+    it; the version goes up once the reply is complete. A turn that doesn't
+    match (another tab got there first, or the server forgot the chat) raises
+    SessionConflict. Sessions live in an LRU bounded by `max_bytes` and, when
+    `directory` is set, also as files that restarts and other workers can read.
+    """
+
+    SWEEP_EVERY = 256  # Disk writes between removing expired session files
+
+    def __init__(self, max_bytes, ttl, directory=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> Session, most recently used last
+        self.pending = {}             # key -> the SessionTurn being generated
+        self.bytes = 0
+        self.writes = 0
+        self.counters = {"delta": 0, "full": 0, "conflict": 0, "commit": 0, "abort": 0, "evict": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def begin(self, user, chat_id, version, length, messages):
+        """Starts a turn. Version 0 replaces the session with `messages`; any other adds them to it.
+
+        A turn with version 0 also supersedes one still being generated, whose reply is then dropped.
+        """
+        key = hashlib.sha256(f"{user}\0{chat_id}".encode()).hexdigest()
+        with self._lock:
+            session = self._get(key, version)
+            if version and (key in self.pending or session is None or session.version != version or len(session.messages) != length):
+                self.counters["conflict"] += 1
+                raise SessionConflict(session.version if session else None)
+            self.counters["delta" if version else "full"] += 1
+            turn = SessionTurn(self, key, (session.version if session else 0) + 1, (session.messages if version else []) + messages)
+            self.pending[key] = turn
+        return turn
+
+    def commit(self, turn, reply):
+        messages = turn.messages + [{"role": "assistant", "content": reply}]
+        session = Session(time.time(), turn.version, messages, sum(len(str(m.get('content'))) + 32 for m in messages))
+        with self._lock:
+            if self.pending.get(turn.key) is not turn:
+                return  # Superseded
+            del self.pending[turn.key]
+            self.counters["commit"] += 1
+            self._remember(turn.key, session)
+        if self.directory:
+            self._write_file(turn.key, session)
+
+    def abort(self, turn):
+        with self._lock:
+            if self.pending.get(turn.key) is not turn:
+                return
+            del self.pending[turn.key]
+            self.counters["abort"] += 1
+            if turn.key in self.entries:
+                self._forget(turn.key)
+        if self.directory:
+            with contextlib.suppress(OSError):
+                os.remove(self._path(turn.key))
+
+    def _get(self, key, version):
+        """The live session from memory, or from disk when memory doesn't have `version`. Caller holds the lock."""
+        now = time.time()
+        session = self.entries.get(key)
+        if session is not None and now - session.stored_at >= self.ttl:
+            self._forget(key)
+            self.counters["expired"] += 1
+            session = None
+        if session is not None and session.version == version:
+            self.entries.move_to_end(key)
+            return session
+        stored = self._read_file(key, now)  # Another worker may have moved the chat on
+        if stored is not None and (session is None or stored.version > session.version):
+            self._remember(key, stored)
+            return stored
+        return session
+
+    def _remember(self, key, session):
+        if key in self.entries:
+            self._forget(key)
+        if session.size > self.max_bytes:
+            return
+        self.entries[key] = session
+        self.bytes += session.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.counters["evict"] += 1
+
+    def _forget(self, key):
+        self.bytes -= self.entries.pop(key).size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_file(self, key, now):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            stored_at = os.stat(path).st_mtime
+            if now - stored_at >= self.ttl:
+                os.remove(path)
+                self.counters["expired"] += 1
+                return None
+            with open(path, 'rb') as f:
+                body = f.read()
+            data = json.loads(body)
+            return Session(stored_at, data['version'], data['messages'], len(body))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_file(self, key, session):
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump({"version": session.version, "messages": session.messages}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not write to the session directory: {e}")
+            return
+        with self._lock:
+            self.writes += 1
+            sweep = self.writes % self.SWEEP_EVERY == 0
+        if sweep:
+            self._sweep_files()
+
+    def _sweep_files(self):
+        cutoff = time.time() - self.ttl
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                with contextlib.suppress(OSError):
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        with self._lock:
+                            self.counters["expired"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": CHAT_SESSIONS, "sessions": len(self.entries), "generating": len(self.pending),
+                "bytes": self.bytes, "max_bytes": self.max_bytes, **self.counters,
+            }
+
+sessions = SessionStore(SESSION_MAX_BYTES, SESSION_TTL, SESSION_DIR)
+
+def session_turn(data, payload, user):
+    """Returns (SessionTurn or None, error message) for a /api/chat body; raises SessionConflict.
+
+    With a session, payload['messages'] is replaced by the whole conversation.
+    """
+    session = data.get("session")
+    if session is None:
+        return None, None
+    if not CHAT_SESSIONS:
+        return None, "Chat sessions are turned off on this server"
+    chat_id = chat_affinity(data)
+    version = session.get("version") if isinstance(session, dict) else None
+    length = session.get("messages", 0) if isinstance(session, dict) else None
+    if chat_id is None or not isinstance(version, int) or not isinstance(length, int) or version < 0 or not isinstance(payload['messages'], list):
+        return None, "A session needs a 'chat_id' and a 'session' with an integer 'version' and 'messages' count"
+    turn = sessions.begin(user, chat_id, version, length, payload['messages'])
+    payload['messages'] = list(turn.messages)
+    return turn, None
+
+def session_conflict_body(e):
+    return {"error": "The chat session is out of date.", "details": str(e), "sessionVersion": e.version}
+
+def session_headers(turn):
+    return {"X-Session-Version": str(turn.version)} if turn else {}
+
+# --- Request Coalescing ---
+
+class Flight:
+    """A chat response in progress that identical requests can follow.
+
+    The leader records its status, headers and body chunks as it sends them;
+    followers replay what was recorded so far and then wait for more, so a
+    streamed reply reaches every follower as it is generated.
+    """
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.status = None
+        self.headers = None
+        self.streamed = False
+        self.chunks = []
+        self.started = False
+        self.done = False
+        self.error = None          # Exception the leader failed with before it started responding
+        self._cond = threading.Condition()
+        self._waiters = []         # (loop, future) of async followers waiting for a change
+
+    def start(self, status, headers, streamed):
+        with self._cond:
+            self.status, self.headers, self.streamed = status, headers, streamed
+            self.started = True
+            self._changed()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._changed()
+
+    def finish(self, error=None, tail=None):
+        """Ends the flight. `tail` is appended if the leader stopped mid-response; no-op when already done."""
+        with self._cond:
+            if self.done:
+                return
+            if tail and self.started:
+                self.chunks.append(tail)
+            self.error = None if self.started else error or RuntimeError("The original request was cancelled.")
+            self.done = True
+            self._changed()
+        self.registry.land(self)
+
+    def _changed(self):
+        """Wakes up followers. Caller holds the condition."""
+        self._cond.notify_all()
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+        self._waiters = []
+
+    def record(self, chunks, tail=None):
+        """Passes the leader's body through, keeping each chunk for the followers."""
+        complete = False
+        try:
+            for chunk in chunks:
+                self.append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.finish(tail=None if complete else tail)
+
+    def wait_started(self):
+        """Blocks until the leader starts responding; raises the leader's error if it failed first."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.started or self.done)
+            if not self.started:
+                raise self.error
+
+    def follow(self):
+        """Yields the recorded chunks, then new ones as the leader sends them."""
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done:
+                return
+
+    def _state(self):
+        return self.started, len(self.chunks), self.done
+
+    async def _changed_since(self, state):
+        """Waits until the flight is no longer in `state`."""
+        with self._cond:
+            if self._state() != state:
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        await future
+
+    async def await_started(self):
+        """The asyncio version of wait_started()."""
+        while True:
+            with self._cond:
+                state = self._state()
+            if self.started or self.done:
+                break
+            await self._changed_since(state)
+        if not self.started:
+            raise self.error
+
+    async def afollow(self):
+        """The asyncio version of follow(), as an async generator."""
+        index = 0
+        while True:
+            with self._cond:
+                state = self._state()
+                chunks = self.chunks[index:]
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if state[2]:
+                return
+            await self._changed_since(state)
+
+class InflightRequests:
+    """Chat requests currently being generated, keyed so duplicates can find them."""
+
+    def __init__(self):
+        self.flights = {}
+        self.counters = {"leaders": 0, "generations_saved": 0}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Returns (flight, is_leader): a new flight to lead, or the one already running for `key`."""
+        with self._lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.counters["generations_saved"] += 1
+                return flight, False
+            flight = self.flights[key] = Flight(self, key)
+            self.counters["leaders"] += 1
+            return flight, True
+
+    def land(self, flight):
+        with self._lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def stats(self):
+        return {"enabled": COALESCE_REQUESTS, "in_flight": len(self.flights), **self.counters}
+
+inflight = InflightRequests()
+
+def flight_key(payload, user, idempotency_key=None):
+    """What makes two chat requests the same generation.
+
+    A client-supplied Idempotency-Key matches retries from the same user. Otherwise
+    requests match on their payload; sampled (temperature > 0) replies are only
+    shared within one user, since other users expect their own sample.
+    """
+    if idempotency_key:
+        return f"key:{user}:{payload['stream']}:{idempotency_key}"
+    scope = user if payload['temperature'] != 0 else ''
+    return f"hash:{scope}:{payload['stream']}:{response_cache_key(payload)}"
+
+def interrupted_event():
+    return sse_event({"error": "The original request was cancelled before the reply finished."}, event="error")
+
+# --- Admission Control ---
+
+class QueueFull(Exception):
+    """Raised when a model's queue is full; `retry_after` is a suggested wait in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__("Too many requests are waiting for this model.")
+        self.retry_after = retry_after
+
+class QueueTimeout(Exception):
+    """Raised when a queued request waited longer than the admission timeout."""
+
+class AdmissionTicket:
+    """One request's place in a model's queue, and then its slot.
+
+    Whoever gets a ticket must call release() when the request is done with LM
+    Studio, whether it was admitted or gave up while waiting.
+    """
+
+    POSITION_INTERVAL = 0.5  # Seconds between queue position checks while waiting
+
+    def __init__(self, controller, gate, user, background=False):
+        self.controller = controller
+        self.gate = gate
+        self.user = user
+        self.background = background  # A batch request, admitted only when no chat is waiting
+        self.admitted = False
+        self.released = False
+        self.cancelled = False
+        self.admitted_at = None
+        self._event = threading.Event()
+        self._loop = None
+        self._future = None
+
+    def _admit(self):
+        """Hands the ticket a slot. Caller holds the controller's lock."""
+        self.admitted = True
+        self.admitted_at = time.monotonic()
+        self._event.set()
+        if self._future is not None:
+            future = self._future
+            self._loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def position(self):
+        return self.controller.position(self)
+
+    def wait(self, timeout):
+        """Blocks until admitted, yielding the queue position whenever it changes.
+
+        Raises QueueTimeout after `timeout` seconds, and RequestCancelled if the
+        request is cancelled while it waits.
+        """
+        deadline = time.monotonic() + timeout
+        last = None
+        while not self._event.is_set():
+            raise_if_cancelled()
+            position = self.position()
+            if position != last and position is not None:
+                yield position
+                last = position
+            if time.monotonic() > deadline:
+                raise QueueTimeout("Timed out waiting for a free LM Studio slot.")
+            self._event.wait(self.POSITION_INTERVAL)
+
+    async def await_admission(self, timeout):
+        """The asyncio version of wait(), as an async generator."""
+        with self.controller.lock:
+            if self.admitted:
+                return
+            self._loop = asyncio.get_running_loop()
+            self._future = self._loop.create_future()
+        deadline = time.monotonic() + timeout
+        last = None
+        while not self._future.done():
+            position = self.position()
+            if position != last and position is not None:
+                yield position
+                last = position
+            if time.monotonic() > deadline:
+                raise QueueTimeout("Timed out waiting for a free LM Studio slot.")
+            try:
+                await asyncio.wait_for(asyncio.shield(self._future), self.POSITION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        self.controller.release(self)
+
+class ModelGate:
+    """Slots and waiting requests of one model."""
+
+    def __init__(self, limit, background_limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.queues = OrderedDict()  # user -> deque of tickets; the front user is served next
+        self.service_time = None     # Moving average of seconds a request holds a slot
+        self.background_limit = background_limit  # Slots batch requests may hold at once
+        self.background_active = 0
+        self.background_waiting = 0
+        self.background = OrderedDict()  # Batch job -> deque of tickets, served after every chat
+
+    def has_room(self, background=False):
+        if self.limit is None:
+            return True
+        if background:
+            if not self.background_limit:  # Every slot is reserved for chats: batch runs only while the model is idle
+                return self.active == 0
+            return self.active < self.limit and self.background_active < self.background_limit
+        return self.active < self.limit
+
+class AdmissionController:
+    """Limits the chat requests each model runs at once and queues the rest fairly.
+
+    Waiting requests are grouped by user and admitted round-robin across users,
+    so one user sending many messages can't starve the others. A full queue
+    rejects new requests at once instead of letting every request slow down.
+
+    Batch requests queue separately, round-robin across jobs. They are let in
+    only while no chat is waiting and never take the last `reserved` slots of
+    a model, so the web UI doesn't wait behind offline work. A model with no
+    more slots than that runs one batch request at a time, and only while it
+    runs no chat.
+    """
+
+    def __init__(self, limit, limits, queue_size, timeout, reserved=0):
+        self.limit = limit
+        self.limits = limits
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.reserved = reserved
+        self.gates = {}
+        self.counters = {"admitted": 0, "queued": 0, "rejected": 0, "cancelled": 0}
+        self.lock = threading.Lock()
+
+    def _gate(self, model):
+        gate = self.gates.get(model)
+        if gate is None:
+            limit = self.limits.get(model, self.limit)
+            gate = self.gates[model] = ModelGate(limit, None if limit is None else max(0, limit - self.reserved))
+        return gate
+
+    def enter(self, model, user, background=False):
+        """Returns a ticket that is admitted at once or queued; raises QueueFull.
+
+        Background (batch) tickets are queued under `user`, the job, and don't
+        count against the queue size.
+        """
+        with self.lock:
+            gate = self._gate(model)
+            ticket = AdmissionTicket(self, gate, user, background)
+            if gate.has_room(background) and not gate.waiting and not (background and gate.background_waiting):
+                self._start(gate, ticket)
+                return ticket
+            if background:
+                gate.background.setdefault(user, deque()).append(ticket)
+                gate.background_waiting += 1
+                self.counters["queued"] += 1
+                return ticket
+            if gate.waiting >= self.queue_size:
+                self.counters["rejected"] += 1
+                raise QueueFull(self._retry_after(gate))
+            gate.queues.setdefault(user, deque()).append(ticket)
+            gate.waiting += 1
+            self.counters["queued"] += 1
+            return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            gate = ticket.gate
+            if not ticket.admitted:
+                queues = gate.background if ticket.background else gate.queues
+                queue = queues[ticket.user]
+                queue.remove(ticket)
+                if not queue:
+                    del queues[ticket.user]
+                if ticket.background:
+                    gate.background_waiting -= 1
+                else:
+                    gate.waiting -= 1
+                self.counters["cancelled"] += 1
+                return
+            gate.active -= 1
+            if ticket.background:
+                gate.background_active -= 1
+            if not ticket.cancelled:  # A stopped reply says little about how long replies take
+                held = time.monotonic() - ticket.admitted_at
+                gate.service_time = held if gate.service_time is None else 0.8 * gate.service_time + 0.2 * held
+            while gate.queues and gate.has_room():
+                gate.waiting -= 1
+                self._start(gate, self._next_waiter(gate.queues))
+            while gate.background and not gate.queues and gate.has_room(background=True):
+                gate.background_waiting -= 1
+                self._start(gate, self._next_waiter(gate.background))
+
+    def _start(self, gate, ticket):
+        """Gives a ticket one of the gate's slots. Caller holds the lock."""
+        gate.active += 1
+        if ticket.background:
+            gate.background_active += 1
+        ticket._admit()
+        self.counters["admitted"] += 1
+
+    @staticmethod
+    def _next_waiter(queues):
+        """Takes the next ticket round-robin from queues grouped by user (or job)."""
+        user, queue = next(iter(queues.items()))
+        waiter = queue.popleft()
+        if queue:
+            queues.move_to_end(user)
+        else:
+            del queues[user]
+        return waiter
+
+    def position(self, ticket):
+        """1-based position of a waiting ticket, counting the round-robin turns ahead of it.
+
+        Every waiting chat is ahead of a batch request.
+        """
+        with self.lock:
+            if ticket.admitted or ticket.released:
+                return None
+            gate = ticket.gate
+            queues = gate.background if ticket.background else gate.queues
+            index = queues[ticket.user].index(ticket)
+            ahead = gate.waiting if ticket.background else 0
+            before_user = True
+            for user, queue in queues.items():
+                if user == ticket.user:
+                    before_user = False
+                ahead += min(len(queue), index) + (1 if before_user and len(queue) > index else 0)
+            return ahead + 1
+
+    def remaining_service_time(self, model, ticket=None):
+        """Estimated seconds LM Studio would still have spent on a request, from the model's average.
+
+        A request that hasn't been admitted yet would have needed the whole average.
+        """
+        with self.lock:
+            gate = ticket.gate if ticket is not None else self.gates.get(model)
+            if gate is None or gate.service_time is None:
+                return 0.0
+            if ticket is None or not ticket.admitted:
+                return gate.service_time
+            return max(0.0, gate.service_time - (time.monotonic() - ticket.admitted_at))
+
+    def _retry_after(self, gate):
+        """Seconds until the queue has likely drained a place, from the average time a request holds a slot."""
+        if gate.service_time is None:
+            return 5
+        return max(1, int(gate.service_time * (gate.waiting + 1) / gate.limit + 0.5))
+
+    def stats(self):
+        with self.lock:
+            models = {
+                model: {"limit": gate.limit, "active": gate.active, "waiting": gate.waiting,
+                        "batch_active": gate.background_active, "batch_waiting": gate.background_waiting}
+                for model, gate in self.gates.items()
+            }
+        return {"queue_size": self.queue_size, "models": models, **self.counters}
+
+def admission_workers():
+    """Worker processes that each admit requests on their own, or None if that isn't known.
+
+    WORKERS is set by --production and by gunicorn.conf.py from gunicorn's own
+    config; otherwise WEB_CONCURRENCY is used, which gunicorn and uvicorn take
+    as their default worker count.
+    """
+    if WORKERS:
+        return WORKERS
+    try:
+        return int(os.environ['WEB_CONCURRENCY'])
+    except (KeyError, ValueError):
+        return None
+
+def worker_share(limit):
+    """A model's concurrency limit divided between the worker processes, which each admit separately.
+
+    Rounded down, so the workers together stay within the limit; but every worker
+    admits at least one chat, which warn_small_limits() reports when it exceeds it.
+    """
+    workers = admission_workers()
+    if limit is None or not workers or workers <= 1:
+        return limit
+    return max(1, limit // workers)
+
+admission = AdmissionController(
+    worker_share(MODEL_CONCURRENCY), {model: worker_share(limit) for model, limit in MODEL_CONCURRENCY_LIMITS.items()},
+    ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT, BATCH_RESERVED_SLOTS,
+)
+
+def queue_full_response(e):
+    """Body and headers of the 429 sent when a model's queue is full."""
+    return {"error": "LM Studio is busy.", "details": str(e)}, {"Retry-After": str(e.retry_after)}
+
+# --- Batch Jobs ---
+
+BATCH_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class BatchError(Exception):
+    """Raised for a batch upload or action that can't be done; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def jsonl_lines(stream, max_bytes, chunk_size=64 * 1024):
+    """Yields the lines of a JSONL upload as it arrives; raises BatchError once it's over max_bytes."""
+    buffer = b''
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise BatchError(f"The upload is larger than {max_bytes} bytes.", 413)
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        yield from lines
+    if buffer:
+        yield buffer
+
+class BatchJob:
+    """One uploaded JSONL file of chat requests, run in the background, with its results.
+
+    A job lives in its own directory, so every worker process can report on it:
+    input.jsonl holds the requests, results.jsonl gets one line per request as
+    it completes, and job.json the status and counts. The results are also the
+    checkpoint: a resumed job skips the requests already in them.
+    """
+
+    CHECKPOINT_INTERVAL = 1.0  # Seconds between writes of job.json while the job runs
+    STALE_AFTER = 15           # A running job whose job.json is older than this was interrupted
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.cancel_reason = None
+        self.thread = None
+        self.running = set()  # Cancellations of the requests in flight
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    @property
+    def id(self):
+        return self.meta["id"]
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def save(self):
+        """Writes job.json atomically; it doubles as the running job's heartbeat."""
+        with self.lock:
+            self.meta["updatedAt"] = time.time()
+            data = json.dumps(self.meta)
+        temp_path = f"{self.file('job.json')}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, self.file('job.json'))
+
+    def reload(self):
+        """Re-reads job.json, for a job that another worker process runs."""
+        if self.is_local():
+            return
+        try:
+            with open(self.file('job.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.meta = meta
+
+    def is_local(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def status(self):
+        """The job's status; a 'running' job nobody has checkpointed for a while is 'interrupted'."""
+        status = self.meta["status"]
+        if status == 'running' and not self.is_local() and time.time() - self.meta["updatedAt"] > self.STALE_AFTER:
+            return 'interrupted'
+        return status
+
+    def progress(self):
+        with self.lock:
+            meta = dict(self.meta)
+        status = self.status()
+        completed = meta["succeeded"] + meta["failed"]
+        progress = {**meta, "status": status, "completed": completed, "remaining": meta["total"] - completed,
+                    "requestsPerSecond": None, "etaSeconds": None}
+        if meta["startedAt"] is not None:
+            elapsed = (meta["finishedAt"] or time.time()) - meta["startedAt"]
+            done = completed - meta["startedWith"]
+            if elapsed > 0 and done > 0:
+                progress["requestsPerSecond"] = round(done / elapsed, 3)
+                if status == 'running':
+                    progress["etaSeconds"] = round(progress["remaining"] * elapsed / done, 1)
+        return progress
+
+    def start(self, concurrency):
+        with self.lock:
+            self.cancel_reason = None
+            self.meta.update(status='running', startedAt=time.time(), finishedAt=None,
+                             startedWith=self.meta["succeeded"] + self.meta["failed"])
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.file('cancel'))
+        self.save()
+        self.thread = threading.Thread(target=self._run, args=(concurrency,), name=f'batch-{self.id}', daemon=True)
+        self.thread.start()
+
+    def cancel(self, reason='client'):
+        """Stops the job; requests in flight are stopped too and run again if the job is resumed."""
+        with self.lock:
+            if self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+            running = list(self.running)
+        for cancellation in running:
+            cancellation.cancel('batch')
+
+    def _done_indexes(self):
+        """Indexes of the requests already in results.jsonl, dropping a last line cut off by a crash."""
+        done = set()
+        path = self.file('results.jsonl')
+        if not os.path.exists(path):
+            return done
+        with open(path, 'rb+') as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                done.add(json.loads(line)["index"])
+                end += len(line)
+            f.truncate(end)
+        return done
+
+    def _run(self, concurrency):
+        try:
+            done = self._done_indexes()
+            with open(self.file('input.jsonl'), 'rb') as f:
+                pending = ((index, line) for index, line in enumerate(f) if index not in done)
+                pending_lock = threading.Lock()
+                with open(self.file('results.jsonl'), 'ab') as results:
+                    workers = [
+                        threading.Thread(target=self._work, args=(pending, pending_lock, results), daemon=True)
+                        for _ in range(concurrency)
+                    ]
+                    for worker in workers:
+                        worker.start()
+                    alive = workers
+                    while alive:
+                        alive[0].join(self.CHECKPOINT_INTERVAL)
+                        if os.path.exists(self.file('cancel')):  # Cancelled through another worker process
+                            self.cancel()
+                        self.save()
+                        alive = [worker for worker in workers if worker.is_alive()]
+            status = 'cancelled' if self.cancel_reason else 'completed'
+        except Exception:
+            logging.exception("Batch job %s failed", self.id)
+            status = 'failed'
+        with self.changed:
+            self.meta.update(status=status, finishedAt=time.time())
+            self.changed.notify_all()
+        self.save()
+
+    def _work(self, pending, pending_lock, results):
+        while self.cancel_reason is None:
+            with pending_lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            index, line = item
+            result = self._complete(index, json.loads(line))
+            if result is None:
+                return  # Cancelled; the request runs again if the job is resumed
+            line = (json.dumps(result, separators=(',', ':')) + '\n').encode()
+            with self.changed:
+                results.write(line)
+                results.flush()
+                self.meta["succeeded" if result["status"] == 200 else "failed"] += 1
+                self.changed.notify_all()
+            batch_jobs.count("succeeded" if result["status"] == 200 else "failed")
+
+    def _complete(self, index, data):
+        """Runs one request of the job; returns its result line, or None if the job was cancelled."""
+        result = {"custom_id": data.get("custom_id"), "index": index}
+        payload, error = build_chat_payload(data)
+        if error:
+            return {**result, "status": 400, "error": {"error": error}}
+        payload['stream'] = False
+        trim_prompt(payload)
+        cached = lookup_response(data, payload)
+        body = cached.body
+        if body is None:
+            cancellation = Cancellation(f"batch-{self.id}-{index}", self.meta["user"], payload['model'])
+            current_cancellation.set(cancellation)
+            with self.lock:
+                self.running.add(cancellation)
+            if self.cancel_reason is not None:
+                cancellation.cancel('batch')
+            try:
+                ticket = admission.enter(payload['model'], self.id, background=True)
+                cancellation.ticket = ticket
+                try:
+                    for _ in ticket.wait(float('inf')):
+                        pass
+                    response, backend = send_chat(payload)
+                    backends.release(backend)
+                    request_done()
+                finally:
+                    ticket.release()
+            except RequestCancelled:
+                return None
+            except requests.exceptions.HTTPError as e:
+                return {**result, "status": e.response.status_code, "error": {"error": "LM Studio returned an error.", "details": str(e)}}
+            except Exception as e:
+                return {**result, "status": 502, "error": {"error": "Could not get a response from LM Studio.", "details": str(e)}}
+            finally:
+                with self.lock:
+                    self.running.discard(cancellation)
+                current_cancellation.set(None)
+            body = response.content
+            keep_completion(body, cached.key)
+        try:
+            return {**result, "status": 200, "response": json.loads(body)}
+        except ValueError:
+            return {**result, "status": 502, "error": {"error": "LM Studio sent a response that isn't JSON."}}
+
+    def results(self, after=0, follow=False):
+        """Yields the result lines written so far, skipping the first `after`.
+
+        With `follow`, keeps waiting for more until the job stops running.
+        """
+        skipped = 0
+        buffer = b''
+        with open(self.file('results.jsonl'), 'rb') as f:
+            while True:
+                self.reload()
+                running = follow and self.status() == 'running'
+                chunk = f.read(64 * 1024)
+                if chunk:
+                    lines = (buffer + chunk).split(b'\n')
+                    buffer = lines.pop()
+                    for line in lines:
+                        if skipped < after:
+                            skipped += 1
+                        else:
+                            yield line + b'\n'
+                    continue
+                if not running:
+                    return
+                with self.changed:
+                    self.changed.wait(0.5)
+
+class BatchJobs:
+    """The batch jobs on disk, and the ones this process runs."""
+
+    def __init__(self, directory, concurrency, max_bytes):
+        self.directory = directory
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.jobs = {}  # Job id -> BatchJob started by this process
+        self.counters = {"submitted": 0, "succeeded": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def create(self, user, stream, concurrency=None):
+        """Saves a JSONL upload of chat requests as a new job and starts it; raises BatchError."""
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, job_id)
+        os.makedirs(path)
+        total = 0
+        try:
+            with open(os.path.join(path, 'input.jsonl'), 'wb') as f:
+                for number, line in enumerate(jsonl_lines(stream, self.max_bytes), 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        raise BatchError(f"Line {number} is not valid JSON.")
+                    _, error = build_chat_payload(data)
+                    if error:
+                        raise BatchError(f"Line {number}: {error}")
+                    f.write(json.dumps(data, separators=(',', ':')).encode() + b'\n')
+                    total += 1
+            if total == 0:
+                raise BatchError("The upload has no requests.")
+            open(os.path.join(path, 'results.jsonl'), 'wb').close()
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        job = BatchJob(path, {
+            "id": job_id, "user": user, "status": 'queued', "total": total, "succeeded": 0, "failed": 0,
+            "concurrency": min(concurrency or self.concurrency, self.concurrency),
+            "createdAt": time.time(), "startedAt": None, "startedWith": 0, "finishedAt": None, "updatedAt": None,
+        })
+        self.count("submitted")
+        self.start(job)
+        return job
+
+    def start(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+        job.start(job.meta["concurrency"])
+
+    def get(self, user, job_id):
+        """The job with this id if it belongs to `user`, else None."""
+        if not BATCH_ID_PATTERN.match(job_id):
+            return None
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            path = os.path.join(self.directory, job_id)
+            try:
+                with open(os.path.join(path, 'job.json')) as f:
+                    job = BatchJob(path, json.load(f))
+            except (OSError, ValueError):
+                return None
+        return job if job.meta["user"] == user else None
+
+    def list(self, user):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        jobs = [job for job in (self.get(user, name) for name in names) if job is not None]
+        return sorted((job.progress() for job in jobs), key=lambda p: p["createdAt"], reverse=True)
+
+    def cancel(self, job):
+        """Cancels a running job, here or (through a marker file) in the worker process that runs it."""
+        status = job.status()
+        if status not in ('running', 'interrupted'):
+            raise BatchError(f"The batch is {status}.", 409)
+        if job.is_local():
+            job.cancel()
+        elif status == 'running':
+            open(job.file('cancel'), 'w').close()
+        else:
+            job.meta.update(status='cancelled', finishedAt=time.time())
+            job.save()
+
+    def resume(self, job):
+        """Starts a cancelled or interrupted job again, from where it stopped."""
+        status = job.status()
+        if status not in ('cancelled', 'interrupted'):
+            raise BatchError(f"The batch is {status}.", 409)
+        self.start(job)
+
+    def delete(self, job):
+        if job.status() == 'running':
+            raise BatchError("The batch is running; cancel it first.", 409)
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        shutil.rmtree(job.path, ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            running = sum(1 for job in self.jobs.values() if job.is_local())
+        return {"running": running, **self.counters}
+
+batch_jobs = BatchJobs(BATCH_DIR, BATCH_CONCURRENCY, BATCH_MAX_BYTES)
+
+# --- Local Chat Store ---
+
+class ChatStore:
+    """Chat history in SQLite (WAL mode), one row per message.
+
+    Saving a turn appends rows rather than rewriting the whole conversation, so
+    the cost of a write doesn't grow with the length of the chat. Each thread
+    gets its own connection; WAL lets readers proceed while a write commits.
+    Titles and messages are indexed for full-text search (FTS5) by triggers, so
+    the index is updated in the same transaction as every write.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            pinned INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        DROP INDEX IF EXISTS chats_by_user;
+        CREATE INDEX IF NOT EXISTS chats_page ON chats (user_id, pinned DESC, created_at DESC, id DESC);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            partial INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_chat ON messages (chat_id, id);
+    """
+
+    SEARCH_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END;
+        CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+            title, content='chats', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS chats_fts_insert AFTER INSERT ON chats BEGIN
+            INSERT INTO chats_fts (rowid, title) VALUES (new.rowid, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS chats_fts_delete AFTER DELETE ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS chats_fts_update AFTER UPDATE OF title ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+            INSERT INTO chats_fts (rowid, title) VALUES (new.rowid, new.title);
+        END;
+    """
+    HIGHLIGHT = ('\x02', '\x03')  # Around matched terms in snippets; never part of chat text
+    SEARCH_CANDIDATES = 2000        # Newest matching messages ranked per search, so common words stay fast
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    columns = {row["name"] for row in conn.execute("PRAGMA table_info(messages)")}
+                    if "partial" not in columns:  # Databases created before replies were saved while streaming
+                        conn.execute("ALTER TABLE messages ADD COLUMN partial INTEGER NOT NULL DEFAULT 0")
+                    indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+                    conn.executescript(self.SEARCH_SCHEMA)
+                    with conn:
+                        if not indexed:  # Index the messages saved before search existed
+                            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+                        # Titles are keyed by the chats rowid, which VACUUM may renumber; they are cheap to reindex.
+                        conn.execute("INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')")
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _chat_json(row):
+        return {
+            "id": row["id"], "title": row["title"], "pinned": bool(row["pinned"]),
+            "createdAt": row["created_at"], "messageCount": row["message_count"],
+        }
+
+    def list_chats(self, user_id, limit, cursor=None):
+        """Returns (chats, next_cursor): one page of metadata, pinned chats first, newest first.
+
+        Pages are keyset-paginated on the chats_page index, so any page costs about
+        the same however many chats the user has. Messages are never loaded here.
+        """
+        query = "SELECT * FROM chats WHERE user_id = ?"
+        params = [user_id]
+        if cursor is not None:
+            query += " AND (pinned, created_at, id) < (?, ?, ?)"
+            params += cursor
+        query += " ORDER BY pinned DESC, created_at DESC, id DESC LIMIT ?"
+        rows = self.db.execute(query, params + [limit + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor([last["pinned"], last["created_at"], last["id"]])
+        return [self._chat_json(row) for row in rows[:limit]], next_cursor
+
+    def get_chat(self, user_id, chat_id):
+        row = self.db.execute("SELECT * FROM chats WHERE id = ? AND user_id = ?", (chat_id, user_id)).fetchone()
+        if row is None:
+            return None
+        chat = self._chat_json(row)
+        messages = self.db.execute("SELECT role, content, partial FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
+        chat["messages"] = [
+            {"role": m["role"], "content": m["content"], **({"partial": True} if m["partial"] else {})} for m in messages
+        ]
+        return chat
+
+    def create_chat(self, user_id, title, messages, pinned=False):
+        chat_id = uuid.uuid4().hex
+        with self.db:
+            self.db.execute(
+                "INSERT INTO chats (id, user_id, title, pinned, created_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, user_id, title, int(pinned), time.time()),
+            )
+            self._insert_messages(chat_id, messages)
+        return self.get_chat(user_id, chat_id)
+
+    def update_chat(self, user_id, chat_id, title=None, pinned=None):
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE chats SET title = COALESCE(?, title), pinned = COALESCE(?, pinned) WHERE id = ? AND user_id = ?",
+                (title, None if pinned is None else int(pinned), chat_id, user_id),
+            )
+        return cursor.rowcount > 0
+
+    def delete_chat(self, user_id, chat_id):
+        with self.db:
+            cursor = self.db.execute("DELETE FROM chats WHERE id = ? AND user_id = ?", (chat_id, user_id))
+        return cursor.rowcount > 0
+
+    def append_messages(self, user_id, chat_id, messages):
+        """Appends messages to a chat; returns the new message count, or None if the chat doesn't exist."""
+        with self.db:
+            if self.db.execute("SELECT 1 FROM chats WHERE id = ? AND user_id = ?", (chat_id, user_id)).fetchone() is None:
+                return None
+            self._insert_messages(chat_id, messages)
+            row = self.db.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return row["message_count"]
+
+    def start_reply(self, user_id, chat_id, role='assistant'):
+        """Adds an empty partial message for a reply that is still streaming.
+
+        Returns (message id, message count), or None if the chat doesn't exist.
+        """
+        with self.db:
+            if self.db.execute("SELECT 1 FROM chats WHERE id = ? AND user_id = ?", (chat_id, user_id)).fetchone() is None:
+                return None
+            cursor = self.db.execute(
+                "INSERT INTO messages (chat_id, role, content, created_at, partial) VALUES (?, ?, '', ?, 1)", (chat_id, role, time.time()),
+            )
+            self.db.execute("UPDATE chats SET message_count = message_count + 1 WHERE id = ?", (chat_id,))
+            row = self.db.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return cursor.lastrowid, row["message_count"]
+
+    def extend_reply(self, user_id, chat_id, message_id, text, final=False):
+        """Appends text to a partial message, and marks it complete if final. Returns False if there is none."""
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE messages SET content = content || ?, partial = ? WHERE id = ? AND chat_id = ? AND partial = 1"
+                " AND EXISTS (SELECT 1 FROM chats WHERE id = ? AND user_id = ?)",
+                (text, int(not final), message_id, chat_id, chat_id, user_id),
+            )
+        return cursor.rowcount > 0
+
+    def search(self, user_id, text, limit, offset=0):
+        """Full-text search over a user's chats; returns (chats, messages, has_more).
+
+        Only the newest SEARCH_CANDIDATES matching messages are ranked (BM25),
+        so a word that appears everywhere costs no more than a rare one, and
+        snippets are built for the returned page only. Chats whose title
+        matches come with the first page. Snippets are lists of
+        {"text", "match"} segments.
+        """
+        match = fts_query(text)
+        if match is None:
+            return [], [], False
+        start, end = self.HIGHLIGHT
+        chats = []
+        if offset == 0:
+            chats = [
+                {"id": row["id"], "title": row["title"], "snippet": highlight_segments(row["snippet"], self.HIGHLIGHT)}
+                for row in self.db.execute(
+                    "SELECT c.id, c.title, highlight(chats_fts, 0, ?, ?) AS snippet FROM chats_fts"
+                    " JOIN chats c ON c.rowid = chats_fts.rowid"
+                    " WHERE chats_fts MATCH ? AND c.user_id = ? ORDER BY rank LIMIT 5",
+                    (start, end, match, user_id),
+                )
+            ]
+        rows = self.db.execute(
+            "WITH candidates AS ("
+            " SELECT messages_fts.rowid AS id, bm25(messages_fts) AS score FROM messages_fts"
+            " JOIN messages m ON m.id = messages_fts.rowid JOIN chats c ON c.id = m.chat_id"
+            " WHERE messages_fts MATCH :match AND c.user_id = :user ORDER BY messages_fts.rowid DESC LIMIT :candidates"
+            "), page AS (SELECT id, score FROM candidates ORDER BY score, id DESC LIMIT :limit OFFSET :offset)"
+            # Snippets come from one scan over the page's rowid range: looking rows up one by one
+            # re-expands a prefix term for every row.
+            " SELECT m.id, m.chat_id, m.role, c.title, snippet(messages_fts, 0, :start, :end, '…', 16) AS snippet"
+            " FROM messages_fts CROSS JOIN page ON page.id = messages_fts.rowid"
+            " JOIN messages m ON m.id = page.id JOIN chats c ON c.id = m.chat_id"
+            " WHERE messages_fts MATCH :match AND messages_fts.rowid >= (SELECT min(id) FROM page)"
+            " ORDER BY page.score, page.id DESC",
+            {"match": match, "user": user_id, "candidates": self.SEARCH_CANDIDATES,
+             "limit": limit + 1, "offset": offset, "start": start, "end": end},
+        ).fetchall()
+        messages = [
+            {"chatId": row["chat_id"], "title": row["title"], "messageId": row["id"], "role": row["role"],
+             "snippet": highlight_segments(row["snippet"], self.HIGHLIGHT)}
+            for row in rows[:limit]
+        ]
+        return chats, messages, len(rows) > limit
+
+    def messages_to_index(self, after_id, message_ids, limit):
+        """User and assistant messages for the vector index: the first `limit` after `after_id`, plus `message_ids`.
+
+        Rows have the message id, its chat's user_id, content, partial and created_at.
+        """
+        query = ("SELECT m.id, c.user_id, m.content, m.partial, m.created_at FROM messages m JOIN chats c ON c.id = m.chat_id"
+                 " WHERE m.role IN ('user', 'assistant') AND ")
+        rows = self.db.execute(query + "m.id > ? ORDER BY m.id LIMIT ?", (after_id, limit)).fetchall()
+        if message_ids:
+            rows += self.db.execute(query + f"m.id IN ({', '.join('?' * len(message_ids))})", list(message_ids)).fetchall()
+        return rows
+
+    def messages_by_id(self, user_id, message_ids, exclude_chat=None):
+        """A user's messages with the given ids, in that order, leaving out deleted ones and those of `exclude_chat`."""
+        if not message_ids:
+            return []
+        rows = self.db.execute(
+            "SELECT m.id, m.chat_id, m.role, m.content, c.title FROM messages m JOIN chats c ON c.id = m.chat_id"
+            f" WHERE m.id IN ({', '.join('?' * len(message_ids))}) AND c.user_id = ? AND m.chat_id IS NOT ?",
+            [*message_ids, user_id, exclude_chat],
+        )
+        found = {row["id"]: row for row in rows}
+        return [found[message_id] for message_id in message_ids if message_id in found]
+
+    def _insert_messages(self, chat_id, messages):
+        now = time.time()
+        self.db.executemany(
+            "INSERT INTO messages (chat_id, role, content, created_at, partial) VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, m["role"], m["content"], now, int(bool(m.get("partial")))) for m in messages],
+        )
+        self.db.execute("UPDATE chats SET message_count = message_count + ? WHERE id = ?", (len(messages), chat_id))
+
+chat_store = ChatStore(CHAT_DB_PATH)
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
 
-# --- Config Management ---
+def decode_cursor(cursor):
+    """Decodes a page cursor from encode_cursor(); raises ValueError if it's malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list) or len(values) != 3:
+        raise ValueError("Invalid cursor")
+    return values
 
-def load_firebase_config():
-    """Loads the Firebase config from config.py."""
-    if not os.path.exists(CONFIG_FILE_PATH):
-        return {}
+SEARCH_TERM_PATTERN = re.compile(r'\w+')
+
+def fts_query(text, max_terms=8):
+    """Turns what the user typed into an FTS5 query matching all its words, the last one as a prefix.
+
+    Returns None if there is nothing to search for. Words are quoted, so FTS5
+    operators in the input are searched for as plain text. A single trailing
+    letter isn't expanded (the prefix indexes start at two characters); after
+    other words it is left out until more of it is typed.
+    """
+    terms = SEARCH_TERM_PATTERN.findall(text or '')[:max_terms]
+    if len(terms) > 1 and len(terms[-1]) == 1:
+        terms.pop()
+    if not terms:
+        return None
+    query = ' '.join(f'"{term}"' for term in terms)
+    return query + '*' if len(terms[-1]) > 1 else query
+
+def highlight_segments(snippet, markers):
+    """Splits a snippet with highlight markers into [{"text", "match"}] segments for the browser."""
+    start, end = markers
+    segments = []
+    for i, part in enumerate(re.split(f'[{start}{end}]', snippet or '')):
+        if part:
+            segments.append({"text": part, "match": i % 2 == 1})
+    return segments
+
+def valid_messages(messages):
+    return isinstance(messages, list) and all(
+        isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("content"), str) for m in messages
+    )
+
+# --- Message Index ---
+
+def send_embeddings(body, model):
+    """POSTs an /embeddings request (JSON) to a backend that serves `model` and returns its response."""
+    backend = backends.acquire(model)
+    started = time.perf_counter()
     try:
-        from config import FIREBASE_CONFIG
-        return FIREBASE_CONFIG
-    except (ImportError, AttributeError, SyntaxError):
-        return {}
+        response = upstream.post(f"{backend.url}/embeddings", headers={"Content-Type": "application/json"}, data=body)
+    except BaseException:
+        backends.release(backend, failed=True)
+        raise
+    record_span('upstream.embeddings', started, backend=backend.url, status=response.status_code)
+    backends.release(backend, failed=response.status_code >= 500)
+    return response
 
-def save_firebase_config(config_data):
-    """Saves the Firebase config dict to config.py."""
-    with open(CONFIG_FILE_PATH, 'w') as f:
-        f.write("# This file is generated automatically. Do not edit manually.\n")
-        f.write("# Add this file to your .gitignore to keep credentials secure.\n\n")
-        f.write("FIREBASE_CONFIG = ")
-        f.write(json.dumps(config_data, indent=4))
-    print(f"Firebase configuration saved to {CONFIG_FILE_PATH}. Please restart the server.")
+def embed_texts(texts, model):
+    """Embeds texts with a single /embeddings request; returns a float32 array with one row per text."""
+    response = send_embeddings(json.dumps({"model": model, "input": texts}), model)
+    response.raise_for_status()
+    data = sorted(response.json()["data"], key=lambda item: item["index"])
+    vectors = np.asarray([item["embedding"] for item in data], dtype=np.float32)
+    if vectors.ndim != 2 or len(vectors) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, got {len(vectors)}")
+    return vectors
+
+class MessageIndex:
+    """Embeddings of the messages in the local chat store, for finding past messages like a prompt.
+
+    Each user's vectors are normalized and quantized to int8 rows (a quarter
+    the size of float32) with a scale per row, in append-only files next to
+    their message ids. A search memory-maps them and scores a cache-sized
+    chunk of rows against all its queries in one matrix product, so it reads
+    the vectors straight from the page cache. A background thread embeds
+    newly saved messages EMBEDDING_BATCH_SIZE at a time, which also backfills
+    an existing history; replies still streaming are embedded once they are
+    complete. index.json records the model, the vector size and how
+    far indexing got; changing the model starts the index over. Vectors of
+    deleted messages stay in the files but are never returned by retrieval.
+    """
+
+    MAX_CHARS = 4000               # Characters of a message that are embedded
+    SEARCH_CHUNK_BYTES = 1024 * 1024  # float32 copy of the rows scored at once; small enough to stay in cache
+    POLL_INTERVAL = 5              # Seconds between looks for messages saved by other workers
+    ERROR_BACKOFF = 60             # Seconds before indexing is retried after an error
+    ABANDONED_AFTER = 3600         # Seconds after which a reply that is still partial is skipped
+
+    def __init__(self, directory, model, batch_size):
+        self.directory = directory
+        self.model = model
+        self.batch_size = batch_size
+        self.counters = {"indexed": 0, "requests": 0, "searches": 0, "errors": 0}
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._counters_lock:
+            self.counters[name] += n
+
+    def wake(self):
+        """Has the background indexer look for newly saved messages now."""
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-index', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                self.index_all()
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, OSError, sqlite3.Error) as e:
+                self.count("errors")
+                print(f"Could not index chat messages: {e}")
+                time.sleep(self.ERROR_BACKOFF)
+
+    def index_all(self, progress=None):
+        """Embeds every message that isn't indexed yet; returns False if another process is indexing.
+
+        `progress` is called with the number of messages embedded so far after each batch.
+        """
+        with self._indexer_lock() as locked:
+            if not locked:
+                return False
+            while self._index_batch():
+                if progress:
+                    progress(self.counters["indexed"])
+        return True
+
+    @contextlib.contextmanager
+    def _indexer_lock(self):
+        """Yields whether this thread may index: one thread per process, one process per directory."""
+        if not self._index_lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, 'indexer.lock'), 'w') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        yield False
+                        return
+                yield True
+        finally:
+            self._index_lock.release()
+
+    def _index_batch(self):
+        """Embeds the next batch of messages, plus replies that completed since; returns False if there was nothing to do."""
+        state, fresh = self._state()
+        if fresh:
+            shutil.rmtree(os.path.join(self.directory, 'users'), ignore_errors=True)
+        rows = chat_store.messages_to_index(state["indexedThrough"], state["waiting"], self.batch_size)
+        abandoned = time.time() - self.ABANDONED_AFTER
+        ready = [row for row in rows if not row["partial"] and row["content"].strip()]
+        waiting = sorted(row["id"] for row in rows if row["partial"] and row["created_at"] > abandoned)
+        indexed_through = max([state["indexedThrough"]] + [row["id"] for row in rows])
+        for start in range(0, len(ready), self.batch_size):
+            self._add(ready[start:start + self.batch_size], state)
+        if not (fresh or ready or waiting != state["waiting"] or indexed_through != state["indexedThrough"]):
+            return False
+        state.update(indexedThrough=indexed_through, waiting=waiting)
+        self._save_state(state)
+        return True
+
+    def _add(self, rows, state):
+        vectors = embed_texts([row["content"][:self.MAX_CHARS] for row in rows], self.model)
+        self.count("requests")
+        if state["dim"] is None:
+            state["dim"] = vectors.shape[1]
+        elif vectors.shape[1] != state["dim"]:
+            raise ValueError(f"{self.model} returned {vectors.shape[1]}-dimensional embeddings, the index has {state['dim']}")
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+        quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+        by_user = {}
+        for i, row in enumerate(rows):
+            by_user.setdefault(row["user_id"], []).append(i)
+        for user_id, positions in by_user.items():
+            path = self._user_path(user_id)
+            os.makedirs(path, exist_ok=True)
+            count = self._rows(path, state["dim"])
+            files = [(name, open(os.path.join(path, name), 'ab')) for name in ('ids.i64', 'scales.f32', 'vectors.i8')]
+            try:
+                for name, f in files:
+                    f.truncate(count * self._row_bytes(name, state["dim"]))  # Drops a row half-written when the process was stopped
+                files[0][1].write(np.asarray([rows[i]["id"] for i in positions], dtype='<i8').tobytes())
+                files[1][1].write(scales[positions].astype('<f4').tobytes())
+                files[2][1].write(quantized[positions].tobytes())
+            finally:
+                for _, f in files:
+                    f.close()
+        self.count("indexed", len(rows))
+
+    def search(self, user_id, queries, k, min_score=-1.0):
+        """The `k` indexed messages of a user most similar to each query vector.
+
+        Returns one list of (score, message id) per query, best first, where
+        the score is the cosine similarity.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        state, fresh = self._state()
+        dim = state["dim"]
+        path = self._user_path(user_id)
+        count = 0 if fresh or dim != queries.shape[1] else self._rows(path, dim)
+        self.count("searches", len(queries))
+        if count == 0:
+            return [[] for _ in queries]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        ids = np.memmap(os.path.join(path, 'ids.i64'), dtype='<i8', mode='r', shape=(count,))
+        scales = np.memmap(os.path.join(path, 'scales.f32'), dtype='<f4', mode='r', shape=(count,))
+        vectors = np.memmap(os.path.join(path, 'vectors.i8'), dtype=np.int8, mode='r', shape=(count, dim))
+        scores = np.empty((count, len(queries)), dtype=np.float32)
+        step = max(1, self.SEARCH_CHUNK_BYTES // (dim * 4))
+        for start in range(0, count, step):
+            np.matmul(vectors[start:start + step].astype(np.float32), queries.T, out=scores[start:start + step])
+        scores *= scales[:, None]
+        results = []
+        for column in scores.T:
+            top = np.argpartition(column, -min(k, count))[-min(k, count):]
+            hits, seen = [], set()
+            for i in top[np.argsort(column[top])[::-1]]:
+                message_id = int(ids[i])
+                if column[i] >= min_score and message_id not in seen:  # A message is in twice if indexing was interrupted
+                    seen.add(message_id)
+                    hits.append((float(column[i]), message_id))
+            results.append(hits)
+        return results
+
+    def _user_path(self, user_id):
+        return os.path.join(self.directory, 'users', hashlib.sha256(user_id.encode()).hexdigest()[:32])
+
+    @staticmethod
+    def _row_bytes(name, dim):
+        return {'ids.i64': 8, 'scales.f32': 4, 'vectors.i8': dim}[name]
+
+    def _rows(self, path, dim):
+        """Rows complete in all of a user's files."""
+        try:
+            return min(os.path.getsize(os.path.join(path, name)) // self._row_bytes(name, dim) for name in ('ids.i64', 'scales.f32', 'vectors.i8'))
+        except OSError:
+            return 0
+
+    def _state(self):
+        """Returns (index.json, fresh); fresh is True if there is none for this model yet."""
+        try:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                state = json.load(f)
+            if isinstance(state, dict) and state.get("model") == self.model:
+                return state, False
+        except (OSError, ValueError):
+            pass
+        return {"model": self.model, "dim": None, "indexedThrough": 0, "waiting": []}, True
+
+    def _save_state(self, state):
+        path = os.path.join(self.directory, 'index.json')
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+    def stats(self):
+        state, _ = self._state()
+        return {
+            "model": self.model, "dim": state["dim"], "indexed_through": state["indexedThrough"],
+            "waiting": len(state["waiting"]), **self.counters,
+        }
+
+message_index = MessageIndex(EMBEDDING_DIR, EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE) if EMBEDDING_MODEL and np is not None and CHAT_STORE == 'local' else None
+if EMBEDDING_MODEL and np is None:
+    print("EMBEDDING_MODEL is set, but the message index needs numpy: pip3 install numpy")
+
+def index_saved_messages():
+    """Lets the message index know that messages were saved, so they are embedded soon."""
+    if message_index is not None:
+        message_index.wake()
+
+def wants_retrieval(data):
+    return message_index is not None and bool(data.get("retrieval", RETRIEVAL))
+
+def add_retrieved_context(payload, user_id, chat_id=None):
+    """Adds the user's past messages most like the prompt, as a system message before its last message.
+
+    Returns how many were added. Messages of the chat being continued are left
+    out, as they are in the prompt already; if the prompt can't be embedded,
+    it is sent as it was.
+    """
+    messages = payload['messages']
+    query = next((m.get("content") for m in reversed(messages) if isinstance(m, dict) and m.get("role") == "user"), None)
+    if user_id is None or not isinstance(query, str) or not query.strip():
+        return 0
+    with span('retrieval'):
+        try:
+            vector = embed_texts([query[:MessageIndex.MAX_CHARS]], message_index.model)[0]
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            print(f"Could not embed the prompt for retrieval: {e}")
+            return 0
+        hits = message_index.search(user_id, vector, RETRIEVAL_TOP_K * 4, RETRIEVAL_MIN_SCORE)[0]
+        found = chat_store.messages_by_id(user_id, [message_id for _, message_id in hits], exclude_chat=chat_id)[:RETRIEVAL_TOP_K]
+    if not found:
+        return 0
+    excerpts = "\n\n".join(f"[{row['title']}] {row['role']}: {row['content'][:RETRIEVAL_MAX_CHARS]}" for row in found)
+    context = {"role": "system", "content": f"Excerpts from the user's earlier chats that may be relevant:\n\n{excerpts}"}
+    payload['messages'] = messages[:-1] + [context] + messages[-1:]
+    return len(found)
+
+def retrieval_headers(count):
+    return {"X-Retrieved-Messages": str(count)} if count is not None else {}
 
 # --- Flask App Initialization ---
-app = Flask(__name__)
-CORS(app) # Enable CORS for all routes
+app = Flask(__name__, static_folder=None)  # Build assets are served by serve_static below
+EXPOSED_HEADERS = ["X-Prompt-Messages-Dropped", "X-Prompt-Tokens-Dropped", "X-Prompt-Summarized", "X-Cache", "X-Coalesced", "X-Request-Id", "Server-Timing", "X-Session-Version", "X-Retrieved-Messages"]
+CORS(app, expose_headers=EXPOSED_HEADERS) # Enable CORS for all routes
 
 # --- HTML Content ---
 INDEX_HTML = """
@@ -53,27 +3288,32 @@ INDEX_HTML = """
     <script src="https://unpkg.com/react-dom@18/umd/react-dom.development.js"></script>
     <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
 
+    <script>window.APP_SETTINGS = __APP_SETTINGS_PLACEHOLDER__;</script>
+
     <script type="module">
         const firebaseConfig = __FIREBASE_CONFIG_PLACEHOLDER__;
 
-        if (firebaseConfig && firebaseConfig.apiKey) {
-            try {
-                const { initializeApp } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-app.js");
-                const { getFirestore, collection, doc, onSnapshot, setDoc, addDoc, updateDoc, deleteDoc, query, where, orderBy, serverTimestamp } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-firestore.js");
-                const { getAuth, signInAnonymously, onAuthStateChanged } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-auth.js");
-
-                const app = initializeApp(firebaseConfig);
-                const db = getFirestore(app);
-                const auth = getAuth(app);
-                window.firebase = { db, auth, collection, doc, onSnapshot, setDoc, addDoc, updateDoc, deleteDoc, query, where, orderBy, serverTimestamp, signInAnonymously, onAuthStateChanged };
-            } catch (e) {
-                console.error("Firebase initialization failed:", e);
+        // The app awaits this before checking window.firebase, however the page is loaded.
+        window.firebaseInit = (async () => {
+            if (firebaseConfig && firebaseConfig.apiKey) {
+                try {
+                    const { initializeApp } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-app.js");
+                    const { getFirestore, collection, doc, onSnapshot, setDoc, addDoc, updateDoc, deleteDoc, deleteField, query, where, orderBy, serverTimestamp } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-firestore.js");
+                    const { getAuth, signInAnonymously, onAuthStateChanged } = await import("https://www.gstatic.com/firebasejs/10.12.2/firebase-auth.js");
+
+                    const app = initializeApp(firebaseConfig);
+                    const db = getFirestore(app);
+                    const auth = getAuth(app);
+                    window.firebase = { db, auth, collection, doc, onSnapshot, setDoc, addDoc, updateDoc, deleteDoc, deleteField, query, where, orderBy, serverTimestamp, signInAnonymously, onAuthStateChanged };
+                } catch (e) {
+                    console.error("Firebase initialization failed:", e);
+                    window.firebase = null;
+                }
+            } else {
+                console.warn("Firebase configuration is missing.");
                 window.firebase = null;
             }
-        } else {
-            console.warn("Firebase configuration is missing.");
-            window.firebase = null;
-        }
+        })();
     </script>
 
     <style>
@@ -221,6 +3461,7 @@ INDEX_HTML = """
     <script type="text/babel">
         const { useState, useEffect, useRef } = React;
         const API_BASE_URL = window.location.origin;
+        const SEARCH_DEBOUNCE_MS = 250;  // Pause in typing before the sidebar searches
 
         // --- Theme Configuration ---
         const THEMES = {
@@ -252,7 +3493,9 @@ INDEX_HTML = """
             edit: "M3 17.25V21h3.75L17.81 9.94l-3.75-3.75L3 17.25zM20.71 7.04c.39-.39.39-1.02 0-1.41l-2.34-2.34a.9959.9959 0 00-1.41 0l-1.83 1.83 3.75 3.75 1.83-1.83z",
             delete: "M6 19c0 1.1.9 2 2 2h8c1.1 0 2-.9 2-2V7H6v12zM19 4h-3.5l-1-1h-5l-1 1H5v2h14V4z",
             theme: "M12 2.5l2 4 4.5.5-3.5 3 1 4.5-4-2.5-4 2.5 1-4.5-3.5-3L10 6.5z",
-            plus: "M19 13h-6v6h-2v-6H5v-2h6V5h2v6h6v2z"
+            plus: "M19 13h-6v6h-2v-6H5v-2h6V5h2v6h6v2z",
+            stop: "M6 6h12v12H6z",
+            search: "M15.5 14h-.79l-.28-.27A6.471 6.471 0 0 0 16 9.5 6.5 6.5 0 1 0 9.5 16c1.61 0 3.09-.59 4.23-1.57l.27.28v.79l5 4.99L20.49 19l-4.99-5zm-6 0C7.01 14 5 11.99 5 9.5S7.01 5 9.5 5 14 7.01 14 9.5 11.99 14 9.5 14z"
         };
 
         const SettingsModal = ({ isOpen, onClose, currentConfig }) => {
@@ -289,12 +3532,9 @@ INDEX_HTML = """
                         {saveStatus === 'success' ? (
                             <div className="text-center p-6 bg-green-500/20 border border-green-400/50 rounded-2xl">
                                 <h3 className="font-bold text-lg text-green-300 mb-2">✨ Success!</h3>
-                                <p className="text-amber-300 font-semibold mt-4">ACTION REQUIRED:</p>
-                                <p className="text-amber-200">1. Stop the Python server (Ctrl+C)</p>
-                                <p className="text-amber-200">2. Restart it: `python3 app.py`</p>
-                                <p className="text-amber-200">3. Refresh this web page</p>
-                                <button onClick={onClose} className="mt-6 px-6 py-3 rounded-xl glass-button text-white font-medium">
-                                    Close
+                                <p className="text-green-200">The server is using the new config. Reload the page to connect to Firebase.</p>
+                                <button onClick={() => window.location.reload()} className="mt-6 px-6 py-3 rounded-xl glass-button text-white font-medium">
+                                    Reload
                                 </button>
                             </div>
                         ) : (
@@ -356,13 +3596,302 @@ INDEX_HTML = """
                             </div>
                         )}
                         <p className="text-sm leading-relaxed whitespace-pre-wrap">{msg.content}</p>
+                        {msg.partial && <p className="text-xs text-white/50 mt-2">Reply interrupted</p>}
                     </div>
                 </div>
             );
         };
 
+        // Reads an SSE response from /api/chat and reports the reply text as it grows,
+        // and the request's place in the server's queue while it waits for the model.
+        const readChatStream = async (response, onDelta, onQueue = () => {}) => {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let content = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true }).replace(/\\r\\n/g, '\\n');
+                const events = buffer.split('\\n\\n');
+                buffer = events.pop();
+                for (const event of events) {
+                    let eventType = 'message';
+                    let data = '';
+                    for (const line of event.split('\\n')) {
+                        if (line.startsWith('event:')) eventType = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    }
+                    if (!data || data === '[DONE]') continue;
+                    const payload = JSON.parse(data);
+                    if (eventType === 'error') throw new Error(payload.details || payload.error);
+                    if (eventType === 'cancelled') throw new DOMException('The reply was stopped.', 'AbortError');
+                    if (eventType === 'queue') {
+                        onQueue(payload.position);
+                        continue;
+                    }
+                    onQueue(null);
+                    const delta = payload.choices?.[0]?.delta?.content;
+                    if (delta) {
+                        content += delta;
+                        onDelta(content);
+                    }
+                }
+            }
+            return content;
+        };
+
+        // Sends how long each phase of a chat took in the browser, so it can be lined up with the server's trace.
+        const reportTiming = (requestId, marks) => {
+            const names = Object.keys(marks);
+            const phases = {};
+            names.slice(1).forEach((name, i) => { phases[name] = Math.round(marks[name] - marks[names[i]]); });
+            navigator.sendBeacon?.(`${API_BASE_URL}/api/client-timing`, JSON.stringify({ requestId, phases }));
+        };
+
+        // Firestore has no full-text search, but all of its chats are in memory: they are searched here,
+        // newest first, and the results take the shape of the server's /api/search.
+        const searchLoadedChats = (chats, text, offset = 0, limit = 20) => {
+            // Accents are ignored, like the server's index: "creme" finds "crème".
+            const fold = (s) => s.normalize('NFD').replace(/\\p{M}/gu, '').toLowerCase();
+            const terms = fold(text).match(/[\\p{L}\\p{N}_]+/gu) || [];
+            if (terms.length === 0) return { query: text, chats: [], messages: [], nextOffset: null };
+            const pattern = new RegExp(terms.map(term => [...term].join('\\\\p{M}*') + '\\\\p{M}*').join('|'), 'giu');
+            const matches = (s) => {
+                const folded = fold(s);
+                return terms.every(term => folded.includes(term));
+            };
+            const highlight = (text) => {
+                const s = text.normalize('NFD');
+                const segments = [];
+                let last = 0;
+                for (const m of s.matchAll(pattern)) {
+                    if (m.index > last) segments.push({ text: s.slice(last, m.index).normalize(), match: false });
+                    segments.push({ text: m[0].normalize(), match: true });
+                    last = m.index + m[0].length;
+                }
+                if (last < s.length) segments.push({ text: s.slice(last).normalize(), match: false });
+                return segments;
+            };
+            const snippet = (content) => {
+                const s = content.normalize('NFD');
+                const start = Math.max(0, s.search(pattern) - 40);
+                const end = Math.min(s.length, start + 160);
+                return highlight((start > 0 ? '…' : '') + s.slice(start, end) + (end < s.length ? '…' : ''));
+            };
+            const messages = [];
+            for (const chat of chats) {
+                (chat.messages || []).forEach((message, index) => {
+                    if (matches(message.content)) messages.push({ chatId: chat.id, title: chat.title, messageId: `${chat.id}-${index}`, role: message.role, content: message.content });
+                });
+            }
+            const page = messages.slice(offset, offset + limit).map(({ content, ...result }) => ({ ...result, snippet: snippet(content) }));
+            return {
+                query: text,
+                chats: offset > 0 ? [] : chats.filter(c => matches(c.title)).slice(0, 5).map(c => ({ id: c.id, title: c.title, snippet: highlight(c.title) })),
+                messages: page,
+                nextOffset: offset + limit < messages.length ? offset + limit : null,
+            };
+        };
+
+        // --- Chat Storage Backends ---
+        // Both backends expose the same methods, so the App doesn't care where chats live.
+        const createFirebaseBackend = (userId) => {
+            const { db, collection, doc, onSnapshot, addDoc, updateDoc, deleteDoc, deleteField, query, where, orderBy, serverTimestamp } = window.firebase;
+            let chats = [];
+            return {
+                userId,
+                subscribe(onChats, onError) {
+                    const q = query(collection(db, "chats"), where("userId", "==", userId), orderBy("createdAt", "desc"));
+                    return onSnapshot(q, snapshot => onChats(chats = snapshot.docs.map(d => ({ id: d.id, ...d.data() }))), onError);
+                },
+                async search(text, offset = 0) {
+                    return searchLoadedChats(chats, text, offset);
+                },
+                async openChat(chatId) {},
+                async createChat(chat) {
+                    const docRef = await addDoc(collection(db, "chats"), { ...chat, createdAt: serverTimestamp(), userId });
+                    return docRef.id;
+                },
+                async deleteChat(chatId) {
+                    await deleteDoc(doc(db, "chats", chatId));
+                },
+                async updateChat(chatId, fields) {
+                    await updateDoc(doc(db, "chats", chatId), fields);
+                },
+                async appendMessages(chat, messages, fields = {}) {
+                    // A reply that broke off mid-stream joins the history before the new messages.
+                    const history = chat.draft ? [...chat.messages, { ...chat.draft, partial: true }] : chat.messages;
+                    const draft = chat.draft ? { draft: deleteField() } : {};
+                    await updateDoc(doc(db, "chats", chat.id), { messages: [...history, ...messages], ...fields, ...draft });
+                },
+                // Firestore can't append to a string, so a streaming reply lives in its own `draft` field:
+                // each save rewrites that field only, and the messages array is written once at the end.
+                async startReply(chat) {
+                    return { content: '' };
+                },
+                async saveReply(chat, reply, delta) {
+                    reply.content += delta;
+                    await updateDoc(doc(db, "chats", chat.id), { draft: { role: 'assistant', content: reply.content } });
+                },
+                async finishReply(chat, reply, delta, message) {
+                    await updateDoc(doc(db, "chats", chat.id), { messages: [...chat.messages, message], draft: deleteField() });
+                },
+            };
+        };
+
+        // Talks to the server's /api/chats store. Each turn appends rows instead of rewriting the chat.
+        // The history is paged: the sidebar gets metadata only and asks for more as it scrolls.
+        const createLocalBackend = (userId) => {
+            let chats = [];
+            let nextCursor = null;
+            let loadingMore = false;
+            let listener = () => {};
+            const emit = () => listener(chats, nextCursor !== null);
+            const patch = (chatId, fields) => {
+                chats = chats.map(c => c.id === chatId ? { ...c, ...fields } : c);
+                emit();
+            };
+            const api = async (path, options = {}) => {
+                const response = await fetch(`${API_BASE_URL}/api/chats${path}`, {
+                    ...options,
+                    headers: { 'Content-Type': 'application/json', 'X-User-Id': userId },
+                });
+                if (!response.ok) throw new Error((await response.json()).error || 'Chat store error');
+                return response.status === 204 ? null : response.json();
+            };
+            return {
+                userId,
+                subscribe(onChats, onError) {
+                    listener = onChats;
+                    api('').then(data => {
+                        chats = data.chats;
+                        nextCursor = data.nextCursor;
+                        emit();
+                    }).catch(onError);
+                    return () => { listener = () => {}; };
+                },
+                async loadMore() {
+                    if (!nextCursor || loadingMore) return;
+                    loadingMore = true;
+                    try {
+                        const data = await api(`?cursor=${encodeURIComponent(nextCursor)}`);
+                        const known = new Set(chats.map(c => c.id));
+                        chats = [...chats, ...data.chats.filter(c => !known.has(c.id))];
+                        nextCursor = data.nextCursor;
+                        emit();
+                    } finally {
+                        loadingMore = false;
+                    }
+                },
+                async loadMessages(chatId) {
+                    const chat = await api(`/${chatId}`);
+                    patch(chatId, { messages: chat.messages });
+                },
+                async search(text, offset = 0) {
+                    const params = new URLSearchParams({ q: text, offset });
+                    const response = await fetch(`${API_BASE_URL}/api/search?${params}`, { headers: { 'X-User-Id': userId } });
+                    if (!response.ok) throw new Error((await response.json()).error || 'Search failed');
+                    return response.json();
+                },
+                // A search result can be a chat that no page loaded yet; it joins the list when opened.
+                async openChat(chatId) {
+                    if (chats.some(c => c.id === chatId)) return;
+                    const chat = await api(`/${chatId}`);
+                    chats = [...chats, chat];
+                    emit();
+                },
+                async createChat(chat) {
+                    const created = await api('', { method: 'POST', body: JSON.stringify(chat) });
+                    chats = [created, ...chats];
+                    emit();
+                    return created.id;
+                },
+                async deleteChat(chatId) {
+                    await api(`/${chatId}`, { method: 'DELETE' });
+                    chats = chats.filter(c => c.id !== chatId);
+                    emit();
+                },
+                async updateChat(chatId, fields) {
+                    await api(`/${chatId}`, { method: 'PATCH', body: JSON.stringify(fields) });
+                    patch(chatId, fields);
+                },
+                async appendMessages(chat, messages, fields = {}) {
+                    if (Object.keys(fields).length > 0) await this.updateChat(chat.id, fields);
+                    const { messageCount } = await api(`/${chat.id}/messages`, { method: 'POST', body: JSON.stringify({ messages }) });
+                    patch(chat.id, { messages: [...chat.messages, ...messages], messageCount });
+                },
+                // A streaming reply is one partial row that each save appends to, so a save costs
+                // only the new text. The chat in memory is updated once the reply is finished.
+                async startReply(chat) {
+                    return await api(`/${chat.id}/replies`, { method: 'POST' });
+                },
+                async saveReply(chat, reply, delta) {
+                    await api(`/${chat.id}/replies/${reply.messageId}`, { method: 'PATCH', body: JSON.stringify({ append: delta }) });
+                },
+                async finishReply(chat, reply, delta, message) {
+                    await api(`/${chat.id}/replies/${reply.messageId}`, { method: 'PATCH', body: JSON.stringify({ append: delta, final: !message.partial }) });
+                    patch(chat.id, { messages: [...chat.messages, message], messageCount: reply.messageCount });
+                },
+            };
+        };
+
+        // Saves a reply while it streams: the new text is sent every replySaveIntervalMs, or sooner once
+        // replySaveChars are waiting, so a reload or a crash loses at most about a second of it.
+        const createReplyWriter = (backend, chat) => {
+            const { replySaveIntervalMs = 1000, replySaveChars = 2048 } = window.APP_SETTINGS || {};
+            let content = '';
+            let saved = 0;
+            let reply = null;
+            let timer = null;
+            let writes = Promise.resolve();
+            let finished = null;
+            const flush = () => {
+                clearTimeout(timer);
+                timer = null;
+                writes = writes.then(async () => {
+                    const end = content.length;
+                    if (end === saved) return;
+                    if (!reply) reply = await backend.startReply(chat);
+                    await backend.saveReply(chat, reply, content.slice(saved, end));
+                    saved = end;
+                }).catch(error => console.error("Could not save the partial reply:", error));
+            };
+            return {
+                update(text) {
+                    content = text;
+                    if (finished) return;
+                    if (content.length - saved >= replySaveChars) flush();
+                    else if (!timer) timer = setTimeout(flush, replySaveIntervalMs);
+                },
+                // Saves the rest of the reply; `complete` is false if the stream broke off. Returns the saved message.
+                finish(complete) {
+                    if (!finished) finished = (async () => {
+                        clearTimeout(timer);
+                        await writes;
+                        const message = complete ? { role: 'assistant', content } : { role: 'assistant', content, partial: true };
+                        if (reply) await backend.finishReply(chat, reply, content.slice(saved), message);
+                        else if (content || complete) await backend.appendMessages(chat, [message]);
+                        else return null;
+                        return message;
+                    })();
+                    return finished;
+                },
+            };
+        };
+
+        const getLocalUserId = () => {
+            let userId = localStorage.getItem('chatUserId');
+            if (!userId) {
+                userId = crypto.randomUUID();
+                localStorage.setItem('chatUserId', userId);
+            }
+            return userId;
+        };
+
+        const isLocalStore = window.APP_SETTINGS?.chatStore === 'local';
+
         const App = () => {
-            const [user, setUser] = useState(null);
             const [chats, setChats] = useState([]);
             const [activeChatId, setActiveChatId] = useState(null);
             const [userInput, setUserInput] = useState('');
@@ -372,10 +3901,20 @@ INDEX_HTML = """
             const [isSettingsOpen, setIsSettingsOpen] = useState(false);
             const [isHistoryOpen, setIsHistoryOpen] = useState(false);
             const [firebaseConfig, setFirebaseConfig] = useState({});
-            const [firebaseReady, setFirebaseReady] = useState(false);
+            const [storeReady, setStoreReady] = useState(false);
+            const [backend, setBackend] = useState(null);
+            const [hasMoreChats, setHasMoreChats] = useState(false);
             const [currentTheme, setCurrentTheme] = useState('cosmic');
             const [deleteConfirmId, setDeleteConfirmId] = useState(null);
+            const [streamingReply, setStreamingReply] = useState(null);
+            const [queuePosition, setQueuePosition] = useState(null);
+            const [searchQuery, setSearchQuery] = useState('');
+            const [searchResults, setSearchResults] = useState(null);
             const chatContainerRef = useRef(null);
+            const searchLoadingRef = useRef(false);
+            const activeRequestRef = useRef(null);
+            // Session version of each chat on the server, after the last reply that completed in this tab.
+            const sessionVersionsRef = useRef({});
 
             const activeChat = chats.find(c => c.id === activeChatId);
             const pinnedChats = chats.filter(c => c.pinned);
@@ -389,9 +3928,15 @@ INDEX_HTML = """
             }, []);
 
             useEffect(() => {
-                fetch('/api/config').then(res => res.json()).then(data => {
+                fetch('/api/config').then(res => res.json()).then(async data => {
                     setFirebaseConfig(data);
-                    if (window.firebase) setFirebaseReady(true);
+                    if (isLocalStore) {
+                        setBackend(createLocalBackend(getLocalUserId()));
+                        setStoreReady(true);
+                        return;
+                    }
+                    await window.firebaseInit;
+                    if (window.firebase) setStoreReady(true);
                     else if (!data || !data.apiKey) setIsSettingsOpen(true);
                 });
                 fetch(`${API_BASE_URL}/api/models`).then(res => res.json()).then(data => {
@@ -402,33 +3947,62 @@ INDEX_HTML = """
             }, []);
 
             useEffect(() => {
-                if (!firebaseReady) return;
+                if (!storeReady || isLocalStore) return;
                 const { auth, onAuthStateChanged, signInAnonymously } = window.firebase;
                 const unsubscribe = onAuthStateChanged(auth, currentUser => {
-                    if (currentUser) setUser(currentUser);
+                    if (currentUser) setBackend(createFirebaseBackend(currentUser.uid));
                     else signInAnonymously(auth);
                 });
                 return unsubscribe;
-            }, [firebaseReady]);
+            }, [storeReady]);
 
             useEffect(() => {
-                if (!user || !firebaseReady) return;
-                const { db, collection, query, where, orderBy, onSnapshot } = window.firebase;
-                const q = query(collection(db, "chats"), where("userId", "==", user.uid), orderBy("createdAt", "desc"));
-                const unsubscribe = onSnapshot(q, (querySnapshot) => {
-                    const chatsData = querySnapshot.docs.map(doc => ({ id: doc.id, ...doc.data() }));
+                if (!backend) return;
+                return backend.subscribe((chatsData, hasMore = false) => {
                     setChats(chatsData);
-                    if (!activeChatId && chatsData.length > 0) setActiveChatId(chatsData[0].id);
+                    setHasMoreChats(hasMore);
+                    setActiveChatId(current => current || (chatsData.length > 0 ? chatsData[0].id : null));
                 }, (error) => {
-                    console.error("Firestore error:", error);
-                    alert("Firestore connection error. Please ensure your security rules and index are correct.");
+                    console.error("Chat store error:", error);
+                    alert(isLocalStore
+                        ? "Could not load chats from the server."
+                        : "Firestore connection error. Please ensure your security rules and index are correct.");
                 });
-                return () => unsubscribe();
-            }, [user, firebaseReady]);
+            }, [backend]);
+
+            useEffect(() => {
+                // The local store lists chats without their messages; fetch them when a chat is opened.
+                if (!backend?.loadMessages || !activeChat || activeChat.messages) return;
+                backend.loadMessages(activeChat.id).catch(error => console.error("Could not load chat:", error));
+            }, [backend, activeChatId, activeChat?.messages]);
+
+            useEffect(() => {
+                if (!backend || !searchQuery.trim()) {
+                    setSearchResults(null);
+                    return;
+                }
+                let stale = false;
+                const timer = setTimeout(() => {
+                    backend.search(searchQuery)
+                        .then(results => { if (!stale) setSearchResults(results); })
+                        .catch(error => console.error("Search failed:", error));
+                }, SEARCH_DEBOUNCE_MS);
+                return () => {
+                    stale = true;
+                    clearTimeout(timer);
+                };
+            }, [backend, searchQuery]);
+
+            useEffect(() => {
+                if (!storeReady) return;
+                // Page-ready time (until the chat is usable), for comparing frontend builds.
+                performance.mark('app-ready');
+                console.info(`App ready in ${Math.round(performance.now())} ms`);
+            }, [storeReady]);
 
             useEffect(() => {
                 chatContainerRef.current?.scrollTo({ top: chatContainerRef.current.scrollHeight, behavior: 'smooth' });
-            }, [activeChat?.messages]);
+            }, [activeChat?.messages, streamingReply]);
 
             const handleThemeChange = (theme) => {
                 setCurrentTheme(theme);
@@ -437,24 +4011,20 @@ INDEX_HTML = """
             };
 
             const handleNewChat = async () => {
-                if (!user || !firebaseReady) return;
-                const { db, collection, addDoc, serverTimestamp } = window.firebase;
+                if (!backend) return;
                 const newChat = {
                     title: "New Chat",
                     messages: [{ role: 'assistant', content: 'Hello! How can I help you today?' }],
-                    createdAt: serverTimestamp(),
-                    userId: user.uid,
                     pinned: false,
                 };
-                const docRef = await addDoc(collection(db, "chats"), newChat);
-                setActiveChatId(docRef.id);
+                const chatId = await backend.createChat(newChat);
+                setActiveChatId(chatId);
                 setIsHistoryOpen(false);
             };
 
             const handleDeleteChat = async (chatId) => {
-                if (!firebaseReady) return;
-                const { db, doc, deleteDoc } = window.firebase;
-                await deleteDoc(doc(db, "chats", chatId));
+                if (!backend) return;
+                await backend.deleteChat(chatId);
                 setDeleteConfirmId(null);
                 if (chatId === activeChatId) {
                     const remainingChats = chats.filter(c => c.id !== chatId);
@@ -468,50 +4038,119 @@ INDEX_HTML = """
 
             const handleSendMessage = async (e) => {
                 e.preventDefault();
-                if (!userInput.trim() || isLoading || !selectedModel || !activeChat || !firebaseReady) return;
+                if (!userInput.trim() || isLoading || !selectedModel || !activeChat?.messages || !backend) return;
                 const newUserMessage = { role: 'user', content: userInput.trim() };
-                const updatedMessages = [...activeChat.messages, newUserMessage];
+                const history = activeChat.draft ? [...activeChat.messages, { ...activeChat.draft, partial: true }] : activeChat.messages;
+                const updatedMessages = [...history, newUserMessage];
                 setIsLoading(true);
                 setUserInput('');
-                const { db, doc, updateDoc } = window.firebase;
-                const docRef = doc(db, "chats", activeChatId);
                 const isNewChat = activeChat.title === "New Chat";
                 const newTitle = isNewChat ? userInput.trim().substring(0, 30) : activeChat.title;
-                await updateDoc(docRef, { messages: updatedMessages, title: newTitle });
+                // Phase end times, in the order the phases happen.
+                const marks = { start: performance.now() };
+                await backend.appendMessages(activeChat, [newUserMessage], isNewChat ? { title: newTitle } : {});
+                marks.save_prompt = performance.now();
+                const chatId = activeChatId;
+                const chatWithUserMessage = { ...activeChat, messages: updatedMessages, draft: null };
+                const writer = createReplyWriter(backend, chatWithUserMessage);
+                const requestId = crypto.randomUUID();
+                const controller = new AbortController();
+                activeRequestRef.current = { requestId, controller };
+                // With a session, only the new message is sent; a draft the server never saw needs the whole chat.
+                const sessionVersion = activeChat.draft ? null : sessionVersionsRef.current[chatId];
+                delete sessionVersionsRef.current[chatId];
+                const postChat = (version) => fetch(`${API_BASE_URL}/api/chat`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json', 'X-User-Id': backend.userId, 'X-Request-Id': requestId },
+                    body: JSON.stringify({
+                        messages: (version ? [newUserMessage] : updatedMessages).map(({ role, content }) => ({ role, content })),
+                        model: selectedModel, stream: true, chat_id: chatId,
+                        ...(window.APP_SETTINGS?.chatSessions && chatId ? { session: { version: version || 0, messages: history.length } } : {})
+                    }),
+                    signal: controller.signal
+                });
                 try {
-                    const response = await fetch(`${API_BASE_URL}/api/chat`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ messages: updatedMessages, model: selectedModel })
-                    });
+                    let response = await postChat(sessionVersion);
+                    if (response.status === 409) response = await postChat(null);
+                    marks.response_headers = performance.now();
                     if (!response.ok) throw new Error((await response.json()).details || 'Unknown error');
-                    const data = await response.json();
-                    const assistantMessage = data.choices[0].message;
-                    await updateDoc(docRef, { messages: [...updatedMessages, assistantMessage] });
+                    const content = await readChatStream(response, text => {
+                        if (!marks.first_token) marks.first_token = performance.now();
+                        setStreamingReply({ chatId, content: text });
+                        writer.update(text);
+                    }, setQueuePosition);
+                    marks.stream = performance.now();
+                    await writer.finish(true);
+                    marks.save_reply = performance.now();
+                    const newVersion = Number(response.headers.get('X-Session-Version'));
+                    if (newVersion) sessionVersionsRef.current[chatId] = newVersion;
                 } catch (error) {
+                    // Whatever arrived before the error is kept, marked as interrupted.
+                    const partial = await writer.finish(false).catch(() => null);
+                    if (error.name === 'AbortError') return;  // Stopped by the user; there is no error to show
+                    const chatSoFar = partial ? { ...chatWithUserMessage, messages: [...updatedMessages, partial] } : chatWithUserMessage;
                     const errorMessage = { role: 'error', content: `Error: ${error.message}` };
-                    await updateDoc(docRef, { messages: [...updatedMessages, errorMessage] });
+                    await backend.appendMessages(chatSoFar, [errorMessage]);
                 } finally {
+                    activeRequestRef.current = null;
+                    setStreamingReply(null);
+                    setQueuePosition(null);
                     setIsLoading(false);
+                    reportTiming(requestId, marks);
+                }
+            };
+
+            // Stops the reply being generated. The cancel call frees LM Studio at once, even
+            // behind a proxy that keeps the connection open; aborting ends the stream here.
+            const handleStopGenerating = () => {
+                const active = activeRequestRef.current;
+                if (!active) return;
+                fetch(`${API_BASE_URL}/api/chat/${active.requestId}/cancel`, {
+                    method: 'POST', headers: { 'X-User-Id': backend.userId }, keepalive: true
+                }).catch(() => {});
+                active.controller.abort();
+            };
+
+            const loadMoreResults = () => {
+                if (searchResults?.nextOffset == null || searchLoadingRef.current) return;
+                searchLoadingRef.current = true;
+                backend.search(searchResults.query, searchResults.nextOffset).then(more => {
+                    setSearchResults(current => current?.query === more.query
+                        ? { ...current, messages: [...current.messages, ...more.messages], nextOffset: more.nextOffset }
+                        : current);
+                }).catch(error => console.error("Search failed:", error)).finally(() => { searchLoadingRef.current = false; });
+            };
+
+            const openSearchResult = async (chatId) => {
+                try {
+                    await backend.openChat(chatId);
+                } catch (error) {
+                    console.error("Could not open chat:", error);
+                    return;
                 }
+                setActiveChatId(chatId);
+                setIsHistoryOpen(false);
             };
 
+            const Highlighted = ({ segments }) => segments.map((segment, i) => segment.match
+                ? <mark key={i} className="bg-yellow-300/40 text-white rounded px-0.5">{segment.text}</mark>
+                : <span key={i}>{segment.text}</span>);
+
             const HistoryItem = ({ chat, onSelect, onDelete, deleteConfirmId, setDeleteConfirmId }) => {
                 const [isEditing, setIsEditing] = useState(false);
                 const [title, setTitle] = useState(chat.title);
-                const { db, doc, updateDoc } = window.firebase;
 
                 const handleRename = async (e) => {
                     e.preventDefault();
                     if (title.trim() && title.trim() !== chat.title) {
-                        await updateDoc(doc(db, "chats", chat.id), { title: title.trim() });
+                        await backend.updateChat(chat.id, { title: title.trim() });
                     }
                     setIsEditing(false);
                 };
 
                 const handleTogglePin = async (e) => {
                     e.stopPropagation();
-                    await updateDoc(doc(db, "chats", chat.id), { pinned: !chat.pinned });
+                    await backend.updateChat(chat.id, { pinned: !chat.pinned });
                 };
 
                 return (
@@ -564,7 +4203,7 @@ INDEX_HTML = """
                                 </div>
                             </div>
                             <p className="text-gray-300 text-xs mt-1">
-                                {new Date(chat.createdAt?.seconds * 1000).toLocaleDateString()}
+                                {new Date((typeof chat.createdAt === 'number' ? chat.createdAt : chat.createdAt?.seconds) * 1000).toLocaleDateString()}
                             </p>
                         </div>
 
@@ -591,7 +4230,7 @@ INDEX_HTML = """
                 );
             };
 
-            if (!firebaseReady && !isSettingsOpen) {
+            if (!storeReady && !isSettingsOpen) {
                 return (
                     <div className="flex items-center justify-center h-screen text-white text-lg">
                         <div className="glass-panel p-8 rounded-3xl flex items-center space-x-3">
@@ -631,7 +4270,48 @@ INDEX_HTML = """
                                 <span>New Chat</span>
                             </button>
 
-                            <div className="space-y-2 overflow-y-auto flex-grow chat-area">
+                            <div className="relative mb-4 flex-shrink-0">
+                                <Icon path={ICONS.search} className="w-4 h-4 text-white/60 absolute left-3 top-1/2 -translate-y-1/2" />
+                                <input
+                                    type="search"
+                                    value={searchQuery}
+                                    onChange={e => setSearchQuery(e.target.value)}
+                                    placeholder="Search chats"
+                                    className="w-full pl-9 pr-3 py-2 rounded-xl bg-white/10 text-white text-sm placeholder-white/50 outline-none focus:bg-white/15"
+                                />
+                            </div>
+
+                            <div
+                                className="space-y-2 overflow-y-auto flex-grow chat-area"
+                                onScroll={e => {
+                                    const el = e.currentTarget;
+                                    if (el.scrollHeight - el.scrollTop - el.clientHeight >= 200) return;
+                                    if (searchResults) loadMoreResults();
+                                    else if (hasMoreChats) backend.loadMore();
+                                }}
+                            >
+                                {searchResults ? (
+                                    <>
+                                        {searchResults.chats.length === 0 && searchResults.messages.length === 0 && (
+                                            <p className="text-sm text-white/60 px-2">No matches</p>
+                                        )}
+                                        {searchResults.chats.map(chat => (
+                                            <div key={`chat-${chat.id}`} onClick={() => openSearchResult(chat.id)} className="p-3 rounded-xl cursor-pointer transition-all hover:bg-white/15">
+                                                <p className="text-white font-medium text-sm truncate"><Highlighted segments={chat.snippet} /></p>
+                                            </div>
+                                        ))}
+                                        {searchResults.messages.map(result => (
+                                            <div key={`message-${result.messageId}`} onClick={() => openSearchResult(result.chatId)} className="p-3 rounded-xl cursor-pointer transition-all hover:bg-white/15">
+                                                <p className="text-white/60 text-xs truncate mb-1">{result.title}</p>
+                                                <p className="text-white text-sm line-clamp-3"><Highlighted segments={result.snippet} /></p>
+                                            </div>
+                                        ))}
+                                        {searchResults.nextOffset != null && (
+                                            <div className="flex justify-center py-3"><Spinner /></div>
+                                        )}
+                                    </>
+                                ) : (
+                                <>
                                 {pinnedChats.length > 0 && (
                                     <h3 className="text-xs text-yellow-300 font-semibold uppercase px-2 mb-2">📌 Pinned</h3>
                                 )}
@@ -659,6 +4339,11 @@ INDEX_HTML = """
                                         setDeleteConfirmId={setDeleteConfirmId}
                                     />
                                 ))}
+                                {hasMoreChats && (
+                                    <div className="flex justify-center py-3"><Spinner /></div>
+                                )}
+                                </>
+                                )}
                             </div>
                         </div>
                     </div>
@@ -727,10 +4412,16 @@ INDEX_HTML = """
                             {/* Chat Area */}
                             <div ref={chatContainerRef} className="flex-1 py-6 overflow-y-auto chat-area">
                                 <div className="space-y-4 pr-4">
-                                    {activeChat?.messages.map((msg, index) => (
+                                    {(activeChat?.messages || []).map((msg, index) => (
                                         <ChatMessage key={index} msg={msg} />
                                     ))}
-                                    {isLoading && (
+                                    {activeChat?.draft && streamingReply?.chatId !== activeChatId && (
+                                        <ChatMessage msg={{ ...activeChat.draft, partial: true }} />
+                                    )}
+                                    {streamingReply?.chatId === activeChatId && (
+                                        <ChatMessage msg={{ role: 'assistant', content: streamingReply.content }} />
+                                    )}
+                                    {isLoading && !streamingReply && (
                                         <div className="flex justify-start">
                                             <div className="bg-gradient-to-br from-white/25 to-white/15 max-w-md lg:max-w-lg px-5 py-3 rounded-2xl text-white shadow-lg flex items-center space-x-3">
                                                 <div className="typing-indicator">
@@ -738,6 +4429,7 @@ INDEX_HTML = """
                                                     <div className="typing-dot"></div>
                                                     <div className="typing-dot"></div>
                                                 </div>
+                                                {queuePosition && <span className="text-sm text-white/70">Waiting for the model · #{queuePosition} in queue</span>}
                                             </div>
                                         </div>
                                     )}
@@ -753,15 +4445,26 @@ INDEX_HTML = """
                                         onChange={e => setUserInput(e.target.value)}
                                         placeholder="Type your message..."
                                         className="flex-1 bg-transparent px-4 py-2 text-white placeholder-gray-400 focus:outline-none"
-                                        disabled={isLoading || !selectedModel || !firebaseReady}
+                                        disabled={isLoading || !selectedModel || !storeReady}
                                     />
-                                    <button
-                                        type="submit"
-                                        className="bg-gradient-to-r from-cyan-500 to-blue-500 rounded-xl p-3 text-white hover:shadow-lg transition-all disabled:opacity-50 disabled:cursor-not-allowed"
-                                        disabled={isLoading || !userInput.trim() || !firebaseReady}
-                                    >
-                                        <Icon path={ICONS.send} className="w-5 h-5" />
-                                    </button>
+                                    {isLoading ? (
+                                        <button
+                                            type="button"
+                                            onClick={handleStopGenerating}
+                                            className="bg-gradient-to-r from-rose-500 to-orange-500 rounded-xl p-3 text-white hover:shadow-lg transition-all"
+                                            title="Stop generating"
+                                        >
+                                            <Icon path={ICONS.stop} className="w-5 h-5" />
+                                        </button>
+                                    ) : (
+                                        <button
+                                            type="submit"
+                                            className="bg-gradient-to-r from-cyan-500 to-blue-500 rounded-xl p-3 text-white hover:shadow-lg transition-all disabled:opacity-50 disabled:cursor-not-allowed"
+                                            disabled={!userInput.trim() || !storeReady}
+                                        >
+                                            <Icon path={ICONS.send} className="w-5 h-5" />
+                                        </button>
+                                    )}
                                 </form>
                             </div>
                         </div>
@@ -777,55 +4480,1304 @@ INDEX_HTML = """
 </html>
 """
 
+# --- Index Page ---
+
+class RenderedPage:
+    """A page rendered once and kept in memory with pre-compressed variants.
+
+    The render function runs again only after invalidate(), e.g. when the
+    Firebase config is saved. Each encoding gets its own strong ETag.
+    """
+
+    def __init__(self, render):
+        self.render = render
+        self._variants = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._variants = None
+
+    def variants(self):
+        """Returns {encoding: (body, etag)}, rendering the page if needed."""
+        variants = self._variants
+        if variants is None:
+            with self._lock:
+                if self._variants is None:
+                    self._variants = self._build()
+                variants = self._variants
+        return variants
+
+    def _build(self):
+        body = self.render().encode()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {
+            'identity': (body, digest),
+            'gzip': (gzip.compress(body, compresslevel=9, mtime=0), f"{digest}-gzip"),
+        }
+        if brotli is not None:
+            variants['br'] = (brotli.compress(body, quality=11), f"{digest}-br")
+        return variants
+
+def choose_encoding(accept_encoding, available):
+    """Picks the best available content coding from an Accept-Encoding header."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('br', 'gzip'):
+        if coding in available and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return 'identity'
+
+def load_asset_manifest():
+    """Loads static/manifest.json written by build.py, or None if the frontend isn't built."""
+    try:
+        with open(os.path.join(STATIC_DIR, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def use_built_assets(html, manifest):
+    """Swaps in-browser Babel, development React and the Tailwind CDN for the prebuilt bundle."""
+    html = html.replace('<script src="https://cdn.tailwindcss.com"></script>', f'<link rel="stylesheet" href="/static/{manifest["css"]}">')
+    html = html.replace('<script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>', '')
+    html = html.replace('react.development.js', 'react.production.min.js').replace('react-dom.development.js', 'react-dom.production.min.js')
+    html = re.sub(r'<script type="text/babel">.*?</script>', lambda _: f'<script defer src="/static/{manifest["js"]}"></script>', html, flags=re.S)
+    return html.replace('<script src="https://unpkg.com/react', '<script defer src="https://unpkg.com/react')
+
+def render_index():
+    html = INDEX_HTML
+    manifest = load_asset_manifest()
+    if manifest:
+        html = use_built_assets(html, manifest)
+    html = html.replace('__APP_SETTINGS_PLACEHOLDER__', json.dumps({
+        "chatStore": CHAT_STORE, "replySaveIntervalMs": REPLY_SAVE_INTERVAL_MS, "replySaveChars": REPLY_SAVE_CHARS,
+        "chatSessions": CHAT_SESSIONS,
+    }))
+    return html.replace('__FIREBASE_CONFIG_PLACEHOLDER__', json.dumps(load_firebase_config()))
+
+index_page = RenderedPage(render_index)
+config_store.on_change(index_page.invalidate)
+
 # --- API Endpoints ---
+@app.before_request
+def start_request_meter():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.meter = RequestMeter(route, request.method, request.content_length)
+    g.trace = Trace(f"{request.method} {route}", request.headers.get('X-Request-Id'), request.headers.get('traceparent'))
+    current_trace.set(g.trace)
+    current_cancellation.set(None)  # Server threads are reused; chat_proxy sets its own
+
+@app.after_request
+def finish_request_meter(response):
+    meter = g.get('meter')
+    if meter is None:
+        return response
+    meter.start(response.status_code, response.headers.get('X-Cache'), 'X-Coalesced' in response.headers)
+    if response.mimetype == 'text/event-stream':
+        response.response = meter.count(response.response)
+    elif meter.model is not None and not response.is_streamed:
+        meter.chunk(response.get_data())
+    else:
+        meter.response_bytes = response.content_length or 0
+    response.call_on_close(meter.finish)
+    trace = g.trace
+    response.headers['X-Request-Id'] = trace.request_id
+    if trace.spans:
+        response.headers['Server-Timing'] = trace.server_timing()
+    response.call_on_close(lambda: trace.finish(meter.status, meter.model))
+    cancellation = g.get('cancellation')
+    if cancellation is not None:
+        response.call_on_close(lambda: active_requests.end(cancellation))
+    turn = g.get('session_turn')
+    if turn is not None:
+        response.call_on_close(turn.close)
+    return response
+
 @app.route('/')
 def serve_index():
-    config_data = load_firebase_config()
-    config_json = json.dumps(config_data)
-    return INDEX_HTML.replace('__FIREBASE_CONFIG_PLACEHOLDER__', config_json)
+    config_store.check()  # Re-renders the page if another worker saved a new config
+    variants = index_page.variants()
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'), variants)
+    body, etag = variants[encoding]
+    # Pages are revalidated on every visit, which costs a 304 unless the config changed.
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if any(etag_matches(request.headers.get('If-None-Match'), tag) for _, tag in variants.values()):
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype='text/html', headers=headers)
+
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    # Build assets have a content hash in their name, so they never change and can be cached for good.
+    available = {'identity': filename}
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if os.path.isfile(os.path.join(STATIC_DIR, filename + suffix)):
+            available[encoding] = filename + suffix
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'), available)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_from_directory(STATIC_DIR, available[encoding], mimetype=mimetype, max_age=31536000)
+    response.headers.pop("Content-Disposition", None)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding != 'identity':
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 @app.route('/api/config', methods=['GET', 'POST'])
 def api_config():
     if request.method == 'POST':
-        config_data = request.get_json()
-        if config_data:
-            save_firebase_config(config_data)
-            return jsonify({"status": "success"})
-        return jsonify({"status": "error", "message": "No data received"}), 400
+        config_data = request.get_json(silent=True)
+        if not isinstance(config_data, dict) or not config_data:
+            return jsonify({"status": "error", "message": "No data received"}), 400
+        try:
+            version = save_firebase_config(config_data)
+        except OSError as e:
+            return jsonify({"status": "error", "message": "Could not save the config.", "details": str(e)}), 500
+        return jsonify({"status": "success", "version": version})
     else: # GET
-        return jsonify(load_firebase_config())
+        config = load_firebase_config()
+        return jsonify(config), 200, {"X-Config-Version": str(config_store.version)}
+
+def store_user_id(value):
+    user_id = (value or '').strip()
+    return user_id if 0 < len(user_id) <= 128 else None
+
+def chat_store_user():
+    """The browser's anonymous user id for the local chat store, or None if it's missing."""
+    return store_user_id(request.headers.get('X-User-Id'))
+
+@app.route('/api/chats', methods=['GET', 'POST'])
+def api_chats():
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    if request.method == 'GET':
+        try:
+            limit = min(max(int(request.args.get('limit', CHAT_PAGE_SIZE)), 1), 200)
+            cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        chats, next_cursor = chat_store.list_chats(user_id, limit, cursor)
+        return jsonify({"chats": chats, "nextCursor": next_cursor})
+    data = request.get_json(silent=True) or {}
+    messages = data.get("messages", [])
+    if not valid_messages(messages):
+        return jsonify({"error": "'messages' must be a list of {role, content} objects"}), 400
+    chat = chat_store.create_chat(user_id, str(data.get("title") or "New Chat"), messages, bool(data.get("pinned", False)))
+    index_saved_messages()
+    return jsonify(chat), 201
+
+@app.route('/api/chats/<chat_id>', methods=['GET', 'PATCH', 'DELETE'])
+def api_chat(chat_id):
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    if request.method == 'GET':
+        chat = chat_store.get_chat(user_id, chat_id)
+        return jsonify(chat) if chat else (jsonify({"error": "Chat not found"}), 404)
+    if request.method == 'DELETE':
+        if not chat_store.delete_chat(user_id, chat_id):
+            return jsonify({"error": "Chat not found"}), 404
+        return Response(status=204)
+    data = request.get_json(silent=True) or {}
+    title = data.get("title")
+    pinned = data.get("pinned")
+    if title is not None and not (isinstance(title, str) and title.strip()):
+        return jsonify({"error": "'title' must be a non-empty string"}), 400
+    if not chat_store.update_chat(user_id, chat_id, title, None if pinned is None else bool(pinned)):
+        return jsonify({"error": "Chat not found"}), 404
+    return jsonify({"status": "success"})
+
+@app.route('/api/chats/<chat_id>/messages', methods=['POST'])
+def api_chat_messages(chat_id):
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    messages = (request.get_json(silent=True) or {}).get("messages")
+    if not valid_messages(messages) or not messages:
+        return jsonify({"error": "'messages' must be a non-empty list of {role, content} objects"}), 400
+    message_count = chat_store.append_messages(user_id, chat_id, messages)
+    if message_count is None:
+        return jsonify({"error": "Chat not found"}), 404
+    index_saved_messages()
+    return jsonify({"messageCount": message_count})
+
+@app.route('/api/chats/<chat_id>/replies', methods=['POST'])
+def api_chat_replies(chat_id):
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    started = chat_store.start_reply(user_id, chat_id)
+    if started is None:
+        return jsonify({"error": "Chat not found"}), 404
+    message_id, message_count = started
+    return jsonify({"messageId": message_id, "messageCount": message_count}), 201
+
+@app.route('/api/chats/<chat_id>/replies/<int:message_id>', methods=['PATCH'])
+def api_chat_reply(chat_id, message_id):
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    data = request.get_json(silent=True) or {}
+    text = data.get("append", "")
+    if not isinstance(text, str):
+        return jsonify({"error": "'append' must be a string"}), 400
+    final = bool(data.get("final", False))
+    if not chat_store.extend_reply(user_id, chat_id, message_id, text, final):
+        return jsonify({"error": "No reply in progress with that id"}), 404
+    if final:
+        index_saved_messages()
+    return jsonify({"status": "success"})
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    user_id = chat_store_user()
+    if user_id is None:
+        return jsonify({"error": "Missing X-User-Id header"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "'limit' and 'offset' must be integers"}), 400
+    query = request.args.get('q', '')
+    with span('search'):
+        chats, messages, has_more = chat_store.search(user_id, query, limit, offset)
+    return jsonify({"query": query, "chats": chats, "messages": messages, "nextOffset": offset + limit if has_more else None})
+
+def fetch_models():
+    return backends.fetch_models()  # Parsed and merged, so a body the UI can't parse is never cached
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
     try:
-        response = requests.get(f"{LM_STUDIO_BASE_URL}/models")
-        response.raise_for_status()
-        return jsonify(response.json())
+        entry = models_cache.get(fetch_models)
+        headers = cached_body_headers(entry)
+        if etag_matches(request.headers.get('If-None-Match'), entry.etag):
+            return Response(status=304, headers=headers)
+        return Response(entry.body, mimetype='application/json', headers=headers)
+    except ValueError as e:
+        return jsonify({"error": "LM Studio returned an invalid model list.", "details": str(e)}), 502
+    except requests.exceptions.Timeout as e:
+        return jsonify({"error": "LM Studio server timed out.", "details": str(e)}), 504
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Could not connect to LM Studio server.", "details": str(e)}), 500
 
+@app.route('/api/embeddings', methods=['POST'])
+def embeddings_proxy():
+    """Passes an OpenAI-style embeddings request through to a backend that serves its model."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'input' not in data or 'model' not in data:
+        return jsonify({"error": "Missing 'input' or 'model' in request body"}), 400
+    try:
+        response = send_embeddings(request.get_data(), data['model'])
+    except requests.exceptions.Timeout as e:
+        return jsonify({"error": "LM Studio timed out.", "details": str(e)}), 504
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Could not get a response from LM Studio.", "details": str(e)}), 500
+    return Response(response.content, status=response.status_code, content_type=passthrough_content_type(response.headers))
+
+def build_chat_payload(data):
+    """Validates a /api/chat body and returns (LM Studio payload, error message)."""
+    if not isinstance(data, dict) or 'messages' not in data or 'model' not in data:
+        return None, "Missing 'messages' or 'model' in request body"
+    payload = {
+        "model": data['model'], "messages": data['messages'],
+        "temperature": data.get("temperature", 0.7), "max_tokens": data.get("max_tokens", -1),
+        "stream": bool(data.get("stream", False)),
+    }
+    return payload, None
+
+def chat_affinity(data):
+    """The chat id a request belongs to, used to keep a chat's turns on one backend."""
+    chat_id = data.get("chat_id")
+    return chat_id if isinstance(chat_id, str) and chat_id else None
+
+def wants_summary(data):
+    return bool(data.get("summarize", PROMPT_SUMMARIZE))
+
+def sse_event(data, event=None):
+    """Formats a JSON payload as a single Server-Sent Event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n".encode()
+
+def relay_stream(response, collector=None):
+    """Yields LM Studio's SSE chunks to the browser as soon as they arrive."""
+    started = first_byte = time.perf_counter()
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            if chunk:
+                if first_byte == started:
+                    first_byte = time.perf_counter()
+                    record_span('upstream.first_byte', started, first_byte)
+                if collector:
+                    collector.feed(chunk)
+                yield chunk
+    except requests.exceptions.RequestException as e:
+        if request_cancelled():
+            yield cancelled_event()
+        else:
+            yield sse_event({"error": "The LM Studio stream was interrupted.", "details": str(e)}, event="error")
+        return
+    finally:
+        detach_upstream()
+        response.close()
+        record_span('upstream.stream', first_byte)
+    request_done()
+    if collector:
+        collector.store()
+
+def admission_user():
+    """Who a chat request is queued for: the browser's user id, or its address."""
+    return request.headers.get('X-User-Id', '').strip() or request.remote_addr
+
+def send_chat(payload, chat_id=None):
+    """POSTs a chat completion to a backend from the pool and checks its status.
+
+    A backend that can't be connected to is skipped for the next one. Returns
+    (response, backend); the caller calls backends.release(backend) once the
+    response has been read. Raises RequestCancelled if the request is cancelled.
+    """
+    tried = []
+    while True:
+        raise_if_cancelled()
+        backend = backends.acquire(payload['model'], chat_id, exclude=tried)
+        started = time.perf_counter()
+        try:
+            response = upstream.post(f"{backend.url}/chat/completions", headers={"Content-Type": "application/json"}, data=json.dumps(payload), stream=payload['stream'])
+        except requests.exceptions.ConnectionError:
+            backends.release(backend, failed=not request_cancelled())
+            raise_if_cancelled()
+            tried.append(backend)
+            if len(tried) == len(backends.backends):
+                raise
+            backends.count("failover")
+            continue
+        except BaseException:
+            backends.release(backend, failed=not request_cancelled())
+            raise_if_cancelled()
+            raise
+        if not payload['stream']:
+            detach_upstream()
+        upstream_latency.observe(time.perf_counter() - started, metrics.model_label(payload['model']))
+        record_span('upstream.headers' if payload['stream'] else 'upstream.response', started, backend=backend.url, status=response.status_code)
+        if not response.ok:
+            response.close()
+            backends.release(backend, failed=response.status_code >= 500)
+            response.raise_for_status()
+        return response, backend
+
+def queued_stream(ticket, payload, chat_id=None, collector=None):
+    """Streams the request's queue position while it waits for a slot, then LM Studio's reply."""
+    try:
+        with span('admission.wait', queued=True):
+            for position in ticket.wait(admission.timeout):
+                yield sse_event({"position": position}, event="queue")
+        response, backend = send_chat(payload, chat_id)
+    except RequestCancelled:
+        yield cancelled_event()
+        return
+    except QueueTimeout as e:
+        yield sse_event({"error": "LM Studio is busy.", "details": str(e)}, event="error")
+        return
+    except requests.exceptions.RequestException as e:
+        yield sse_event({"error": "Could not get a response from LM Studio.", "details": str(e)}, event="error")
+        return
+    try:
+        yield from relay_stream(response, collector)
+    finally:
+        backends.release(backend)
+
+def completion_events(body):
+    """Replays a cached completion as the SSE stream LM Studio would have sent."""
+    completion = json.loads(body)
+    choice = completion['choices'][0]
+    chunk = {
+        "id": completion.get("id"), "object": "chat.completion.chunk", "created": completion.get("created"), "model": completion.get("model"),
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": choice['message']['content']}, "finish_reason": choice.get('finish_reason')}],
+    }
+    return sse_event(chunk) + b"data: [DONE]\n\n"
+
+def completion_reply(body):
+    """The reply text of a non-streamed completion body, or None if it has none."""
+    try:
+        content = json.loads(body)['choices'][0]['message']['content']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+    return content if isinstance(content, str) else None
+
+def keep_completion(body, cache_key=None, turn=None):
+    """Caches a non-streamed completion and adds its reply to the session turn.
+
+    The body is passed to the browser as LM Studio sent it; it is parsed here
+    only when the cache or a session needs the reply.
+    """
+    if cache_key is None and turn is None:
+        return
+    reply = completion_reply(body)
+    if reply is None:
+        return  # A session turn without its reply is forgotten when the request closes
+    if cache_key is not None:
+        response_cache.put(cache_key, body)
+    if turn is not None:
+        turn.commit(reply)
+
+def passthrough_content_type(headers):
+    return headers.get('Content-Type') or 'application/json'
+
 @app.route('/api/chat', methods=['POST'])
 def chat_proxy():
     try:
-        data = request.get_json()
-        if 'messages' not in data or 'model' not in data:
-            return jsonify({"error": "Missing 'messages' or 'model' in request body"}), 400
-        payload = {
-            "model": data['model'], "messages": data['messages'],
-            "temperature": data.get("temperature", 0.7), "max_tokens": data.get("max_tokens", -1),
-            "stream": False,
-        }
-        response = requests.post(f"{LM_STUDIO_BASE_URL}/chat/completions", headers={"Content-Type": "application/json"}, data=json.dumps(payload))
-        response.raise_for_status()
-        return jsonify(response.json())
+        with span('parse'):
+            data = request.get_json()
+            payload, error = build_chat_payload(data)
+        if error:
+            return jsonify({"error": error}), 400
+        try:
+            turn, error = session_turn(data, payload, admission_user())
+        except SessionConflict as e:
+            return jsonify(session_conflict_body(e)), 409
+        if error:
+            return jsonify({"error": error}), 400
+        g.session_turn = turn
+        g.meter.model = payload['model']
+        g.cancellation = active_requests.start(g.trace.request_id, admission_user(), payload['model'])
+        current_cancellation.set(g.cancellation)
+        client_socket = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+        if client_socket is not None:
+            g.cancellation.client_socket = client_socket
+            disconnects.watch(client_socket, g.cancellation)
+        stream = payload['stream']
+        chat_id = chat_affinity(data)
+        retrieved = add_retrieved_context(payload, chat_store_user(), chat_id) if wants_retrieval(data) else None
+        summarize = wants_summary(data)
+        trim = trim_prompt(payload, summarize)
+        if trim.dropped and summarize:
+            summary = summarize_dropped(payload['model'], trim.dropped)
+            if summary:
+                trim = insert_summary(payload, trim, summary)
+        with span('cache.lookup'):
+            cached = lookup_response(data, payload)
+        headers = {**trim_headers(trim), **cache_headers(cached), **session_headers(turn), **retrieval_headers(retrieved)}
+        if cached.body is not None:
+            keep_completion(cached.body, turn=turn)
+            if stream:
+                return Response(completion_events(cached.body), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers})
+            return Response(cached.body, mimetype='application/json', headers=headers)
+        if not COALESCE_REQUESTS or turn is not None:  # A session turn is never a duplicate: its version is taken
+            return generate_chat(payload, chat_id, cached, headers, turn)
+        flight, leader = inflight.join(flight_key(payload, admission_user(), request.headers.get('Idempotency-Key')))
+    except RequestCancelled as e:
+        return jsonify({"error": "The request was cancelled.", "details": str(e)}), 499
+    except Exception as e:
+        return jsonify({"error": "An internal server error occurred.", "details": str(e)}), 500
+    if not leader:
+        return follow_flight(flight)
+    return lead_flight(flight, generate_chat(payload, chat_id, cached, headers))
+
+def generate_chat(payload, chat_id, cached, headers, turn=None):
+    """Sends a chat through the admission queue to a backend and returns the response for the browser."""
+    stream = payload['stream']
+    try:
+        try:
+            ticket = admission.enter(payload['model'], admission_user())
+        except QueueFull as e:
+            body, retry_headers = queue_full_response(e)
+            return jsonify(body), 429, retry_headers
+        current_cancellation.get().ticket = ticket
+        if stream:
+            collector = CompletionCollector(cached.key, payload['model'], turn) if cached.key or turn else None
+            if ticket.admitted:
+                try:
+                    response, backend = send_chat(payload, chat_id)
+                except BaseException:
+                    ticket.release()
+                    raise
+                result = Response(stream_with_context(relay_stream(response, collector)), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers})
+                result.call_on_close(lambda: backends.release(backend))
+            else:
+                result = Response(stream_with_context(queued_stream(ticket, payload, chat_id, collector)), mimetype='text/event-stream', headers={**SSE_HEADERS, **headers})
+            result.call_on_close(ticket.release)  # Also runs if the browser disconnects mid-stream
+            return result
+        try:
+            with span('admission.wait', queued=not ticket.admitted):
+                for _ in ticket.wait(admission.timeout):
+                    pass
+            response, backend = send_chat(payload, chat_id)
+            backends.release(backend)
+            request_done()
+        finally:
+            ticket.release()
+        keep_completion(response.content, cached.key, turn)
+        with span('serialize'):
+            return Response(response.content, content_type=passthrough_content_type(response.headers), headers=headers)
+    except RequestCancelled as e:
+        return jsonify({"error": "The request was cancelled.", "details": str(e)}), 499
+    except QueueTimeout as e:
+        return jsonify({"error": "LM Studio is busy.", "details": str(e)}), 503
+    except requests.exceptions.Timeout as e:
+        return jsonify({"error": "LM Studio timed out.", "details": str(e)}), 504
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Could not get a response from LM Studio.", "details": str(e)}), 500
     except Exception as e:
         return jsonify({"error": "An internal server error occurred.", "details": str(e)}), 500
 
+def lead_flight(flight, result):
+    """Shares the leader's response with the identical requests that joined its flight."""
+    try:
+        result = app.make_response(result)
+        headers = {name: value for name, value in result.headers.items() if name != 'Content-Length'}
+        flight.start(result.status_code, headers, result.is_streamed)
+        if result.is_streamed:
+            result.response = flight.record(result.response, tail=interrupted_event())
+            result.call_on_close(lambda: flight.finish(tail=interrupted_event()))  # If the body was never read
+        else:
+            flight.append(result.get_data())
+            flight.finish()
+        return result
+    except BaseException as e:
+        flight.finish(error=e)
+        raise
+
+def follow_flight(flight):
+    """Answers a duplicate request with the response of the flight it joined."""
+    try:
+        with span('coalesced.wait'):
+            flight.wait_started()
+    except Exception as e:
+        return jsonify({"error": "An internal server error occurred.", "details": str(e)}), 500
+    headers = {**flight.headers, "X-Coalesced": "1"}
+    if flight.streamed:
+        return Response(stop_when_cancelled(flight.follow()), status=flight.status, headers=headers)
+    return Response(b''.join(flight.follow()), status=flight.status, headers=headers)
+
+def stop_when_cancelled(chunks):
+    """Ends a followed stream once this request is cancelled; the shared generation goes on for the others."""
+    cancellation = current_cancellation.get()
+    try:
+        for chunk in chunks:
+            if cancellation is not None and cancellation.cancelled:
+                yield cancelled_event()
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+@app.route('/api/chat/<request_id>/cancel', methods=['POST'])
+def cancel_chat(request_id):
+    """Stops a chat request of this user; with several workers, one running in another worker is stopped shortly after."""
+    saved = active_requests.cancel(request_id, admission_user())
+    if saved is None:
+        if not cancel_relay.running or not REQUEST_ID_PATTERN.match(request_id) or active_requests.running(request_id):
+            return jsonify({"error": "No such request in progress."}), 404
+        try:
+            cancel_relay.post(request_id, admission_user())
+        except OSError as e:
+            return jsonify({"error": "Could not pass the cancel call on to the other workers.", "details": str(e)}), 500
+        return jsonify({"status": "cancelling", "requestId": request_id}), 202
+    return jsonify({"status": "cancelled", "requestId": request_id, "gpuSecondsSaved": round(saved, 3)})
+
+def query_flag(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+@app.route('/api/batch', methods=['GET', 'POST'])
+def api_batch():
+    """Starts a batch job from a JSONL upload of chat requests, or lists this user's jobs."""
+    user = admission_user()
+    if request.method == 'GET':
+        return jsonify({"batches": batch_jobs.list(user)})
+    try:
+        concurrency = max(int(request.args.get('concurrency', BATCH_CONCURRENCY)), 1)
+    except ValueError:
+        return jsonify({"error": "'concurrency' must be an integer"}), 400
+    try:
+        job = batch_jobs.create(user, request.stream, concurrency)
+    except BatchError as e:
+        return jsonify({"error": str(e)}), e.status
+    if query_flag('stream'):
+        return Response(job.results(follow=True), mimetype='application/x-ndjson', headers={"X-Batch-Id": job.id})
+    return jsonify(job.progress()), 202, {"Location": f"/api/batch/{job.id}"}
+
+@app.route('/api/batch/<job_id>', methods=['GET', 'DELETE'])
+def api_batch_job(job_id):
+    job = batch_jobs.get(admission_user(), job_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    if request.method == 'DELETE':
+        try:
+            batch_jobs.delete(job)
+        except BatchError as e:
+            return jsonify({"error": str(e)}), e.status
+        return Response(status=204)
+    return jsonify(job.progress())
+
+@app.route('/api/batch/<job_id>/results', methods=['GET'])
+def api_batch_results(job_id):
+    """The job's results as JSONL in completion order; with ?follow=1, streamed until the job stops."""
+    job = batch_jobs.get(admission_user(), job_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    try:
+        after = max(int(request.args.get('after', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "'after' must be an integer"}), 400
+    follow = query_flag('follow')
+    headers = {} if follow else {"Content-Disposition": f'attachment; filename="batch-{job.id}.jsonl"'}
+    return Response(job.results(after, follow), mimetype='application/x-ndjson', headers=headers)
+
+@app.route('/api/batch/<job_id>/cancel', methods=['POST'])
+def api_batch_cancel(job_id):
+    job = batch_jobs.get(admission_user(), job_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    try:
+        batch_jobs.cancel(job)
+    except BatchError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify(job.progress())
+
+@app.route('/api/batch/<job_id>/resume', methods=['POST'])
+def api_batch_resume(job_id):
+    job = batch_jobs.get(admission_user(), job_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    try:
+        batch_jobs.resume(job)
+    except BatchError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify(job.progress())
+
+metrics.gauge('admission_queue_depth', "Chat requests waiting for a slot, per model.", ('model',),
+              lambda: {(m,): v["waiting"] for m, v in admission.stats()["models"].items()})
+metrics.gauge('admission_active_requests', "Chat requests running on LM Studio, per model.", ('model',),
+              lambda: {(m,): v["active"] for m, v in admission.stats()["models"].items()})
+metrics.gauge('backend_outstanding_requests', "Requests in progress per backend.", ('backend',),
+              lambda: {(url,): b["outstanding"] for url, b in backends.stats()["backends"].items()})
+metrics.gauge('backend_ejected', "1 while a backend is left out after failures.", ('backend',),
+              lambda: {(url,): int(b["ejected"]) for url, b in backends.stats()["backends"].items()})
+metrics.gauge('cache_events_total', "Model list and response cache lookups by outcome.", ('cache', 'event'),
+              lambda: {**{("models", k): v for k, v in models_cache.counters.items()},
+                       **{("responses", k): v for k, v in response_cache.counters.items()}}, kind='counter')
+metrics.gauge('coalesced_generations_saved_total', "Chat requests that followed an identical in-flight request.", (),
+              lambda: {(): inflight.counters["generations_saved"]}, kind='counter')
+metrics.gauge('batch_requests_total', "Requests of batch jobs completed, by outcome.", ('outcome',),
+              lambda: {("succeeded",): batch_jobs.counters["succeeded"], ("failed",): batch_jobs.counters["failed"]}, kind='counter')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/client-timing', methods=['POST'])
+def client_timing():
+    # Sent with navigator.sendBeacon, which posts the JSON as text/plain.
+    data = request.get_json(force=True, silent=True) or {}
+    phases = data.get("phases") if isinstance(data.get("phases"), dict) else {}
+    phases = {name: ms for name, ms in phases.items() if name in CLIENT_PHASES and isinstance(ms, (int, float)) and 0 <= ms < 86400000}
+    if not phases:
+        return jsonify({"error": "No known phases in the timing report."}), 400
+    request_id = str(data.get("requestId", ""))
+    for name, ms in phases.items():
+        client_phase.observe(ms / 1000, name)
+    if TRACE_LOG:
+        trace_log.info(json.dumps({"request_id": request_id if REQUEST_ID_PATTERN.match(request_id) else None, "name": "client", "phases_ms": phases}))
+    return '', 204
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    stats = {
+        "upstream": upstream.stats(), "models_cache": models_cache.stats(),
+        "response_cache": response_cache.stats(), "admission": admission.stats(), "backends": backends.stats(),
+        "coalescing": inflight.stats(), "cancellation": active_requests.stats(),
+        "sessions": sessions.stats(), "batch": batch_jobs.stats(),
+        "embeddings": message_index.stats() if message_index is not None else None,
+    }
+    if asgi_app is not None and asgi_app.upstream is not None:
+        stats["async_upstream"] = asgi_app.upstream.stats()
+    return jsonify(stats)
+
+# --- Async Serving (ASGI) ---
+
+class AsyncUpstreamClient:
+    """The asyncio counterpart of UpstreamClient, backed by one httpx.AsyncClient.
+
+    Each in-flight generation holds a connection rather than a thread, so the
+    connection limit is much higher than the number of idle keep-alive sockets.
+    """
+
+    def __init__(self, pool_size, max_connections, connect_timeout, read_timeout, retries, backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    async def get(self, url):
+        """GETs a URL, retrying connection errors and 502/503/504 with exponential backoff."""
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client.get(url)
+                if response.status_code not in (502, 503, 504) or attempt == self.retries:
+                    return response
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def post(self, url, stream=False, **kwargs):
+        request_ = self.client.build_request('POST', url, **kwargs)
+        return await self.client.send(request_, stream=stream)
+
+    def stats(self):
+        """Connections in use and idle, or "unknown" where httpx doesn't expose its pool."""
+        # httpcore's pool isn't public API: another httpx version or a custom transport may not have it.
+        connections = getattr(getattr(getattr(self.client, '_transport', None), '_pool', None), 'connections', None)
+        try:
+            idle = sum(1 for conn in connections if conn.is_idle())
+            return {"in_use": len(connections) - idle, "idle": idle}
+        except (TypeError, AttributeError):
+            return {"in_use": "unknown", "idle": "unknown"}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+# What Flask-CORS adds to every response, for the routes served without Flask
+ASGI_CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-expose-headers', ', '.join(EXPOSED_HEADERS).encode()),
+]
+
+async def read_asgi_body(receive):
+    """Collects the full request body from an ASGI receive channel."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+async def send_asgi_json(send, data, status=200, headers=None):
+    await send_asgi_body(send, json.dumps(data).encode(), status=status, headers=headers)
+
+async def send_asgi_body(send, body, status=200, content_type='application/json', headers=None):
+    raw_headers = [
+        (b'content-type', content_type.encode()),
+        (b'content-length', str(len(body)).encode()),
+    ] + ASGI_CORS_HEADERS
+    raw_headers += [(name.lower().encode(), str(value).encode()) for name, value in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+def asgi_header(scope, name):
+    """Returns a request header from an ASGI scope, or None."""
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def asgi_admission_user(scope):
+    """The ASGI version of admission_user()."""
+    return (asgi_header(scope, 'X-User-Id') or '').strip() or (scope.get('client') or ('unknown',))[0]
+
+def metered_send(meter, send):
+    """Wraps an ASGI send callable so the response is observed by a RequestMeter."""
+    async def send_and_measure(message):
+        if message['type'] == 'http.response.start':
+            headers = dict(message['headers'])
+            meter.start(message['status'], headers.get(b'x-cache', b'').decode() or None, b'x-coalesced' in headers)
+        elif message['type'] == 'http.response.body':
+            meter.chunk(message.get('body', b''))
+        await send(message)
+    return send_and_measure
+
+def traced_send(trace, send):
+    """Wraps an ASGI send callable to add the X-Request-Id and Server-Timing headers."""
+    async def send_with_trace(message):
+        if message['type'] == 'http.response.start':
+            headers = message['headers'] + [(b'x-request-id', trace.request_id.encode())]
+            if trace.spans:
+                headers.append((b'server-timing', trace.server_timing().encode()))
+            message = {**message, 'headers': headers}
+        await send(message)
+    return send_with_trace
+
+def record_asgi_response(flight, send):
+    """Wraps an ASGI send callable so a leader's response is kept for its flight's followers."""
+    async def send_and_record(message):
+        if message['type'] == 'http.response.start':
+            headers = [(name, value) for name, value in message['headers'] if name != b'content-length']
+            flight.start(message['status'], headers, True)
+        elif message['type'] == 'http.response.body':
+            if message.get('body'):
+                flight.append(message['body'])
+            if not message.get('more_body'):
+                flight.finish()
+        await send(message)
+    return send_and_record
+
+class AsgiApp:
+    """Serves the LM Studio-bound API routes as coroutines and hands the rest to Flask."""
+
+    def __init__(self, flask_app):
+        self.fallback = WsgiToAsgi(flask_app)
+        self.upstream = None
+        self.routes = {
+            ('POST', '/api/chat'): self.chat,
+            ('GET', '/api/models'): self.models,
+            ('GET', '/api/config'): self.config,
+            ('POST', '/api/config'): self.config,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+        if self.upstream is None:
+            self.upstream = AsyncUpstreamClient(
+                UPSTREAM_POOL_SIZE, ASYNC_UPSTREAM_MAX_CONNECTIONS, UPSTREAM_CONNECT_TIMEOUT,
+                UPSTREAM_READ_TIMEOUT, UPSTREAM_RETRIES, UPSTREAM_RETRY_BACKOFF,
+            )
+        meter = scope['meter'] = RequestMeter(scope['path'], scope['method'], int(asgi_header(scope, 'Content-Length') or 0))
+        trace = scope['trace'] = Trace(f"{scope['method']} {scope['path']}", asgi_header(scope, 'X-Request-Id'), asgi_header(scope, 'traceparent'))
+        current_trace.set(trace)
+        try:
+            await handler(scope, receive, metered_send(meter, traced_send(trace, send)))
+        finally:
+            meter.finish()
+            trace.finish(meter.status, meter.model)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.upstream is not None:
+                    await self.upstream.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def config(self, scope, receive, send):
+        if scope['method'] == 'POST':
+            try:
+                config_data = json.loads(await read_asgi_body(receive) or b'null')
+            except ValueError:
+                config_data = None
+            if not isinstance(config_data, dict) or not config_data:
+                return await send_asgi_json(send, {"status": "error", "message": "No data received"}, 400)
+            try:
+                version = await asyncio.to_thread(save_firebase_config, config_data)
+            except OSError as e:
+                return await send_asgi_json(send, {"status": "error", "message": "Could not save the config.", "details": str(e)}, 500)
+            return await send_asgi_json(send, {"status": "success", "version": version})
+        config = load_firebase_config()
+        await send_asgi_json(send, config, headers={"X-Config-Version": str(config_store.version)})
+
+    async def fetch_models(self):
+        responses = await asyncio.gather(*(self.upstream.get(f"{b.url}/models") for b in backends.backends), return_exceptions=True)
+        return backends.merge_model_lists(zip(backends.backends, responses))
+
+    async def models(self, scope, receive, send):
+        try:
+            entry = await models_cache.aget(self.fetch_models)
+            headers = cached_body_headers(entry)
+            if etag_matches(asgi_header(scope, 'If-None-Match'), entry.etag):
+                return await send_asgi_body(send, b'', status=304, headers=headers)
+            await send_asgi_body(send, entry.body, headers=headers)
+        except ValueError as e:
+            await send_asgi_json(send, {"error": "LM Studio returned an invalid model list.", "details": str(e)}, 502)
+        except httpx.TimeoutException as e:
+            await send_asgi_json(send, {"error": "LM Studio server timed out.", "details": str(e)}, 504)
+        except httpx.HTTPError as e:
+            await send_asgi_json(send, {"error": "Could not connect to LM Studio server.", "details": str(e)}, 500)
+
+    async def chat(self, scope, receive, send):
+        """Runs generate() so that a cancel call or a client disconnect stops it at once."""
+        body = await read_asgi_body(receive)
+        cancellation = active_requests.start(scope['trace'].request_id, asgi_admission_user(scope))
+        current_cancellation.set(cancellation)
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        cancellation.on_cancel(lambda: loop.call_soon_threadsafe(lambda: cancellation.finished or task.cancel()))
+
+        async def send_until_done(message):
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                cancellation.done()  # Servers report a disconnect once the response is complete
+            await send(message)
+
+        watcher = asyncio.create_task(self.watch_disconnect(receive, cancellation))
+        try:
+            await self.generate(scope, body, send_until_done)
+        except asyncio.CancelledError:
+            if not cancellation.cancelled:
+                raise  # The server is shutting down
+            with contextlib.suppress(OSError):
+                if scope['meter'].status is None:
+                    await send_asgi_json(send, {"error": "The request was cancelled.", "details": f"The request was cancelled ({cancellation.reason})."}, 499)
+                else:
+                    await send({'type': 'http.response.body', 'body': cancelled_event()})
+        finally:
+            watcher.cancel()
+            active_requests.end(cancellation)
+
+    async def watch_disconnect(self, receive, cancellation):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        active_requests.stop(cancellation, 'disconnect')
+
+    async def generate(self, scope, body, send):
+        flight = turn = None
+        try:
+            with span('parse'):
+                data = json.loads(body)
+                payload, error = build_chat_payload(data)
+            if error:
+                return await send_asgi_json(send, {"error": error}, 400)
+            try:
+                turn, error = session_turn(data, payload, asgi_admission_user(scope))
+            except SessionConflict as e:
+                return await send_asgi_json(send, session_conflict_body(e), 409)
+            if error:
+                return await send_asgi_json(send, {"error": error}, 400)
+            scope['meter'].model = current_cancellation.get().model = payload['model']
+            chat_id = chat_affinity(data)
+            retrieved = None
+            if wants_retrieval(data):
+                retrieved = await asyncio.to_thread(add_retrieved_context, payload, store_user_id(asgi_header(scope, 'X-User-Id')), chat_id)
+            summarize = wants_summary(data)
+            trim = trim_prompt(payload, summarize)
+            if trim.dropped and summarize:
+                summary = await self.summarize_dropped(payload['model'], trim.dropped)
+                if summary:
+                    trim = insert_summary(payload, trim, summary)
+            with span('cache.lookup'):
+                cached = lookup_response(data, payload)
+            headers = {**trim_headers(trim), **cache_headers(cached), **session_headers(turn), **retrieval_headers(retrieved)}
+            if cached.body is not None:
+                keep_completion(cached.body, turn=turn)
+                if payload['stream']:
+                    return await send_asgi_body(send, completion_events(cached.body), content_type='text/event-stream', headers={**SSE_HEADERS, **headers})
+                return await send_asgi_body(send, cached.body, headers=headers)
+            if COALESCE_REQUESTS and turn is None:
+                flight, leader = inflight.join(flight_key(payload, asgi_admission_user(scope), asgi_header(scope, 'Idempotency-Key')))
+                if not leader:
+                    return await self.follow_flight(flight, send)
+                send = record_asgi_response(flight, send)
+            try:
+                ticket = admission.enter(payload['model'], asgi_admission_user(scope))
+            except QueueFull as e:
+                body, retry_headers = queue_full_response(e)
+                return await send_asgi_json(send, body, 429, retry_headers)
+            current_cancellation.get().ticket = ticket
+            collector = CompletionCollector(cached.key, payload['model'], turn) if (cached.key or turn) and payload['stream'] else None
+            try:
+                if payload['stream'] and not ticket.admitted:
+                    await self.queued_stream(ticket, payload, chat_id, send, headers, collector)
+                else:
+                    with span('admission.wait', queued=not ticket.admitted):
+                        async for _ in ticket.await_admission(admission.timeout):
+                            pass
+                    response, backend = await self.send_chat(payload, chat_id)
+                    try:
+                        if not payload['stream']:
+                            if cached.key or turn:
+                                await asyncio.to_thread(keep_completion, response.content, cached.key, turn)
+                            with span('serialize'):
+                                await send_asgi_body(send, response.content, content_type=passthrough_content_type(response.headers), headers=headers)
+                            return
+                        await self.relay_stream(response, send, headers, collector)
+                    finally:
+                        backends.release(backend)
+            finally:
+                ticket.release()
+        except QueueTimeout as e:
+            await send_asgi_json(send, {"error": "LM Studio is busy.", "details": str(e)}, 503)
+        except httpx.TimeoutException as e:
+            await send_asgi_json(send, {"error": "LM Studio timed out.", "details": str(e)}, 504)
+        except httpx.HTTPError as e:
+            await send_asgi_json(send, {"error": "Could not get a response from LM Studio.", "details": str(e)}, 500)
+        except Exception as e:
+            await send_asgi_json(send, {"error": "An internal server error occurred.", "details": str(e)}, 500)
+        finally:
+            if flight is not None:
+                flight.finish(tail=interrupted_event())  # No-op once the whole response was sent
+            if turn is not None:
+                turn.close()
+
+    async def follow_flight(self, flight, send):
+        """The async version of follow_flight()."""
+        try:
+            with span('coalesced.wait'):
+                await flight.await_started()
+        except Exception as e:
+            return await send_asgi_json(send, {"error": "An internal server error occurred.", "details": str(e)}, 500)
+        await send({'type': 'http.response.start', 'status': flight.status, 'headers': flight.headers + [(b'x-coalesced', b'1')]})
+        async for chunk in flight.afollow():
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def summarize_dropped(self, model, dropped):
+        """The async version of summarize_dropped(); returns None if LM Studio can't summarize."""
+        key = summary_key(model, dropped)
+        summary = cached_summary(key)
+        if summary is None:
+            try:
+                response, backend = await self.send_chat(summary_payload(model, dropped))
+                backends.release(backend)
+                summary = response.json()['choices'][0]['message']['content']
+            except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+                print(f"Could not summarize trimmed messages: {e}")
+                return None
+            store_summary(key, summary)
+        return summary
+
+    async def send_chat(self, payload, chat_id=None):
+        """The async version of send_chat()."""
+        tried = []
+        while True:
+            raise_if_task_cancelled()
+            backend = backends.acquire(payload['model'], chat_id, exclude=tried)
+            started = time.perf_counter()
+            try:
+                response = await self.upstream.post(
+                    f"{backend.url}/chat/completions", stream=payload['stream'],
+                    headers={"Content-Type": "application/json"}, content=json.dumps(payload),
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                backends.release(backend, failed=not request_cancelled())
+                tried.append(backend)
+                if len(tried) == len(backends.backends):
+                    raise
+                backends.count("failover")
+                continue
+            except asyncio.CancelledError:  # Stopped by the browser, the cancel API or a disconnect, not by the backend
+                backends.release(backend)
+                raise
+            except BaseException:
+                backends.release(backend, failed=not request_cancelled())
+                raise
+            if request_cancelled():
+                await response.aclose()
+                backends.release(backend)
+                raise_if_task_cancelled()
+            upstream_latency.observe(time.perf_counter() - started, metrics.model_label(payload['model']))
+            record_span('upstream.headers' if payload['stream'] else 'upstream.response', started, backend=backend.url, status=response.status_code)
+            if response.is_error:
+                await response.aclose()
+                backends.release(backend, failed=response.status_code >= 500)
+                response.raise_for_status()
+            return response, backend
+
+    async def queued_stream(self, ticket, payload, chat_id, send, extra_headers, collector=None):
+        """The async version of queued_stream()."""
+        await self.start_stream(send, extra_headers)
+        try:
+            with span('admission.wait', queued=True):
+                async for position in ticket.await_admission(admission.timeout):
+                    await send({'type': 'http.response.body', 'body': sse_event({"position": position}, event="queue"), 'more_body': True})
+            response, backend = await self.send_chat(payload, chat_id)
+        except (QueueTimeout, httpx.HTTPError) as e:
+            error = "LM Studio is busy." if isinstance(e, QueueTimeout) else "Could not get a response from LM Studio."
+            await send({'type': 'http.response.body', 'body': sse_event({"error": error, "details": str(e)}, event="error")})
+            return
+        try:
+            await self.relay_stream(response, send, collector=collector, started=True)
+        finally:
+            backends.release(backend)
+
+    async def start_stream(self, send, extra_headers=None):
+        headers = [(b'content-type', b'text/event-stream')] + ASGI_CORS_HEADERS
+        headers += [(name.lower().encode(), value.encode()) for name, value in {**SSE_HEADERS, **(extra_headers or {})}.items()]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    async def relay_stream(self, response, send, extra_headers=None, collector=None, started=False):
+        """Forwards LM Studio's SSE chunks to the client as soon as they arrive.
+
+        A stream relayed without errors is stored by the collector before the
+        response ends, so the session has the reply by the time the next turn comes.
+        """
+        if not started:
+            await self.start_stream(send, extra_headers)
+        relay_started = first_byte = time.perf_counter()
+        try:
+            async for chunk in response.aiter_bytes():
+                if first_byte == relay_started:
+                    first_byte = time.perf_counter()
+                    record_span('upstream.first_byte', relay_started, first_byte)
+                raise_if_task_cancelled()
+                if collector:
+                    collector.feed(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        except httpx.HTTPError as e:
+            error = sse_event({"error": "The LM Studio stream was interrupted.", "details": str(e)}, event="error")
+            await send({'type': 'http.response.body', 'body': error, 'more_body': True})
+            collector = None
+        finally:
+            await response.aclose()
+            record_span('upstream.stream', first_byte)
+        if collector:
+            await asyncio.to_thread(collector.store)
+        await send({'type': 'http.response.body', 'body': b''})
+
+asgi_app = AsgiApp(app) if httpx is not None else None
+
+# --- Production Serving ---
+
+def warn_unknown_workers(server):
+    """Warns that every worker admits the full per-model limits when the worker count isn't known."""
+    if admission_workers() is None and (MODEL_CONCURRENCY is not None or MODEL_CONCURRENCY_LIMITS):
+        print(f"⚠️  Started by {server} without WORKERS or WEB_CONCURRENCY: with more than one worker, each one admits "
+              f"the full MODEL_CONCURRENCY ({MODEL_CONCURRENCY}) and LM Studio gets that many chats per worker. "
+              f"Set WORKERS to the number of workers.", file=sys.stderr, flush=True)
+
+def warn_small_limits():
+    """Warns about per-model limits below the worker count, where each worker still admits one chat."""
+    workers = admission_workers()
+    if not workers or workers <= 1:
+        return
+    limits = {"MODEL_CONCURRENCY": MODEL_CONCURRENCY, **{f"MODEL_CONCURRENCY_LIMITS[{model!r}]": limit for model, limit in MODEL_CONCURRENCY_LIMITS.items()}}
+    for name, limit in limits.items():
+        if limit is not None and limit < workers:
+            print(f"⚠️  {name} is {limit} but there are {workers} workers: each one admits a chat at a time, so LM Studio "
+                  f"can get {workers} at once. Run fewer workers or raise the limit.", file=sys.stderr, flush=True)
+
+def share_sessions():
+    """Keeps chat sessions on disk when there are several workers, so any worker can take a chat's next turn.
+
+    Each worker only remembers the chats it served itself; without a shared
+    directory a turn that lands on another worker gets a 409 and the browser
+    has to send the whole chat again.
+    """
+    global SESSION_DIR
+    workers = admission_workers()
+    if CHAT_SESSIONS and SESSION_DIR is None and workers and workers > 1:
+        SESSION_DIR = sessions.directory = 'sessions'
+        print(f"Keeping chat sessions in {os.path.abspath(SESSION_DIR)}/ for the {workers} workers to share "
+              f"(set SESSION_DIR to choose another directory).", flush=True)
+
+def relay_cancels():
+    """With several workers, lets cancel calls reach chats running in the other workers."""
+    workers = admission_workers()
+    if workers and workers > 1:
+        cancel_relay.start()
+
+def create_app():
+    """The WSGI app, for servers such as gunicorn: gunicorn -k gthread --threads 32 'app:create_app()'
+
+    Started from this directory, gunicorn loads gunicorn.conf.py, which passes
+    its worker count on so the per-model limits are divided between workers.
+    """
+    if 'gunicorn' in sys.modules:
+        warn_unknown_workers('gunicorn')
+    warn_small_limits()
+    share_sessions()
+    relay_cancels()
+    return app
+
+def create_asgi_app():
+    """The ASGI app, for servers such as uvicorn: uvicorn --factory app:create_asgi_app
+
+    Run with --workers, uvicorn doesn't tell the workers how many there are:
+    set WORKERS (or WEB_CONCURRENCY, which uvicorn also uses as --workers).
+    """
+    if asgi_app is None:
+        raise RuntimeError("Async mode needs extra packages: pip3 install httpx asgiref uvicorn")
+    if multiprocessing.parent_process() is not None:  # A worker process of uvicorn --workers (or --reload)
+        warn_unknown_workers('uvicorn')
+    warn_small_limits()
+    share_sessions()
+    relay_cancels()
+    return asgi_app
+
+def worker_count():
+    return WORKERS or os.cpu_count() or 1
+
+def serve_production(use_async):
+    """Runs worker processes that each import this module afresh.
+
+    On SIGTERM or SIGINT the workers stop accepting connections and get
+    GRACEFUL_TIMEOUT seconds to finish the generations already in progress.
+    """
+    workers = worker_count()
+    # Workers read WORKERS to split the per-model concurrency limits between them.
+    os.environ['WORKERS'] = str(workers)
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    if use_async:
+        try:
+            import uvicorn
+        except ImportError:
+            raise SystemExit("Async mode needs extra packages: pip3 install httpx asgiref uvicorn")
+        uvicorn.run('app:create_asgi_app', factory=True, app_dir=module_dir, host='0.0.0.0', port=APP_PORT,
+                    workers=workers, backlog=4096, timeout_graceful_shutdown=GRACEFUL_TIMEOUT)
+        return
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("Production mode needs gunicorn (pip3 install gunicorn), or use --production --async")
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"0.0.0.0:{APP_PORT}", 'workers': workers, 'worker_class': 'gthread', 'threads': WORKER_THREADS,
+                'graceful_timeout': GRACEFUL_TIMEOUT, 'timeout': 60, 'keepalive': 5, 'backlog': 4096,
+                'accesslog': '-', 'chdir': module_dir,
+            }
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            # Imported in each worker, so threads and connection pools start after the fork.
+            from app import create_app
+            return create_app()
+
+    ProductionServer().run()
+
 # --- Main Execution ---
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="LM Studio Glass UI server")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Serve the chat, models and config APIs with async handlers under uvicorn.")
+    parser.add_argument('--production', action='store_true',
+                        help="Run several worker processes (gunicorn, or uvicorn with --async) instead of the development server.")
+    parser.add_argument('--workers', type=int, help="Worker processes with --production (default: WORKERS, or one per CPU core).")
+    parser.add_argument('--index-embeddings', action='store_true',
+                        help="Embed the saved chat messages that aren't in the vector index yet (EMBEDDING_MODEL), then exit.")
+    args = parser.parse_args()
+    if args.index_embeddings:
+        if message_index is None:
+            raise SystemExit("Indexing needs EMBEDDING_MODEL, CHAT_STORE = 'local' and numpy (pip3 install numpy).")
+        try:
+            if not message_index.index_all(progress=lambda count: print(f"\r{count} messages embedded", end="", flush=True)):
+                raise SystemExit("Another process is indexing the chat messages already.")
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            raise SystemExit(f"\nCould not index chat messages: {e}")
+        print(f"\r✅ {message_index.stats()['indexed']} messages embedded with {message_index.model}")
+        raise SystemExit(0)
+    if args.workers:
+        WORKERS = args.workers
     print(f"🚀 Server starting...")
-    print(f"✅ LM Studio backend is expected at: {LM_STUDIO_BASE_URL}")
+    print(f"✅ LM Studio backend is expected at: {', '.join(b.url for b in backends.backends)}")
     print(f"✅ Web UI will be available at: http://0.0.0.0:{APP_PORT}")
-    app.run(host='0.0.0.0', port=APP_PORT, debug=True)
+    if args.production:
+        print(f"✅ Production mode with {worker_count()} {'async' if args.use_async else 'sync'} workers")
+        serve_production(args.use_async)
+    elif args.use_async:
+        try:
+            import uvicorn
+        except ImportError:
+            uvicorn = None
+        if uvicorn is None or asgi_app is None:
+            raise SystemExit("Async mode needs extra packages: pip3 install httpx asgiref uvicorn")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=APP_PORT, backlog=4096)
+    else:
+        app.run(host='0.0.0.0', port=APP_PORT, debug=True)
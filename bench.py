@@ -0,0 +1,816 @@
+# bench.py
+# ---
+# Benchmarks for app.py against a fake LM Studio server
+# Runs an OpenAI-compatible mock backend so proxy latency can be measured without a GPU
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# --- Fake LM Studio ---
+
+class FakeLMStudio:
+    """A minimal OpenAI-compatible server that streams tokens at a fixed rate.
+
+    error_rate is the fraction of chat completions answered with a 500 instead.
+    Embeddings are hashed bags of words, so texts sharing words come out similar.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, tokens=40, token_rate=40.0, latency=0.2, models=('fake-model',), error_rate=0.0, seed=None, embedding_dim=256):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.latency = latency
+        self.models = list(models)
+        self.error_rate = error_rate
+        self.embedding_dim = embedding_dim
+        self.random = random.Random(seed)
+        self.requests = collections.Counter()
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port, backlog=4096))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests[path] += 1
+                if path.endswith('/models'):
+                    await self._send_json(writer, {"object": "list", "data": [{"id": m, "object": "model"} for m in self.models]})
+                elif path.endswith('/chat/completions') and method == 'POST':
+                    request = json.loads(body or b'{}')
+                    if self.random.random() < self.error_rate:
+                        self.requests['injected_errors'] += 1
+                        await asyncio.sleep(self.latency)
+                        await self._send_json(writer, {"error": "Injected failure"}, status='500 Internal Server Error')
+                    elif request.get('stream'):
+                        await self._stream_completion(writer, request)
+                    else:
+                        await self._complete(writer, request)
+                elif path.endswith('/embeddings') and method == 'POST':
+                    await self._embed(writer, json.loads(body or b'{}'))
+                else:
+                    await self._send_json(writer, {"error": "not found"}, status='404 Not Found')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send_json(self, writer, data, status='200 OK'):
+        body = json.dumps(data).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _complete(self, writer, request):
+        await asyncio.sleep(self.latency + self.tokens / self.token_rate)
+        content = ' '.join(f"tok{i}" for i in range(self.tokens))
+        await self._send_json(writer, {
+            "id": "chatcmpl-fake", "object": "chat.completion", "model": request.get('model'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": self.tokens, "total_tokens": 10 + self.tokens},
+        })
+
+    async def _embed(self, writer, request):
+        texts = request.get('input', [])
+        texts = [texts] if isinstance(texts, str) else texts
+        data = []
+        for i, text in enumerate(texts):
+            vector = [0.0] * self.embedding_dim
+            vector[0] = 0.01  # Keeps empty texts from having no direction
+            for word in str(text).lower().split():
+                vector[zlib.crc32(word.encode()) % self.embedding_dim] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        await asyncio.sleep(self.latency / 10)
+        await self._send_json(writer, {"object": "list", "model": request.get('model'), "data": data})
+
+    async def _stream_completion(self, writer, request):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self.latency)
+        for i in range(self.tokens):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": request.get('model'),
+                     "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}]}
+            await self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(1 / self.token_rate)
+        await self._write_chunk(writer, b"data: [DONE]\n\n")
+        await self._write_chunk(writer, b"")
+
+    async def _write_chunk(self, writer, data):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+# --- Proxy Under Test ---
+
+def start_proxy(base_url):
+    """Serves app.py in-process on a free port, pointed at the given backend."""
+    from werkzeug.serving import make_server
+    import app as proxy
+    proxy.backends = proxy.BackendPool([base_url], proxy.BACKEND_HEALTH_INTERVAL, proxy.BACKEND_EJECT_FAILURES, proxy.BACKEND_EJECT_SECONDS)
+    proxy.TRACE_LOG = False
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, proxy.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_async_proxy():
+    """Serves app.py's ASGI app in-process under uvicorn on a free port; returns (server, port)."""
+    import uvicorn
+    import app as proxy
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(proxy.asgi_app, log_level='warning'))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, sock.getsockname()[1]
+
+def serve_proxy(mode, port, backend, model_concurrency=None):
+    """Runs app.py in this process in 'sync' (threaded Flask) or 'async' (uvicorn) mode.
+
+    model_concurrency replaces the proxy's per-model limit; None lifts it, so the
+    serving mode itself is measured rather than the admission queue.
+    """
+    import app as proxy
+    proxy.backends = proxy.BackendPool([backend], proxy.BACKEND_HEALTH_INTERVAL, proxy.BACKEND_EJECT_FAILURES, proxy.BACKEND_EJECT_SECONDS)
+    proxy.admission = proxy.AdmissionController(model_concurrency, {}, proxy.ADMISSION_QUEUE_SIZE, proxy.ADMISSION_QUEUE_TIMEOUT)
+    proxy.TRACE_LOG = False  # A JSON line per chat would drown the benchmark's own output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(4096)
+    print(f"READY {sock.getsockname()[1]}", flush=True)
+    if mode == 'async':
+        import uvicorn
+        config = uvicorn.Config(proxy.asgi_app, log_level='warning', backlog=4096)
+        uvicorn.Server(config).run(sockets=[sock])
+    else:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', 0, proxy.app, threaded=True, fd=sock.fileno()).serve_forever()
+
+def spawn(*args):
+    """Starts a bench.py subcommand in its own process and returns (process, port)."""
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), *args], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('READY'):
+        process.kill()
+        raise RuntimeError(f"{args[0]} failed to start")
+    return process, int(line.split()[1])
+
+def process_status(pid):
+    """Reads thread count, current RSS and peak RSS (MB) of a process from /proc."""
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                status[name] = value.split()[0] if value.split() else ''
+    except OSError:
+        pass
+    return {
+        "threads": int(status.get('Threads', 0)),
+        "rss_mb": int(status.get('VmRSS', 0)) / 1024,
+        "rss_peak_mb": int(status.get('VmHWM', 0)) / 1024,
+    }
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def timed_chat(port, stream, path='/api/chat'):
+    """Posts one chat request and returns (time to first body byte, total time)."""
+    body = json.dumps({"model": "fake-model", "messages": [{"role": "user", "content": "hi"}], "stream": stream})
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    conn.request('POST', path, body=body, headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"{path} returned {response.status}: {response.read()[:200]!r}")
+    response.read1(65536)
+    first_byte = time.perf_counter() - start
+    response.read()
+    total = time.perf_counter() - start
+    conn.close()
+    return first_byte, total
+
+async def stream_chat(port, timeout):
+    """Sends one streaming chat over a raw connection; returns (status, ttfb, total)."""
+    body = json.dumps({"model": "fake-model", "messages": [{"role": "user", "content": "hi"}], "stream": True}).encode()
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(
+            b"POST /api/chat HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nConnection: close\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        status = int((await asyncio.wait_for(reader.readline(), timeout)).split()[1])
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        await asyncio.wait_for(reader.read(1), timeout)
+        ttfb = time.perf_counter() - start
+        while await asyncio.wait_for(reader.read(65536), timeout):
+            pass
+        return status, ttfb, time.perf_counter() - start
+    finally:
+        writer.close()
+
+async def drive_load(port, concurrency, timeout, pid):
+    """Opens `concurrency` simultaneous streaming chats and samples the server while they run."""
+    peak_threads = 0
+    async def sample():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, process_status(pid)["threads"])
+            await asyncio.sleep(0.05)
+    sampler = asyncio.create_task(sample())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(stream_chat(port, timeout) for _ in range(concurrency)), return_exceptions=True)
+    wall = time.perf_counter() - start
+    sampler.cancel()
+    ok = [r for r in results if not isinstance(r, BaseException) and r[0] == 200]
+    error_types = {}
+    for r in results:
+        if isinstance(r, BaseException) or r[0] != 200:
+            kind = type(r).__name__ if isinstance(r, BaseException) else f"HTTP {r[0]}"
+            error_types[kind] = error_types.get(kind, 0) + 1
+    ttfbs = [r[1] * 1000 for r in ok]
+    totals = [r[2] * 1000 for r in ok]
+    return {
+        "concurrency": concurrency,
+        "completed": len(ok),
+        "errors": len(results) - len(ok),
+        "error_types": error_types,
+        "ttfb_p50_ms": round(percentile(ttfbs, 50) or 0, 1),
+        "ttfb_p95_ms": round(percentile(ttfbs, 95) or 0, 1),
+        "latency_p50_ms": round(percentile(totals, 50) or 0, 1),
+        "latency_p95_ms": round(percentile(totals, 95) or 0, 1),
+        "wall_s": round(wall, 2),
+        "throughput_rps": round(len(ok) / wall, 1),
+        "server_threads_peak": peak_threads,
+        "server_rss_peak_mb": round(process_status(pid)["rss_peak_mb"], 1),
+    }
+
+def completion_body(reply_bytes):
+    """A non-streamed completion with a reply of about `reply_bytes`, including the quotes and escapes real replies have."""
+    sentence = 'The "quick" brown fox \u2014 jumps over the lazy dog.\n'
+    content = (sentence * (reply_bytes // len(sentence) + 1))[:reply_bytes]
+    return json.dumps({
+        "id": "chatcmpl-bench", "object": "chat.completion", "model": "fake-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": reply_bytes // 4, "total_tokens": 10 + reply_bytes // 4},
+    }).encode()
+
+def time_per_call(fn, min_seconds):
+    """Calls fn repeatedly for at least `min_seconds` and returns the mean seconds per call."""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+# --- Benchmark Suite ---
+
+SCENARIOS = ('index', 'models', 'chat', 'chat-stream')
+
+def scenario_request(scenario, i):
+    """The raw HTTP request for one call of a scenario.
+
+    Chat prompts differ per call, so identical requests aren't coalesced into
+    one generation and every call reaches the fake backend.
+    """
+    if scenario == 'index':
+        return b"GET / HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+    if scenario == 'models':
+        return b"GET /api/models HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+    body = json.dumps({"model": "fake-model", "messages": [{"role": "user", "content": f"request {i}"}], "stream": scenario == 'chat-stream'}).encode()
+    return (
+        b"POST /api/chat HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nConnection: close\r\n"
+        + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+
+async def timed_request(port, raw, timeout):
+    """Sends one raw request and reads the response to the end; returns (status, ttfb, total)."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(raw)
+        await writer.drain()
+        status = int((await asyncio.wait_for(reader.readline(), timeout)).split()[1])
+        ttfb = time.perf_counter() - start
+        while await asyncio.wait_for(reader.read(65536), timeout):
+            pass
+        return status, ttfb, time.perf_counter() - start
+    finally:
+        writer.close()
+
+async def run_scenario(port, pid, scenario, concurrency, requests, timeout):
+    """Sends `requests` calls of a scenario from `concurrency` closed-loop clients."""
+    results = []
+    counter = iter(range(requests))
+    peak_rss = 0.0
+    async def client():
+        for i in counter:
+            try:
+                results.append(await timed_request(port, scenario_request(scenario, i), timeout))
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                results.append(e)
+    async def sample():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, process_status(pid)["rss_mb"])
+            await asyncio.sleep(0.05)
+    sampler = asyncio.create_task(sample())
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    sampler.cancel()
+    ok = [r for r in results if not isinstance(r, BaseException) and r[0] == 200]
+    error_types = collections.Counter(
+        type(r).__name__ if isinstance(r, BaseException) else f"HTTP {r[0]}"
+        for r in results if isinstance(r, BaseException) or r[0] != 200
+    )
+    latencies = [r[2] * 1000 for r in ok]
+    ttfbs = [r[1] * 1000 for r in ok]
+    summary = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "completed": len(ok),
+        "errors": len(results) - len(ok),
+        "error_types": dict(error_types),
+        "throughput_rps": round(len(ok) / wall, 1),
+        "wall_s": round(wall, 2),
+        "server_rss_mb": round(max(peak_rss, process_status(pid)["rss_mb"]), 1),
+    }
+    for pct in (50, 95, 99):
+        summary[f"latency_p{pct}_ms"] = round(percentile(latencies, pct) or 0, 1)
+        summary[f"ttfb_p{pct}_ms"] = round(percentile(ttfbs, pct) or 0, 1)
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result):
+    return (result["mode"], result["scenario"], result["concurrency"])
+
+def compare_results(baseline, current, threshold):
+    """Lines comparing two suite runs, and whether any scenario regressed by more than threshold percent."""
+    before = {result_key(r): r for r in baseline["results"]}
+    lines = [f"{'mode':<6} {'scenario':<12} {'conc':>5} {'p95 ms':>18} {'p99 ms':>18} {'rps':>18} {'errors':>9}"]
+    regressed = False
+    for result in current["results"]:
+        old = before.get(result_key(result))
+        if old is None:
+            continue
+        def change(metric):
+            return 100 * (result[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+        worse = [change("latency_p95_ms") > threshold, change("throughput_rps") < -threshold, result["errors"] > old["errors"]]
+        regressed = regressed or any(worse)
+        cells = [f"{old[m]:>7} → {result[m]:<7}" for m in ("latency_p95_ms", "latency_p99_ms", "throughput_rps")]
+        lines.append(f"{result['mode']:<6} {result['scenario']:<12} {result['concurrency']:>5} {' '.join(cells)} "
+                     f"{old['errors']:>3} → {result['errors']:<3}{'  REGRESSION' if any(worse) else ''}")
+    return lines, regressed
+
+# --- Regression Checks ---
+# Each check drives one proxy feature through a serving mode and returns what it observed;
+# `check` runs them against the sync and async servers and fails if either mode misbehaves or they differ.
+
+def post_chat(port, body, headers=None):
+    """Posts a chat body and returns (status, headers, body bytes); header lookups ignore case."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('POST', '/api/chat', body=json.dumps({"model": "fake-model", **body}), headers={"Content-Type": "application/json", **(headers or {})})
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+def check_coalescing(proxy, port, fakes):
+    """Identical requests sent at the same time share one generation."""
+    before = sum(fake.requests['/v1/chat/completions'] for fake in fakes)
+    body = {"messages": [{"role": "user", "content": f"coalesce {port}"}], "temperature": 0}
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: post_chat(port, body), range(4)))
+    replies = {json.loads(result[2])['choices'][0]['message']['content'] for result in results}
+    return {
+        "statuses": sorted(result[0] for result in results),
+        "generations": sum(fake.requests['/v1/chat/completions'] for fake in fakes) - before,
+        "coalesced": sum('X-Coalesced' in headers for _, headers, _ in results),
+        "same_reply": len(replies) == 1,
+    }
+
+def cancel_stream(port, n, early):
+    """Starts a chat and cancels it through the cancel API; returns (cancel status, reply tail).
+
+    An early cancel stops a non-streaming chat while the backend is still generating it,
+    a late one stops a streaming chat after its first chunk.
+    """
+    request_id = f"cancel-{port}-{n}"
+    body = json.dumps({"model": "fake-model", "messages": [{"role": "user", "content": f"cancel {n}"}], "stream": not early})
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('POST', '/api/chat', body=body, headers={"Content-Type": "application/json", "X-Request-Id": request_id})
+        if early:
+            time.sleep(0.3)
+        else:
+            response = conn.getresponse()
+            response.read1(65536)
+        cancel = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            cancel.request('POST', f'/api/chat/{request_id}/cancel')
+            status = cancel.getresponse().status
+        finally:
+            cancel.close()
+        if early:
+            response = conn.getresponse()
+        return status, response.read()[-200:]
+    finally:
+        conn.close()
+
+def check_cancel(proxy, port, fakes):
+    """Cancelled chats end with a cancelled reply and don't count against the backends."""
+    for fake in fakes:
+        fake.latency = 1.0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(6) as pool:
+            results = list(pool.map(lambda n: cancel_stream(port, n, early=n % 2 == 0), range(6)))
+    finally:
+        for fake in fakes:
+            fake.latency = 0.05
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and any(b["outstanding"] for b in proxy.backends.stats()["backends"].values()):
+        time.sleep(0.05)
+    pool_stats = proxy.backends.stats()["backends"].values()
+    return {
+        "cancel_statuses": sorted(status for status, _ in results),
+        "ended_cancelled": sum(b"cancelled" in tail for _, tail in results),
+        "outstanding": sum(b["outstanding"] for b in pool_stats),
+        "errors": sum(b["errors"] for b in pool_stats),
+        "ejected": sum(b["ejected"] for b in pool_stats),
+    }
+
+def check_sessions(proxy, port, fakes):
+    """A delta turn builds on the server's session; a turn on an old version gets 409 and the current version."""
+    chat_id = f"session-{port}"
+    turns = [
+        {"session": {"version": 0, "messages": 0}, "messages": [{"role": "user", "content": "hi"}]},
+        {"session": {"version": 1, "messages": 2}, "messages": [{"role": "user", "content": "and then?"}]},
+        {"session": {"version": 1, "messages": 2}, "messages": [{"role": "user", "content": "from another tab"}]},
+        {"session": {"version": 1, "messages": 2}, "messages": [{"role": "user", "content": "hi"}], "chat_id": f"unknown-{port}"},
+    ]
+    results = [post_chat(port, {"chat_id": chat_id, **turn}) for turn in turns]
+    return {
+        "statuses": [status for status, _, _ in results],
+        "versions": [headers.get('X-Session-Version') for _, headers, _ in results],
+        "conflict_versions": [json.loads(body).get('sessionVersion') for status, _, body in results if status == 409],
+    }
+
+CHECKS = {"coalescing": check_coalescing, "cancel": check_cancel, "sessions": check_sessions}
+CHECK_EXPECTED = {
+    "coalescing": {"statuses": [200] * 4, "generations": 1, "coalesced": 3, "same_reply": True},
+    "cancel": {"cancel_statuses": [200] * 6, "ended_cancelled": 6, "outstanding": 0, "errors": 0, "ejected": 0},
+    "sessions": {"statuses": [200, 200, 409, 409], "versions": ["1", "2", None, None], "conflict_versions": [2, None]},
+}
+
+# --- Commands ---
+
+def run_ttfb(args):
+    fake = FakeLMStudio(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency).start()
+    server = start_proxy(fake.base_url)
+    try:
+        results = {}
+        for mode, stream in (("non-streaming", False), ("streaming", True)):
+            samples = [timed_chat(server.port, stream) for _ in range(args.runs)]
+            results[mode] = {
+                "ttfb_ms": round(1000 * min(s[0] for s in samples), 1),
+                "total_ms": round(1000 * min(s[1] for s in samples), 1),
+            }
+    finally:
+        server.shutdown()
+        fake.stop()
+    print(json.dumps(results, indent=2))
+    # Streaming should deliver its first byte after prompt latency plus about one token, not the whole generation.
+    budget_ms = 1000 * (args.latency + 5 / args.token_rate) + 100
+    if results["streaming"]["ttfb_ms"] > budget_ms:
+        print(f"FAIL: streaming TTFB {results['streaming']['ttfb_ms']} ms exceeds {budget_ms:.0f} ms", file=sys.stderr)
+        return 1
+    print(f"OK: streaming TTFB within {budget_ms:.0f} ms")
+    return 0
+
+def run_check(args):
+    import app as proxy
+    fakes = [FakeLMStudio(tokens=100, token_rate=50, latency=0.05).start() for _ in range(2)]
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    sync_server = start_proxy(fakes[0].base_url)
+    async_server, async_port = start_async_proxy()
+    failures = []
+    results = {}
+    try:
+        for name in args.checks.split(','):
+            results[name] = {}
+            for mode, port in (("sync", sync_server.port), ("async", async_port)):
+                proxy.backends = proxy.BackendPool([fake.base_url for fake in fakes], proxy.BACKEND_HEALTH_INTERVAL, proxy.BACKEND_EJECT_FAILURES, proxy.BACKEND_EJECT_SECONDS)
+                results[name][mode] = observed = CHECKS[name](proxy, port, fakes)
+                if observed != CHECK_EXPECTED[name]:
+                    failures.append(f"{name} ({mode}): expected {CHECK_EXPECTED[name]}, got {observed}")
+    finally:
+        sync_server.shutdown()
+        async_server.should_exit = True
+        for fake in fakes:
+            fake.stop()
+    print(json.dumps(results, indent=2))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    if not failures:
+        print(f"OK: {', '.join(results)} behave as expected in sync and async mode")
+    return 1 if failures else 0
+
+def run_passthrough(args):
+    import app as proxy
+    fake = FakeLMStudio(token_rate=1e9, latency=0).start()
+    server = start_proxy(fake.base_url)
+    results = []
+    try:
+        for size in (int(s) for s in args.sizes.split(',')):
+            # In-process cost of handing one completion body to the browser
+            body = completion_body(size)
+            with proxy.app.app_context():
+                reparse = time_per_call(lambda: proxy.jsonify(json.loads(body)).get_data(), args.min_time)
+            passthrough = time_per_call(lambda: proxy.Response(body, content_type='application/json').get_data(), args.min_time)
+            # End to end: what the proxy adds to a request sent straight to the fake server
+            fake.tokens = max(1, size // 7)  # The fake server's replies are "tok0 tok1 ..."
+            direct = [timed_chat(fake.port, False, '/v1/chat/completions')[1] for _ in range(args.runs)]
+            proxied = [timed_chat(server.port, False)[1] for _ in range(args.runs)]
+            result = {
+                "reply_bytes": size, "body_bytes": len(body),
+                "reparse_us": round(reparse * 1e6, 1), "passthrough_us": round(passthrough * 1e6, 1),
+                "speedup": round(reparse / passthrough, 1),
+                "direct_p50_ms": round(1000 * percentile(direct, 50), 2), "proxy_p50_ms": round(1000 * percentile(proxied, 50), 2),
+                "proxy_overhead_ms": round(1000 * (percentile(proxied, 50) - percentile(direct, 50)), 2),
+            }
+            results.append(result)
+            print(f"{size:>9} B  re-encode {result['reparse_us']:>9} us  passthrough {result['passthrough_us']:>7} us  "
+                  f"x{result['speedup']:<6}  proxy overhead {result['proxy_overhead_ms']:>6} ms", file=sys.stderr)
+    finally:
+        server.shutdown()
+        fake.stop()
+    print(json.dumps(results, indent=2))
+    return 0
+
+def run_retrieval(args):
+    import numpy as np
+    import app as proxy
+    fake = FakeLMStudio(latency=0.02).start()
+    server = start_proxy(fake.base_url)
+    workdir = tempfile.mkdtemp(prefix='bench-retrieval-')
+    proxy.chat_store = proxy.ChatStore(os.path.join(workdir, 'chats.db'))
+    results = {}
+    try:
+        # Backfill: embed a saved history in batches, counting the requests it takes
+        words = [f"word{i}" for i in range(500)]
+        messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": ' '.join(random.choices(words, k=30))} for i in range(args.messages)]
+        for start in range(0, len(messages), 100):
+            proxy.chat_store.create_chat('bench', 'Bench chat', messages[start:start + 100])
+        index = proxy.MessageIndex(os.path.join(workdir, 'embeddings'), 'fake-embedding', args.batch_size)
+        started = time.perf_counter()
+        index.index_all()
+        elapsed = time.perf_counter() - started
+        results["backfill"] = {
+            "messages": args.messages, "batch_size": args.batch_size, "embedding_requests": fake.requests['/v1/embeddings'],
+            "seconds": round(elapsed, 2), "messages_per_second": round(args.messages / elapsed),
+        }
+        print(f"backfill {args.messages} messages in {fake.requests['/v1/embeddings']} requests, {elapsed:.2f} s", file=sys.stderr)
+        # Search: score random vectors of a realistic size, one query and a batch of queries at a time
+        rng = np.random.default_rng(0)
+        index = proxy.MessageIndex(os.path.join(workdir, 'vectors'), 'random', args.batch_size)
+        state, _ = index._state()
+        state["dim"] = args.dim
+        os.makedirs(index._user_path('bench'))
+        with open(os.path.join(index._user_path('bench'), 'ids.i64'), 'wb') as f:
+            f.write(np.arange(args.vectors, dtype='<i8').tobytes())
+        with open(os.path.join(index._user_path('bench'), 'scales.f32'), 'wb') as f:
+            f.write(np.full(args.vectors, 1 / 127, dtype='<f4').tobytes())
+        with open(os.path.join(index._user_path('bench'), 'vectors.i8'), 'wb') as f:
+            f.write(rng.integers(-127, 128, (args.vectors, args.dim), dtype=np.int8).tobytes())
+        index._save_state(state)
+        results["search"] = {"vectors": args.vectors, "dim": args.dim}
+        for queries in (1, 8):
+            batch = rng.standard_normal((queries, args.dim), dtype=np.float32)
+            seconds = time_per_call(lambda: index.search('bench', batch, 16), args.min_time)
+            results["search"][f"batch_{queries}_ms"] = round(seconds * 1000, 2)
+            print(f"search {args.vectors} x {args.dim}: {queries} queries in {seconds * 1000:.2f} ms", file=sys.stderr)
+    finally:
+        server.shutdown()
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+    return 0
+
+def run_loadtest(args):
+    fake, fake_port = spawn('fake-server', '--tokens', str(args.tokens), '--token-rate', str(args.token_rate), '--latency', str(args.latency))
+    results = {}
+    try:
+        for mode in args.modes.split(','):
+            proxy, port = spawn('serve', '--mode', mode, '--backend', f"http://127.0.0.1:{fake_port}/v1", '--model-concurrency', str(args.model_concurrency))
+            try:
+                results[mode] = asyncio.run(drive_load(port, args.concurrency, args.timeout, proxy.pid))
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+    print(json.dumps(results, indent=2))
+    return 0 if all(r["errors"] == 0 for r in results.values()) else 1
+
+def run_suite(args):
+    fake, fake_port = spawn('fake-server', '--tokens', str(args.tokens), '--token-rate', str(args.token_rate),
+                            '--latency', str(args.latency), '--error-rate', str(args.error_rate))
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))} (choose from {', '.join(SCENARIOS)})")
+    results = []
+    try:
+        for mode in args.modes.split(','):
+            proxy, port = spawn('serve', '--mode', mode, '--backend', f"http://127.0.0.1:{fake_port}/v1", '--model-concurrency', str(args.model_concurrency))
+            try:
+                for scenario in scenarios:
+                    for concurrency in (int(c) for c in args.concurrency.split(',')):
+                        result = {"mode": mode, **asyncio.run(run_scenario(port, proxy.pid, scenario, concurrency, args.requests, args.timeout))}
+                        results.append(result)
+                        print(f"{mode:<6} {scenario:<12} c={concurrency:<4} p50 {result['latency_p50_ms']:>8} ms  p95 {result['latency_p95_ms']:>8} ms  "
+                              f"p99 {result['latency_p99_ms']:>8} ms  {result['throughput_rps']:>7} req/s  {result['errors']} errors  "
+                              f"{result['server_rss_mb']} MB", file=sys.stderr)
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "revision": git_revision(),
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "backend": {"tokens": args.tokens, "token_rate": args.token_rate, "latency": args.latency, "error_rate": args.error_rate},
+            "requests": args.requests, "model_concurrency": args.model_concurrency,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressed = compare_results(json.load(f), report, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    return 0
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    lines, regressed = compare_results(baseline, current, args.threshold)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+def run_fake_server(args):
+    fake = FakeLMStudio(port=args.port, tokens=args.tokens, token_rate=args.token_rate, latency=args.latency, error_rate=args.error_rate).start()
+    print(f"READY {fake.port}", flush=True)
+    threading.Event().wait()
+
+def run_serve(args):
+    serve_proxy(args.mode, args.port, args.backend, args.model_concurrency or None)
+
+def raise_open_file_limit():
+    """Thousands of concurrent connections need more file descriptors than the usual default."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+def add_backend_arguments(parser):
+    parser.add_argument('--tokens', type=int, default=40)
+    parser.add_argument('--token-rate', type=float, default=40.0, help="Tokens per second generated by the fake server.")
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds of prompt processing before the first token.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of chat completions the fake server fails with a 500.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the LM Studio proxy.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser('check', help="Regression checks of the sync and async serving paths.")
+    check.add_argument('--checks', default=','.join(CHECKS), help="Comma-separated checks to run.")
+    check.set_defaults(func=run_check)
+    ttfb = commands.add_parser('ttfb', help="Compare time-to-first-byte for streaming and non-streaming chat.")
+    add_backend_arguments(ttfb)
+    ttfb.add_argument('--runs', type=int, default=3)
+    ttfb.set_defaults(func=run_ttfb)
+    passthrough = commands.add_parser('passthrough', help="Measure what relaying large non-streamed completions costs the proxy.")
+    passthrough.add_argument('--sizes', default='1024,102400,1048576', help="Comma-separated reply sizes in bytes.")
+    passthrough.add_argument('--runs', type=int, default=20, help="End-to-end requests per size.")
+    passthrough.add_argument('--min-time', type=float, default=0.5, help="Seconds each in-process measurement runs.")
+    passthrough.set_defaults(func=run_passthrough)
+    retrieval = commands.add_parser('retrieval', help="Measure backfilling the message index and searching it.")
+    retrieval.add_argument('--messages', type=int, default=2000, help="Saved messages to embed.")
+    retrieval.add_argument('--batch-size', type=int, default=64, help="Messages per /embeddings request.")
+    retrieval.add_argument('--vectors', type=int, default=100000, help="Vectors in the searched index.")
+    retrieval.add_argument('--dim', type=int, default=768, help="Size of each vector.")
+    retrieval.add_argument('--min-time', type=float, default=1.0, help="Seconds each search measurement runs.")
+    retrieval.set_defaults(func=run_retrieval)
+    load = commands.add_parser('loadtest', help="Hold many concurrent streaming chats open and compare serving modes.")
+    add_backend_arguments(load)
+    load.add_argument('--concurrency', type=int, default=500)
+    load.add_argument('--modes', default='sync,async', help="Comma-separated serving modes to compare.")
+    load.add_argument('--timeout', type=float, default=120.0, help="Per-read timeout in seconds.")
+    load.add_argument('--model-concurrency', type=int, default=0, help="Per-model admission limit of the proxy (0 for none).")
+    load.set_defaults(func=run_loadtest)
+    suite = commands.add_parser('suite', help="Measure latency, throughput and memory of /, /api/models and /api/chat.")
+    add_backend_arguments(suite)
+    suite.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated scenarios to run.")
+    suite.add_argument('--concurrency', default='1,10,50', help="Comma-separated numbers of concurrent clients.")
+    suite.add_argument('--requests', type=int, default=200, help="Requests per scenario and concurrency level.")
+    suite.add_argument('--modes', default='sync,async', help="Comma-separated serving modes to compare.")
+    suite.add_argument('--timeout', type=float, default=120.0, help="Per-read timeout in seconds.")
+    suite.add_argument('--model-concurrency', type=int, default=0, help="Per-model admission limit of the proxy (0 for none).")
+    suite.add_argument('--output', help="Write the results to this JSON file instead of stdout.")
+    suite.add_argument('--baseline', help="Compare against an earlier results file and exit 1 on a regression.")
+    suite.add_argument('--threshold', type=float, default=10.0, help="Percent change in p95 latency or throughput that counts as a regression.")
+    suite.set_defaults(func=run_suite)
+    compare = commands.add_parser('compare', help="Compare two suite result files.")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10.0, help="Percent change in p95 latency or throughput that counts as a regression.")
+    compare.set_defaults(func=run_compare)
+    fake = commands.add_parser('fake-server', help="Run only the fake LM Studio server.")
+    add_backend_arguments(fake)
+    fake.add_argument('--port', type=int, default=1234)
+    fake.set_defaults(func=run_fake_server)
+    serve = commands.add_parser('serve', help="Run app.py in a given serving mode (used by loadtest).")
+    serve.add_argument('--mode', choices=('sync', 'async'), default='sync')
+    serve.add_argument('--port', type=int, default=0)
+    serve.add_argument('--backend', default="http://127.0.0.1:1234/v1")
+    serve.add_argument('--model-concurrency', type=int, default=0, help="Per-model admission limit (0 for none).")
+    serve.set_defaults(func=run_serve)
+    args = parser.parse_args(argv)
+    raise_open_file_limit()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
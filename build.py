@@ -0,0 +1,102 @@
+# build.py
+# ---
+# Ahead-of-time build of the React frontend embedded in app.py
+# Compiles the JSX into a minified production bundle and purges Tailwind into static CSS
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+from app import INDEX_HTML, STATIC_DIR, brotli
+
+# Node tools run through npx by default; set ESBUILD / TAILWIND to use local binaries instead.
+ESBUILD = os.environ.get('ESBUILD', 'npx --yes esbuild@0.23.1').split()
+TAILWIND = os.environ.get('TAILWIND', 'npx --yes tailwindcss@3.4.13').split()
+
+def extract_jsx(html):
+    """Returns the source of the <script type="text/babel"> block."""
+    match = re.search(r'<script type="text/babel">(.*?)</script>', html, re.S)
+    if not match:
+        raise SystemExit("No <script type=\"text/babel\"> block found in INDEX_HTML")
+    return match.group(1)
+
+def run(command, stdin=None):
+    try:
+        result = subprocess.run(command, input=stdin, capture_output=True, check=True)
+    except FileNotFoundError:
+        raise SystemExit(f"{command[0]} not found. Install Node.js (for npx) or set ESBUILD/TAILWIND.")
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(f"{' '.join(command)} failed:\n{e.stderr.decode(errors='replace')}")
+    return result.stdout
+
+def bundle_js(jsx):
+    """Compiles the JSX app with esbuild against the global (UMD) React build."""
+    return run(ESBUILD + [
+        '--loader=jsx', '--minify', '--target=es2020',
+        '--jsx-factory=React.createElement', '--jsx-fragment=React.Fragment',
+        '--define:process.env.NODE_ENV="production"',
+    ], stdin=jsx.encode())
+
+def build_css(html):
+    """Generates only the Tailwind classes the page actually uses."""
+    with tempfile.TemporaryDirectory() as workdir:
+        content = os.path.join(workdir, 'index.html')
+        source = os.path.join(workdir, 'input.css')
+        output = os.path.join(workdir, 'output.css')
+        with open(content, 'w') as f:
+            f.write(html)
+        with open(source, 'w') as f:
+            f.write("@tailwind base;\n@tailwind components;\n@tailwind utilities;\n")
+        run(TAILWIND + ['-i', source, '-o', output, '--content', content, '--minify'])
+        with open(output, 'rb') as f:
+            return f.read()
+
+def write_asset(name, extension, body):
+    """Writes a content-hashed asset plus gzip/brotli variants and returns its file name."""
+    filename = f"{name}.{hashlib.sha256(body).hexdigest()[:12]}.{extension}"
+    path = os.path.join(STATIC_DIR, filename)
+    with open(path, 'wb') as f:
+        f.write(body)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(body, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(body, quality=11))
+    return filename
+
+def read_manifest():
+    """The manifest of the previous build, or an empty one."""
+    try:
+        with open(os.path.join(STATIC_DIR, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def main():
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    previous = read_manifest()
+    manifest = {
+        "js": write_asset('app', 'js', bundle_js(extract_jsx(INDEX_HTML))),
+        "css": write_asset('app', 'css', build_css(INDEX_HTML)),
+    }
+    # Drop bundles from older builds. The previous build's stay: a running server keeps
+    # serving the page that points at them until it is restarted.
+    keep = set(manifest.values()) | set(previous.values())
+    for path in glob.glob(os.path.join(STATIC_DIR, 'app.*')):
+        if os.path.basename(path).split('.gz')[0].split('.br')[0] not in keep:
+            os.remove(path)
+    with open(os.path.join(STATIC_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    for filename in manifest.values():
+        print(f"✅ static/{filename} ({os.path.getsize(os.path.join(STATIC_DIR, filename)) // 1024} KB)")
+    print("Restart the server to serve the new bundle.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
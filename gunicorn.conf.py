@@ -0,0 +1,10 @@
+# gunicorn.conf.py
+# ---
+# Loaded by gunicorn when it is started from this directory, e.g. gunicorn -k gthread --threads 32 -w 4 'app:create_app()'
+# Tells app.py how many workers there are, so the per-model concurrency limits are divided between them
+
+import os
+
+def on_starting(server):
+    # Runs in the master before the workers fork; they import app.py afterwards and read it.
+    os.environ['WORKERS'] = str(server.cfg.workers)